@@ -1,4 +1,4 @@
-from flask import Flask, Blueprint, jsonify, request, current_app, send_file
+from flask import Flask, Blueprint, jsonify, request, current_app, send_file, after_this_request
 from app.models import * # Import from your models.py
 from flask_cors import CORS
 from functools import wraps
@@ -63,7 +63,26 @@ from flask import Flask, request, jsonify
 import os
 import uuid
 import json
+import hashlib
+import mimetypes
+import shutil
 from werkzeug.utils import secure_filename
+from app.chunk_io import preallocate, write_stream, write_stream_at, concat_files, DecodingReader, UnsupportedEncoding, available_chunk_encodings
+from app.upload_sessions import get_upload_store, UploadSessionError, has_bit, first_missing, missing_ranges
+from werkzeug.http import http_date
+from app.digests import BlockHasher, combine_block_digests, file_digest, is_block_aligned, DIGEST_ALGORITHM, DIGEST_BLOCK_SIZE
+from app.blobstore import store_blob, adjust_blob_refs, find_stored_files, owned_digests
+from app.multipart_stream import stream_multipart, StreamedFile
+from werkzeug.exceptions import RequestEntityTooLarge
+from sqlalchemy import insert, select
+from app.jobs import enqueue, job_handler, job_to_dict
+from app.upload_admission import admission_controlled, get_admission_controller
+from app.upload_layout import sharded_path
+from app.storage import LocalStorage, get_storage
+from app.upload_journal import open_upload_journal
+from app.frame_metadata import metadata_to_json
+from app.metadata_pool import read_frames_metadata
+from app.storage_usage import UsageChanges, IMAGE_CATEGORY, stored_file_info, stored_file_sizes, frameset_owner, usage_for, check_quota, quota_for
 
 # Assuming your Flask app is already created as 'app'
 # If not, create it with:
@@ -78,21 +97,14 @@ FINAL_UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '
 os.makedirs(TEMP_UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(FINAL_UPLOAD_FOLDER, exist_ok=True)
 
-# Store information about active uploads
-active_uploads = {}
+# Information about active uploads lives in a shared store (see app/upload_sessions.py),
+# so chunk and complete calls can land on any worker process
 @api_bp.route('/chunk-upload/init', methods=['POST'])
 @token_required
 def init_chunked_upload(current_user):
     """Initialize a new chunked upload"""
     data = request.json
     
-    # Generate a unique upload ID
-    upload_id = str(uuid.uuid4())
-    
-    # Create a folder for this upload's chunks
-    upload_folder = os.path.join(TEMP_UPLOAD_FOLDER, upload_id)
-    os.makedirs(upload_folder, exist_ok=True)
-    
     # Validate upload type (support for new frame types)
     valid_upload_types = [
         'main-image', 'lightFrames', 'darkFrames', 'flatFrames', 
@@ -103,111 +115,500 @@ def init_chunked_upload(current_user):
     if upload_type not in valid_upload_types:
         return jsonify({'error': f'Invalid upload type. Must be one of {valid_upload_types}'}), 400
     
+    # The chunk offsets are worked out from these, so they have to add up
+    file_size = get_positive_int(data.get('fileSize'))
+    total_chunks = get_positive_int(data.get('totalChunks'))
+    if file_size is None or total_chunks is None:
+        return jsonify({'error': 'fileSize and totalChunks must be positive integers'}), 400
+    if total_chunks > file_size:
+        return jsonify({'error': 'totalChunks can\'t be larger than fileSize'}), 400
+    chunk_size = data.get('chunkSize')
+    if chunk_size is not None:
+        chunk_size = get_positive_int(chunk_size)
+        if chunk_size is None or not chunk_size * (total_chunks - 1) < file_size <= chunk_size * total_chunks:
+            return jsonify({'error': 'chunkSize doesn\'t match fileSize and totalChunks'}), 400
+    
+    # Refuse uploads that can't fit in the user's quota before any of it is sent
+    fits, used, quota = check_quota(current_user, file_size)
+    if not fits:
+        return jsonify({
+            'error': 'Storage quota exceeded',
+            'usedBytes': used,
+            'quotaBytes': quota,
+            'fileSize': file_size
+        }), 413
+    
+    # Generate a unique upload ID
+    upload_id = str(uuid.uuid4())
+    
+    # Create a folder for this upload's chunks
+    upload_folder = os.path.join(TEMP_UPLOAD_FOLDER, upload_id)
+    os.makedirs(upload_folder, exist_ok=True)
+    
     # Store upload information
-    active_uploads[upload_id] = {
+    chunk_mode = current_app.config.get('UPLOAD_CHUNK_MODE', 'offset')
+    get_upload_store().create({
+        'uploadId': upload_id,
+        'userId': current_user.user_id,
         'fileName': secure_filename(data.get('fileName')),
-        'fileSize': data.get('fileSize'),
+        'fileSize': file_size,
         'fileType': data.get('fileType'),
         'uploadType': upload_type, 
         'fileId': data.get('fileId'),
-        'totalChunks': data.get('totalChunks'),
-        'receivedChunks': 0,
+        'totalChunks': total_chunks,
+        'chunkSize': chunk_size,
         'chunkFolder': upload_folder,
-        'isComplete': False
-    }
+        'chunkMode': chunk_mode
+    })
+    
+    # In offset mode the final file is preallocated now and every chunk lands in place
+    if chunk_mode == 'offset':
+        preallocate(os.path.join(upload_folder, 'data.part'), file_size)
     
     return jsonify({
         'uploadId': upload_id,
-        'status': 'initialized'
+        'status': 'initialized',
+        'chunkMode': chunk_mode,
+        'chunkEncodings': available_chunk_encodings(),
+        # How the blockDigest checked on completion is computed (see app/digests.py)
+        'digestAlgorithm': DIGEST_ALGORITHM,
+        'digestBlockSize': DIGEST_BLOCK_SIZE
+    })
+
+def get_positive_int(value):
+    """Return value as an int if it is a whole number above zero, None otherwise"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    return None
+
+def get_chunk_offset(upload_info, chunk_index, chunk_length):
+    """Work out where a chunk starts in the final file"""
+    # Every chunk but the last one is full sized, and the last one ends
+    # exactly at the end of the file
+    if chunk_index == int(upload_info['totalChunks']) - 1:
+        return int(upload_info['fileSize']) - chunk_length
+    return chunk_index * int(upload_info.get('chunkSize') or chunk_length)
+
+def get_expected_chunk_length(upload_info, chunk_index):
+    """Return the length chunk_index must have, or None if it can't be known yet"""
+    chunk_size = upload_info.get('chunkSize')
+    if not chunk_size:
+        return None
+    chunk_size = int(chunk_size)
+    if chunk_index == int(upload_info['totalChunks']) - 1:
+        return int(upload_info['fileSize']) - chunk_index * chunk_size
+    return chunk_size
+
+def get_chunk_stream():
+    """Return (stream, length) for the chunk in the current request.
+
+    Chunks can be sent as a multipart 'chunk' file (what the web client does)
+    or as the raw request body, which avoids Werkzeug spooling the data first.
+    """
+    if request.mimetype == 'multipart/form-data':
+        chunk = request.files.get('chunk')
+        if chunk is None:
+            return None, 0
+        stream = chunk.stream
+        stream.seek(0, os.SEEK_END)
+        length = stream.tell()
+        stream.seek(0)
+        return stream, length
+    
+    return request.stream, request.content_length
+
+def get_chunk_encoding():
+    """How the chunk in the current request is compressed ('identity' when it isn't)"""
+    if request.mimetype == 'multipart/form-data':
+        # Content-Encoding would apply to the whole multipart body, so it's a field here
+        encoding = request.values.get('chunkEncoding')
+    else:
+        encoding = request.headers.get('Content-Encoding')
+    return (encoding or 'identity').strip().lower()
+
+@api_bp.route('/chunk-upload/chunk', methods=['POST'])
+@token_required
+@admission_controlled
+def upload_chunk(current_user):
+    """Receive a single chunk of a chunked upload.
+
+    Chunks can arrive in any order and over many connections at once. Every
+    chunk is written to its own region (offset mode) or its own file (concat
+    mode), and only recorded in the session bitmap once it is fully on disk,
+    so sending the same chunk again is harmless.
+    """
+    upload_id = request.values.get('uploadId')
+    store = get_upload_store()
+    
+    # Check if the upload exists. Expired and evicted uploads (see app/upload_janitor.py)
+    # are gone for good, the client has to start over.
+    upload_info = store.get(upload_id)
+    if upload_info is None:
+        return jsonify({'error': 'Upload not found or expired'}), 410
+    if upload_info['userId'] != current_user.user_id:
+        return jsonify({'error': 'Upload not found or expired'}), 404
+    if upload_info['isComplete']:
+        return jsonify({'error': 'Upload is already complete'}), 409
+    if not os.path.isdir(upload_info['chunkFolder']):
+        return jsonify({'error': 'Upload not found or expired'}), 410
+    
+    try:
+        chunk_index = int(request.values.get('chunkIndex'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid chunk index'}), 400
+    total_chunks = int(upload_info['totalChunks'])
+    if not 0 <= chunk_index < total_chunks:
+        return jsonify({'error': f'Chunk index must be between 0 and {total_chunks - 1}'}), 400
+    
+    # A retry of a chunk we already have doesn't need to be written again
+    if has_bit(upload_info['chunkBitmap'], chunk_index):
+        return jsonify({
+            'status': 'chunk_duplicate',
+            'chunkIndex': chunk_index,
+            'receivedChunks': upload_info['receivedChunks'],
+            'totalChunks': upload_info['totalChunks'],
+            'missingRanges': missing_ranges(upload_info['chunkBitmap'], total_chunks)
+        })
+    
+    # Get the chunk data
+    stream, chunk_length = get_chunk_stream()
+    if stream is None:
+        return jsonify({'error': 'No chunk in request'}), 400
+    if chunk_length is None:
+        return jsonify({'error': 'Content-Length is required'}), 411
+    
+    # Compressed chunks are decoded while they are written. From here on
+    # chunk_length, offsets, checksums and digests all refer to the decoded bytes.
+    encoding = get_chunk_encoding()
+    if encoding != 'identity':
+        decoded_length = request.headers.get('X-Chunk-Length') or request.values.get('chunkLength')
+        if decoded_length is None:
+            decoded_length = get_expected_chunk_length(upload_info, chunk_index)
+        if decoded_length is None:
+            return jsonify({'error': 'X-Chunk-Length (the decoded size) is required for encoded chunks'}), 411
+        try:
+            chunk_length = int(decoded_length)
+            stream = DecodingReader(stream, encoding, chunk_length)
+        except ValueError:
+            return jsonify({'error': 'Invalid chunk length'}), 400
+        except UnsupportedEncoding as e:
+            return jsonify({'error': str(e), 'chunkEncodings': available_chunk_encodings()}), 415
+    
+    # Every chunk but the last one has to be the same size, otherwise the offsets don't line up
+    expected_length = get_expected_chunk_length(upload_info, chunk_index)
+    if expected_length is not None and chunk_length != expected_length:
+        return jsonify({
+            'error': 'Unexpected chunk size',
+            'chunkIndex': chunk_index,
+            'expectedSize': expected_length,
+            'receivedSize': chunk_length
+        }), 400
+    if expected_length is None and chunk_index < total_chunks - 1:
+        upload_info = store.update(upload_id, chunkSize=chunk_length)
+    
+    # Hash the chunk while it is written: a plain SHA-256 to check against the
+    # checksum the client sent (if any), and the block digests that are combined
+    # into the file digest on completion (see app/digests.py)
+    offset = get_chunk_offset(upload_info, chunk_index, chunk_length)
+    if offset < 0 or offset + chunk_length > int(upload_info['fileSize']):
+        return jsonify({
+            'error': 'Chunk doesn\'t fit in the file',
+            'chunkIndex': chunk_index,
+            'receivedSize': chunk_length
+        }), 400
+    expected_checksum = (request.headers.get('X-Chunk-Checksum') or request.values.get('chunkChecksum') or '').lower()
+    chunk_hasher = hashlib.sha256() if expected_checksum else None
+    block_hasher = BlockHasher() if is_block_aligned(offset, chunk_length, chunk_index == total_chunks - 1) else None
+    
+    def on_block(block):
+        if chunk_hasher:
+            chunk_hasher.update(block)
+        if block_hasher:
+            block_hasher.update(block)
+    
+    error = None
+    temp_path = None
+    try:
+        if upload_info['chunkMode'] == 'offset':
+            # Write the chunk straight into the final file at its byte offset
+            part_path = os.path.join(upload_info['chunkFolder'], 'data.part')
+            written = write_stream_at(part_path, stream, offset, on_block=on_block)
+        else:
+            # Keep the chunk as its own file, they are concatenated on completion.
+            # Parallel retries of the same chunk each write their own temp file and
+            # the rename makes sure completion never sees a half written chunk.
+            chunk_path = os.path.join(upload_info['chunkFolder'], f'chunk_{chunk_index}')
+            temp_path = f'{chunk_path}.{uuid.uuid4().hex}.tmp'
+            written = write_stream(temp_path, stream, on_block=on_block)
+    except FileNotFoundError:
+        # The janitor removed the chunk folder while we were writing
+        return jsonify({'error': 'Upload not found or expired'}), 410
+    except Exception as e:
+        # Corrupt compressed data, the region written so far is never marked as received
+        if encoding == 'identity':
+            raise
+        print(f"Error decoding chunk {chunk_index} of {upload_id}: {str(e)}")
+        written = None
+        error = f'Chunk could not be decoded as {encoding}'
+    
+    if not error and getattr(stream, 'overflow', False):
+        error = 'Chunk is longer than its declared size'
+    if not error and written != chunk_length:
+        error = 'Chunk was truncated'
+    if not error and chunk_hasher and chunk_hasher.hexdigest() != expected_checksum:
+        error = 'Chunk checksum mismatch'
+    
+    if temp_path:
+        if error:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        else:
+            try:
+                os.replace(temp_path, chunk_path)
+            except FileNotFoundError:
+                return jsonify({'error': 'Upload not found or expired'}), 410
+    
+    # A bad chunk is simply not marked as received, the client sends it again
+    if error:
+        return jsonify({'error': error, 'chunkIndex': chunk_index}), 400
+    
+    # Mark the chunk in the session bitmap (updates the received counters)
+    try:
+        is_new, upload_info = store.mark_chunk(
+            upload_id, chunk_index, written,
+            block_digests=block_hasher.block_digests() if block_hasher else None
+        )
+    except UploadSessionError as e:
+        if store.get(upload_id) is None:
+            return jsonify({'error': 'Upload not found or expired'}), 410
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'status': 'chunk_received' if is_new else 'chunk_duplicate',
+        'chunkIndex': chunk_index,
+        'receivedChunks': upload_info['receivedChunks'],
+        'totalChunks': upload_info['totalChunks'],
+        'missingRanges': missing_ranges(upload_info['chunkBitmap'], total_chunks)
     })
 
+def get_confirmed_offset(upload_info):
+    """Number of bytes at the start of the file that were received without gaps"""
+    total_chunks = int(upload_info['totalChunks'] or 0)
+    index = first_missing(upload_info['chunkBitmap'], total_chunks)
+    if index >= total_chunks:
+        return int(upload_info['fileSize'] or 0)
+    
+    # Chunk 0 (a full sized chunk) is in, so the chunk size is known by now
+    return index * int(upload_info.get('chunkSize') or 0)
+
+@api_bp.route('/chunk-upload/<string:upload_id>', methods=['GET', 'HEAD'])
+@token_required
+def get_chunked_upload_status(current_user, upload_id):
+    """Report how far a chunked upload got so an interrupted client can resume it.
+
+    HEAD only returns the Upload-Offset / Upload-Length / Upload-Expires headers,
+    GET also returns the missing chunks. The client re-sends the missing chunks
+    to /chunk-upload/chunk and then calls /chunk-upload/complete as usual.
+    """
+    upload_info = get_upload_store().get(upload_id)
+    if upload_info is None or upload_info['userId'] != current_user.user_id:
+        return jsonify({'error': 'Upload not found or expired'}), 404
+    
+    confirmed_offset = get_confirmed_offset(upload_info)
+    response = jsonify({
+        'uploadId': upload_id,
+        'status': 'complete' if upload_info['isComplete'] else 'in_progress',
+        'fileName': upload_info['fileName'],
+        'fileSize': upload_info['fileSize'],
+        'fileId': upload_info['fileId'],
+        'uploadType': upload_info['uploadType'],
+        'chunkSize': upload_info['chunkSize'],
+        'totalChunks': upload_info['totalChunks'],
+        'receivedChunks': upload_info['receivedChunks'],
+        'receivedBytes': upload_info['receivedBytes'],
+        'confirmedOffset': confirmed_offset,
+        'missingRanges': missing_ranges(upload_info['chunkBitmap'], upload_info['totalChunks']),
+        'expiresAt': to_iso_timestamp(upload_info['expiresAt'])
+    })
+    response.headers['Upload-Offset'] = str(confirmed_offset)
+    response.headers['Upload-Length'] = str(upload_info['fileSize'] or 0)
+    if upload_info['expiresAt']:
+        response.headers['Upload-Expires'] = http_date(upload_info['expiresAt'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @api_bp.route('/chunk-upload/complete', methods=['POST'])
 @token_required
+@admission_controlled
 def complete_chunked_upload(current_user):
     """Complete a chunked upload by combining all chunks"""
     data = request.json
     upload_id = data.get('uploadId')
+    store = get_upload_store()
     
     # Check if the upload exists
-    if upload_id not in active_uploads:
+    upload_info = store.get(upload_id)
+    if upload_info is None:
         return jsonify({'error': 'Invalid upload ID'}), 400
+    if upload_info['userId'] != current_user.user_id:
+        return jsonify({'error': 'Upload not found or expired'}), 404
     
-    upload_info = active_uploads[upload_id]
+    # A retry of a complete call that went through gets the same file back
+    if upload_info['isComplete']:
+        relative_path = os.path.relpath(upload_info['finalPath'], FINAL_UPLOAD_FOLDER)
+        stored_file = db.session.get(StoredFile, relative_path)
+        return jsonify({
+            'status': 'complete',
+            'filePath': relative_path,
+            'fileType': upload_info['uploadType'],
+            'fileId': upload_info['fileId'],
+            'blockDigest': stored_file.content_digest if stored_file else None
+        })
     
     # Check if all chunks were received
     if upload_info['receivedChunks'] != upload_info['totalChunks']:
         return jsonify({
             'error': 'Not all chunks received',
             'receivedChunks': upload_info['receivedChunks'],
-            'totalChunks': upload_info['totalChunks']
+            'totalChunks': upload_info['totalChunks'],
+            'missingRanges': missing_ranges(upload_info['chunkBitmap'], upload_info['totalChunks'])
         }), 400
     
-    # Create final destination folder based on upload type
-    type_folder = os.path.join(FINAL_UPLOAD_FOLDER, upload_info['uploadType'])
-    os.makedirs(type_folder, exist_ok=True)
-    
-    # Generate unique filename
-    base_filename = upload_info['fileName']
-    filename = f"{uuid.uuid4()}_{base_filename}"
-    file_path = os.path.join(type_folder, filename)
-    
-    # Combine all chunks into final file
-    with open(file_path, 'wb') as final_file:
-        for i in range(upload_info['totalChunks']):
-            chunk_path = os.path.join(upload_info['chunkFolder'], f'chunk_{i}')
-            with open(chunk_path, 'rb') as chunk_file:
-                final_file.write(chunk_file.read())
-    
-    # Update upload status
-    upload_info['isComplete'] = True
-    upload_info['finalPath'] = file_path
+    # Check the quota again, other uploads may have been finalized since init.
+    # The session is kept, the upload can complete once space was freed.
+    fits, used, quota = check_quota(current_user, int(upload_info['fileSize'] or 0), upload_ids=[upload_id])
+    if not fits:
+        return jsonify({
+            'error': 'Storage quota exceeded',
+            'usedBytes': used,
+            'quotaBytes': quota,
+            'fileSize': upload_info['fileSize']
+        }), 413
+    
+    # Put the chunks back together inside the chunk folder
+    assembled_path = os.path.join(upload_info['chunkFolder'], 'data.part')
+    if upload_info['chunkMode'] == 'offset' and not os.path.exists(assembled_path):
+        # Another complete call for this upload took data.part and hasn't finished yet
+        return jsonify({'error': 'Upload is being completed'}), 409
+    if upload_info['chunkMode'] != 'offset':
+        # Combine all chunks into one file (copied inside the kernel, not through Python).
+        # In offset mode the chunks were written straight into data.part already.
+        chunk_paths = [
+            os.path.join(upload_info['chunkFolder'], f'chunk_{i}')
+            for i in range(upload_info['totalChunks'])
+        ]
+        concat_files(assembled_path, chunk_paths)
+    
+    # Combine the block digests of every chunk into the file digest. Chunks that
+    # weren't aligned to the digest blocks couldn't be hashed on arrival, so
+    # those uploads have to be read back once.
+    chunk_digests = store.chunk_digests(upload_id)
+    if len(chunk_digests) == upload_info['totalChunks']:
+        content_digest = combine_block_digests(b''.join(chunk_digests[i] for i in range(upload_info['totalChunks'])))
+    else:
+        content_digest = file_digest(assembled_path)
     
-    # Extract metadata if this is an image file
-    metadata = {}
-    if upload_info['uploadType'] in ['main-image', 'lightFrames', 'darkFrames', 'flatFrames', 'biasFrames', 'darkFlats']:
-        try:
-            # You could use a library like Pillow or exifread to extract EXIF data here
-            # This is a placeholder for where you'd extract image metadata
-            metadata = extract_image_metadata(file_path)
-        except Exception as e:
-            print(f"Error extracting metadata: {str(e)}")
+    # Let the client check the whole file if it knows the digest. The session and
+    # chunks are kept, completing can be retried (or the upload abandoned to expire).
+    expected_digest = data.get('blockDigest')
+    if expected_digest and expected_digest.lower() != content_digest:
+        return jsonify({
+            'error': 'File digest mismatch',
+            'expectedDigest': expected_digest,
+            'blockDigest': content_digest,
+            'digestAlgorithm': DIGEST_ALGORITHM,
+            'digestBlockSize': DIGEST_BLOCK_SIZE
+        }), 400
     
-    # Clean up chunks
-    try:
-        for i in range(upload_info['totalChunks']):
-            chunk_path = os.path.join(upload_info['chunkFolder'], f'chunk_{i}')
-            if os.path.exists(chunk_path):
-                os.remove(chunk_path)
+    file_size = os.path.getsize(assembled_path)
+    is_duplicate = False
+    storage = get_storage()
+    # On local storage completing is just a rename. Remote backends get a copy and
+    # the local one stays in the chunk folder, the background job reads the header
+    # from there instead of fetching the object again.
+    keep_source = not storage.local
+    # The file is only put in place right before the rows are committed (see app/upload_journal.py)
+    journal = open_upload_journal()
+    try:
+        if current_app.config.get('UPLOAD_DEDUP', True):
+            # Content we already have isn't stored twice, the upload just points at the existing blob
+            relative_path, is_duplicate = store_blob(
+                storage, assembled_path, content_digest, file_size,
+                extension=os.path.splitext(upload_info['fileName'])[1], keep_source=keep_source,
+                journal=journal
+            )
+        else:
+            # Generate unique filename in a shard of the upload type's folder (see app/upload_layout.py)
+            filename = f"{uuid.uuid4()}_{upload_info['fileName']}"
+            relative_path = sharded_path(upload_info['uploadType'], filename)
+            journal.stage(assembled_path, relative_path, keep_source=keep_source)
+        file_path = os.path.join(FINAL_UPLOAD_FOLDER, relative_path)
         
-        # Remove the chunk folder
-        if os.path.exists(upload_info['chunkFolder']):
-            os.rmdir(upload_info['chunkFolder'])
+        # Remember the digest so the Image/RawFrame rows created later can store it
+        db.session.merge(StoredFile(
+            file_path=relative_path,
+            content_digest=content_digest,
+            file_size=file_size
+        ))
+        
+        # Metadata extraction and chunk clean-up run in the background
+        job = enqueue('process_upload', {
+            'filePath': relative_path,
+            'uploadType': upload_info['uploadType'],
+            'chunkFolder': upload_info['chunkFolder'],
+            'localCopy': os.path.basename(assembled_path) if keep_source else None
+        }, user_id=current_user.user_id)
+        journal.publish(storage)
+        db.session.commit()
     except Exception as e:
-        print(f"Error during cleanup: {str(e)}")
+        # data.part goes back into the chunk folder, so completing can be retried
+        db.session.rollback()
+        journal.rollback(storage)
+        print(f"Error completing upload {upload_id}: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    journal.commit()
     
-    # Return file path relative to FINAL_UPLOAD_FOLDER
-    relative_path = os.path.join(upload_info['uploadType'], filename)
+    # Update upload status
+    store.update(upload_id, isComplete=True, finalPath=file_path)
     
     return jsonify({
         'status': 'complete',
         'filePath': relative_path,
         'fileType': upload_info['uploadType'],
         'fileId': upload_info['fileId'],
-        'metadata': metadata
+        'blockDigest': content_digest,
+        'duplicate': is_duplicate,
+        'jobId': job.job_id
     })
 
-def extract_image_metadata(file_path):
-    """Extract metadata from an image file (placeholder function)"""
-    # This would be implemented with a library like Pillow or exifread
-    # For now, return an empty dict
-    return {
-        # Example metadata that could be extracted
-        # 'exposure_time': '1/250',
-        # 'iso': 100,
-        # 'aperture': 5.6,
-        # 'focal_length': 50,
-        # 'capture_date_time': '2023-01-01T12:00:00'
-    }
+@job_handler('process_upload')
+def process_completed_upload(payload):
+    """Background part of completing a chunked upload: header parsing and chunk clean-up.
+
+    The header goes into the metadata cache (see app/metadata_cache.py) under
+    the file's digest, so registering the file with /finalize-upload later
+    finds it there instead of reading the file again.
+    """
+    metadata = {}
+    if payload['uploadType'] in ['main-image', 'lightFrames', 'darkFrames', 'flatFrames', 'biasFrames', 'darkFlats']:
+        if current_app.config.get('FRAME_METADATA_CACHE', True):
+            file_path = payload['filePath']
+            digest = get_content_digests([file_path]).get(file_path)
+            local_copy = payload.get('localCopy')
+            if local_copy and digest and os.path.exists(os.path.join(payload['chunkFolder'], local_copy)):
+                # Remote backends: the copy left in the chunk folder has the same content
+                # (and so the same cache entry) as the stored object
+                metadata = read_frames_metadata(LocalStorage(payload['chunkFolder']), [local_copy], {local_copy: digest})[local_copy]
+            else:
+                metadata = read_frames_metadata(get_storage(), [file_path], {file_path: digest} if digest else {})[file_path]
+    
+    # Clean up chunks
+    if os.path.exists(payload['chunkFolder']):
+        shutil.rmtree(payload['chunkFolder'])
+    
+    return {'metadata': metadata_to_json(metadata)}
 
 
 """ @api_bp.route('/chunk-upload/init', methods=['POST'])
@@ -322,6 +723,19 @@ def complete_chunked_upload(current_user):
         'fileId': upload_info['fileId']
     }) """
 
+def get_content_digests(file_paths, batch_size=500):
+    """Look up the digests computed when the given files were uploaded"""
+    file_paths = list({path for path in file_paths if path})
+    digests = {}
+    # In batches, databases limit the number of bound parameters per statement
+    for start in range(0, len(file_paths), batch_size):
+        rows = db.session.execute(
+            select(StoredFile.file_path, StoredFile.content_digest)
+            .where(StoredFile.file_path.in_(file_paths[start:start + batch_size]))
+        ).all()
+        digests.update({row.file_path: row.content_digest for row in rows})
+    return digests
+
 def create_image_record(user_id, image_details, file_path):
     """Create a new Image record"""
     new_image = Image(
@@ -334,7 +748,9 @@ def create_image_record(user_id, image_details, file_path):
         iso=image_details.get('iso'),
         aperture=image_details.get('aperture'),
         focal_length=image_details.get('focal_length'),
-        focus_score=image_details.get('focus_score')
+        focus_score=image_details.get('focus_score'),
+        content_digest=get_content_digests([file_path]).get(file_path),
+        file_size=stored_file_sizes(get_storage(), [file_path]).get(file_path)
     )
     return new_image
 
@@ -360,13 +776,139 @@ def create_image_gear_relations(image_id, selected_gear):
         )
         db.session.add(image_gear)
 
+def is_content_digest(value):
+    """Whether value looks like a content digest (64 hex characters)"""
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdefABCDEF' for c in value)
+
+@api_bp.route('/negotiate-upload', methods=['POST'])
+@token_required
+def negotiate_upload(current_user):
+    """Tell the client which of its files are already stored, so only the rest need uploading.
+    
+    The client sends the content digest (see app/digests.py) and size of every
+    file in the session. Only files the user already has in the archive count
+    as stored (see find_stored_files), other users' files are never revealed.
+    Files reported as stored can be passed to
+    /finalize-upload as storedFiles[<fileId>]=<digest> instead of being uploaded.
+    """
+    data = request.get_json(silent=True) or {}
+    files = data.get('files')
+    if not isinstance(files, list):
+        return jsonify({'error': 'files must be a list'}), 400
+    
+    for file_info in files:
+        if not isinstance(file_info, dict) or not is_content_digest(file_info.get('digest')):
+            return jsonify({'error': 'Every file needs a 64 character hex digest'}), 400
+    
+    stored = find_stored_files(get_storage(), [f['digest'].lower() for f in files], current_user.user_id)
+    
+    results = []
+    stored_bytes = 0
+    for file_info in files:
+        digest = file_info['digest'].lower()
+        stored_file = stored.get(digest)
+        # A size that doesn't match means the client hashed something else
+        is_stored = stored_file is not None and (
+            file_info.get('size') is None or stored_file.file_size is None or stored_file.file_size == file_info.get('size')
+        )
+        if is_stored:
+            stored_bytes += stored_file.file_size or 0
+        results.append({
+            'fileId': file_info.get('fileId'),
+            'digest': digest,
+            'size': file_info.get('size'),
+            'stored': is_stored
+        })
+    
+    return jsonify({
+        'files': results,
+        'storedCount': sum(1 for r in results if r['stored']),
+        'missingCount': sum(1 for r in results if not r['stored']),
+        'storedBytes': stored_bytes
+    })
+
+def find_linkable_files(user_id, file_paths):
+    """Split the chunkedFiles paths sent to /finalize-upload into the ones user_id may link.
+
+    Blob paths follow from the digest, so naming one proves nothing. A path is
+    accepted when one of the user's own completed chunked uploads produced it,
+    or when its content is already referenced by the user's images or frames
+    (like storedFiles, see find_stored_files). Returns ({path: uploadId or None}, rejected paths).
+    """
+    final_paths = {os.path.join(FINAL_UPLOAD_FOLDER, os.path.normpath(path)): path for path in file_paths}
+    completed = get_upload_store().completed_uploads(user_id, final_paths)
+    linkable = {final_paths[final_path]: upload_id for final_path, upload_id in completed.items()}
+    
+    others = [path for path in file_paths if path not in linkable]
+    if others:
+        digests = {
+            stored.file_path: stored.content_digest
+            for stored in StoredFile.query.filter(StoredFile.file_path.in_(others)).all()
+            if stored.content_digest
+        }
+        owned = owned_digests(user_id, set(digests.values())) if digests else set()
+        for path in others:
+            if digests.get(path) in owned:
+                linkable[path] = None
+    
+    rejected = sorted(set(file_paths) - set(linkable))
+    return linkable, rejected
+
+def get_finalize_folder(field_name):
+    """Folder a file sent to /finalize-upload as field_name is written to (None to ignore it)"""
+    if field_name == 'images.mainImage':
+        return os.path.join(FINAL_UPLOAD_FOLDER, 'main-image')
+    for frame_type in ('lightFrames', 'darkFrames', 'flatFrames', 'biasFrames', 'darkFlats'):
+        if field_name.startswith(f'images.{frame_type}'):
+            return os.path.join(FINAL_UPLOAD_FOLDER, frame_type)
+    return None
+
 @api_bp.route('/finalize-upload', methods=['POST'])
 @token_required
+@admission_controlled
 def finalize_upload(current_user):
     """Handle the final form submission with metadata and small files"""
+    # Every file the request writes is journaled, and taken back unless the request
+    # commits (see app/upload_journal.py)
+    storage = get_storage()
+    journal = open_upload_journal()
+    
+    @after_this_request
+    def close_journal(response):
+        if not journal.closed:
+            db.session.rollback()
+            journal.rollback(storage)
+        return response
+    
     # Extract form data
-    form_data = request.form
-    files = request.files
+    if current_app.config.get('FINALIZE_STREAMING', True) and request.mimetype == 'multipart/form-data':
+        # Files are written to their upload folder while the body is read
+        max_size = current_app.config.get('FINALIZE_MAX_REQUEST_SIZE')
+        if max_size and (request.content_length or 0) > max_size:
+            return jsonify({'error': f'Request is larger than {max_size} bytes'}), 413
+        try:
+            form_data, files = stream_multipart(
+                request.stream, request.content_type, get_finalize_folder,
+                max_size=max_size,
+                max_form_memory=current_app.config.get('FINALIZE_MAX_FORM_MEMORY'),
+                max_parts=current_app.config.get('FINALIZE_MAX_PARTS'),
+                on_file=journal.track
+            )
+        except RequestEntityTooLarge:
+            return jsonify({'error': f'Request is larger than {max_size} bytes or has too many parts'}), 413
+        except ValueError as e:
+            return jsonify({'error': f'Invalid multipart body: {str(e)}'}), 400
+        
+        # Whatever the request didn't end up using is removed once it's done
+        @after_this_request
+        def discard_unused_files(response):
+            for _, part in files.items(multi=True):
+                if part.relative_path is None and os.path.exists(part.path):
+                    os.remove(part.path)
+            return response
+    else:
+        form_data = request.form
+        files = request.files
     
     # For debugging
     print("Form data keys:", list(form_data.keys()))
@@ -403,6 +945,20 @@ def finalize_upload(current_user):
         except json.JSONDecodeError:
             return jsonify({'error': 'Invalid session details format'}), 400
     
+    # Resolve the digests of files the client didn't upload, before anything is written
+    stored_refs = {}
+    for key in form_data:
+        if key.startswith('storedFiles[') and key.endswith(']'):
+            stored_refs[key[len('storedFiles['):-1]] = form_data[key].lower()
+    
+    stored_file_paths = {}
+    if stored_refs:
+        stored = find_stored_files(storage, stored_refs.values(), current_user.user_id)
+        unknown = sorted(set(stored_refs.values()) - set(stored))
+        if unknown:
+            return jsonify({'error': 'Unknown file digests', 'unknownDigests': unknown}), 400
+        stored_file_paths = {file_id: stored[digest].file_path for file_id, digest in stored_refs.items()}
+    
     # Process uploaded files
     main_image_path = None
     image_files = {
@@ -416,21 +972,27 @@ def finalize_upload(current_user):
     # 1. Process main image
     if 'images.mainImage' in files:
         main_image = files['images.mainImage']
-        main_image_path = handle_small_file(main_image, 'main-image')
+        main_image_path = handle_small_file(main_image, 'main-image', journal=journal)
         print(f"Processed main image: {main_image_path}")
     
-    # 2. Process frame files - first check for direct file uploads
-    for frame_type in image_files.keys():
-        file_key = f'images.{frame_type}'
-        
-        # Handle multiple files
-        for key in files.keys():
-            if key.startswith(file_key):
-                frame_file = files[key]
-                frame_path = handle_small_file(frame_file, frame_type)
-                if frame_path:
-                    print(f"Direct upload for {frame_type}: {frame_path}")
-                    image_files[frame_type].append(frame_path)
+    # Paths already in image_files per frame type, so duplicates are found without scanning the lists
+    seen_paths = {frame_type: set() for frame_type in image_files}
+    # (frame_type, filename) -> path of the first uploaded file with that name, for images.fileData
+    uploaded_by_name = {}
+    frame_type_prefixes = [(f'images.{frame_type}', frame_type) for frame_type in image_files]
+    
+    # 2. Process frame files - first check for direct file uploads (a single pass over the fields)
+    for key in files.keys():
+        frame_type = next((t for prefix, t in frame_type_prefixes if key.startswith(prefix)), None)
+        if frame_type is None:
+            continue
+        frame_file = files[key]
+        frame_path = handle_small_file(frame_file, frame_type, journal=journal)
+        if frame_path:
+            print(f"Direct upload for {frame_type}: {frame_path}")
+            image_files[frame_type].append(frame_path)
+            seen_paths[frame_type].add(frame_path)
+            uploaded_by_name.setdefault((frame_type, frame_file.filename), frame_path)
     
     # 3. Process file data from hidden JSON field (new approach)
     if 'images.fileData' in form_data:
@@ -442,21 +1004,18 @@ def finalize_upload(current_user):
             
             # Look for file uploads that match the file data
             for frame_type, frames_data in file_data.items():
-                if not isinstance(frames_data, list):
+                if not isinstance(frames_data, list) or frame_type not in image_files:
                     continue
                     
                 for idx, frame_info in enumerate(frames_data):
                     frame_name = frame_info.get('name')
                     
-                    # Look for file uploads that match this name
-                    for key in files.keys():
-                        if key.startswith(f'images.{frame_type}') and files[key].filename == frame_name:
-                            frame_file = files[key]
-                            frame_path = handle_small_file(frame_file, frame_type)
-                            if frame_path and frame_path not in image_files[frame_type]:
-                                print(f"Added {frame_type} from fileData: {frame_path}")
-                                image_files[frame_type].append(frame_path)
-                                break
+                    # Look for the file upload that matches this name
+                    frame_path = uploaded_by_name.get((frame_type, frame_name))
+                    if frame_path and frame_path not in seen_paths[frame_type]:
+                        print(f"Added {frame_type} from fileData: {frame_path}")
+                        image_files[frame_type].append(frame_path)
+                        seen_paths[frame_type].add(frame_path)
                     
                     # Also check for hidden field references
                     hidden_field_key = f'images.{frame_type}[{idx}]'
@@ -464,9 +1023,10 @@ def finalize_upload(current_user):
                         frame_value = form_data[hidden_field_key]
                         # If this is a reference to a previously uploaded file, add it
                         if os.path.exists(frame_value) or frame_value.startswith(('http://', 'https://')):
-                            if frame_value not in image_files[frame_type]:
+                            if frame_value not in seen_paths[frame_type]:
                                 print(f"Added {frame_type} from hidden field: {frame_value}")
                                 image_files[frame_type].append(frame_value)
+                                seen_paths[frame_type].add(frame_value)
         except json.JSONDecodeError as e:
             print(f"Error parsing images.fileData: {str(e)}")
     
@@ -477,6 +1037,15 @@ def finalize_upload(current_user):
             file_id = key[len('chunkedFiles['):-1]
             chunked_files[file_id] = form_data[key]
     
+    # Only the user's own uploads can be linked
+    linkable_files, rejected = find_linkable_files(current_user.user_id, set(chunked_files.values()))
+    if rejected:
+        return jsonify({'error': 'Unknown chunked files', 'unknownFiles': rejected}), 400
+    
+    # Files the client skipped because /negotiate-upload said we have them already
+    # are handled like chunked files that were uploaded earlier
+    chunked_files.update(stored_file_paths)
+    
     # Process chunked files
     for file_id, file_path in chunked_files.items():
         file_type = determine_file_type(file_id)
@@ -493,52 +1062,144 @@ def finalize_upload(current_user):
         if frames:
             print(f"Sample {frame_type}: {frames[0]}")
     
+    # Everything the image and its frames add to the user's usage has to fit. The
+    # chunked uploads were counted while pending, here they are swapped for the rows.
+    upload_ids = [upload_id for upload_id in linkable_files.values() if upload_id]
+    new_paths = [path for path in [main_image_path, *(p for frames in image_files.values() for p in frames)] if path]
+    _, new_sizes = stored_file_info(storage, new_paths)
+    new_bytes = sum(new_sizes.get(path) or 0 for path in new_paths)
+    fits, used, quota = check_quota(current_user, new_bytes, upload_ids=upload_ids)
+    if not fits:
+        return jsonify({
+            'error': 'Storage quota exceeded',
+            'usedBytes': used,
+            'quotaBytes': quota,
+            'fileSize': new_bytes
+        }), 413
+    
     try:
-        # 1. Create the main image record
+        # 1. Create the main image record, so its id can be returned right away
         new_image = create_image_record(current_user.user_id, image_details, main_image_path)
         db.session.add(new_image)
         db.session.flush()  # Flush to get the image_id
         image_id = new_image.image_id
-
-        # 2. Create related records
-
-        # 2.1 Handle celestial objects
-        object_id = image_details.get('object_id')
-        if object_id:
-            image_object = create_image_object_relations(image_id, object_id)
-            db.session.add(image_object) 
-
-        # 2.2 Handle Gear
-        if gear_details.get('selectedGear'):
-            for gear_item in gear_details.get('selectedGear'):
-                gear_id = gear_item.get('gear_id')
-                if gear_id:
-                    image_gear = ImageGear(
-                        image_id=image_id,
-                        gear_id=gear_id
-                    )
-                    db.session.add(image_gear)
-
-        # 2.3 Handle Session 
-        if session_details:
-            create_or_link_session(image_id, current_user.user_id, session_details, location_details)
-
-        # 3. Create frame tracking records
-        create_frame_records(image_id, image_files)
-
+        adjust_blob_refs(added=[main_image_path])
+        usage = UsageChanges()
+        usage.add(current_user.user_id, IMAGE_CATEGORY, new_image.file_size)
+        usage.apply()
+
+        # 2. Related and frame records are created by a background job
+        job = enqueue('finalize_upload', {
+            'image_id': image_id,
+            'user_id': current_user.user_id,
+            'object_id': image_details.get('object_id'),
+            'selected_gear': gear_details.get('selectedGear') or [],
+            'session_details': session_details,
+            'location_details': location_details,
+            'image_files': image_files,
+            'upload_ids': upload_ids
+        }, priority=10, user_id=current_user.user_id)
+
+        # The files go in place first, then the rows pointing at them are committed
+        journal.publish(storage)
         db.session.commit()
+        journal.commit()
         
         return jsonify({
-            'status': 'success',
-            'message': 'Upload completed successfully',
-            'image_id': image_id
-        })
+            'status': 'accepted',
+            'message': 'Upload received, the frames are being registered',
+            'image_id': image_id,
+            'job_id': job.job_id
+        }), 202
         
     except Exception as e:
         db.session.rollback() 
+        journal.rollback(storage)
         print(f"Error in finalize upload: {str(e)}")  # Add better logging
         return jsonify({'error': str(e)}), 500
 
+@job_handler('finalize_upload')
+def finish_finalized_upload(payload):
+    """Create the records of a finalized upload (relations, session and frames)"""
+    image_id = payload['image_id']
+    
+    # A retry after the commit went through only has the sessions left to forget
+    if FrameSet.query.filter_by(image_id=image_id).first() is not None:
+        release_upload_sessions(payload.get('upload_ids') or [])
+        return {'image_id': image_id}
+    
+    # 2. Create related records
+
+    # 2.1 Handle celestial objects
+    object_id = payload.get('object_id')
+    if object_id:
+        image_object = create_image_object_relations(image_id, object_id)
+        db.session.add(image_object) 
+
+    # 2.2 Handle Gear
+    for gear_item in payload.get('selected_gear') or []:
+        gear_id = gear_item.get('gear_id')
+        if gear_id:
+            image_gear = ImageGear(
+                image_id=image_id,
+                gear_id=gear_id
+            )
+            db.session.add(image_gear)
+
+    # 2.3 Handle Session 
+    if payload.get('session_details'):
+        create_or_link_session(image_id, payload['user_id'], payload['session_details'], payload.get('location_details') or {})
+
+    # 2.4 Capture settings the form left out, from the main image's header
+    fill_image_metadata(image_id)
+
+    # 3. Create frame tracking records
+    frameset_id = create_frame_records(image_id, payload.get('image_files') or {}, user_id=payload['user_id'])
+
+    db.session.commit()
+    release_upload_sessions(payload.get('upload_ids') or [])
+    return {'image_id': image_id, 'frameset_id': frameset_id}
+
+def release_upload_sessions(upload_ids):
+    """Forget the sessions of chunked uploads that are registered now.
+
+    Until then their size counts as pending in the quota checks, from now on
+    the rows' storage usage counts it instead.
+    """
+    store = get_upload_store()
+    for upload_id in upload_ids:
+        store.delete(upload_id)
+
+@api_bp.route('/jobs/<string:job_id>', methods=['GET'])
+@token_required
+def get_job_status(current_user, job_id):
+    """Status of a background job started by one of the upload routes"""
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != current_user.user_id:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_to_dict(job))
+
+@api_bp.route('/upload-admission', methods=['GET'])
+@token_required
+def get_upload_admission(current_user):
+    """Queue depths of the upload admission control in this worker (see app/upload_admission.py)"""
+    controller = get_admission_controller()
+    if controller is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(controller.stats(current_user.user_id), enabled=True))
+
+@api_bp.route('/storage-usage', methods=['GET'])
+@token_required
+def get_storage_usage(current_user):
+    """Bytes and files the user has stored, per frame type, and their quota"""
+    by_category = usage_for(current_user.user_id)
+    return jsonify({
+        'totalBytes': sum(item['bytes'] for item in by_category.values()),
+        'fileCount': sum(item['files'] for item in by_category.values()),
+        'quotaBytes': quota_for(current_user),
+        'byCategory': by_category
+    })
+
 def determine_file_type(file_id):
     """
     Determines the type of astronomical frame based on the file_id.
@@ -577,80 +1238,147 @@ def determine_file_type(file_id):
     # No recognized pattern
     return None
 
-def create_frame_records(image_id, image_files):
-    """Create FrameSet, FrameSummary, and RawFrame records"""
+# Form frame type -> RawFrame.frame_type
+FRAME_TYPE_MAPPING = {
+    'lightFrames': 'light',
+    'darkFrames': 'dark',
+    'flatFrames': 'flat',
+    'biasFrames': 'bias',
+    'darkFlats': 'dark_flat'
+}
+
+# RawFrame column -> key of the header metadata (app/frame_metadata.py)
+FRAME_METADATA_COLUMNS = {
+    'exposure_time': 'exposure_time',
+    'iso': 'iso',
+    'temperature': 'temperature',
+    'capture_time': 'capture_time',
+    'gain': 'gain',
+    'filter_name': 'filter',
+    'binning': 'binning',
+    'camera_serial': 'serial_number',
+    'lens': 'lens'
+}
+
+# Image column -> key of the header metadata
+IMAGE_METADATA_COLUMNS = {
+    'capture_date_time': 'capture_time',
+    'exposure_time': 'exposure_time',
+    'iso': 'iso',
+    'aperture': 'aperture',
+    'focal_length': 'focal_length'
+}
+
+def fill_image_metadata(image_id):
+    """Fill the capture settings of an Image the user didn't enter from its file's header"""
+    image = db.session.get(Image, image_id)
+    if image is None or not image.file_path or '://' in image.file_path:
+        return
+    digests = {image.file_path: image.content_digest} if image.content_digest else None
+    metadata = read_frames_metadata(get_storage(), [image.file_path], digests)[image.file_path]
+    for column, key in IMAGE_METADATA_COLUMNS.items():
+        if getattr(image, column) is None and metadata.get(key) is not None:
+            setattr(image, column, metadata[key])
+
+def apply_frame_metadata(row, metadata):
+    """Fill the RawFrame columns of row from a frame's header metadata"""
+    for column, key in FRAME_METADATA_COLUMNS.items():
+        if metadata.get(key) is not None:
+            row[column] = metadata[key]
+
+def create_frame_records(image_id, image_files, user_id=None):
+    """Create FrameSet, FrameSummary, and RawFrame records
+    
+    Sessions can have thousands of sub-exposures, so the rows are written with
+    Core inserts (one executemany for all the frames) instead of an ORM object
+    per frame. They join the current transaction like any other change, and so
+    does the frames' storage usage, charged to user_id (the image's owner).
+    """
+    frameset_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    
     # Create FrameSet
-    new_frameset = FrameSet(
-        image_id=image_id
-    )
-    db.session.add(new_frameset)
-    db.session.flush()
-    frameset_id = new_frameset.frameset_id
+    db.session.execute(insert(FrameSet.__table__), [{
+        'frameset_id': frameset_id,
+        'image_id': image_id,
+        'created_at': now
+    }])
     
     # Track frame counts for summary
-    frame_counts = {
-        'lightFrames': 0,
-        'darkFrames': 0,
-        'flatFrames': 0, 
-        'biasFrames': 0,
-        'darkFlats': 0
-    }
+    frame_counts = dict.fromkeys(FRAME_TYPE_MAPPING, 0)
     
-    # Create RawFrame records for each frame type
+    # Collect one RawFrame row for each frame
+    frame_rows = []
     for frame_type, frame_list in image_files.items():
-        if frame_type in frame_counts:
-            for frame_path in frame_list:
-                # Skip empty paths
-                if not frame_path:
-                    continue
-
-                # Check if frame_path is an object or string
-                if isinstance(frame_path, dict):
-                    # Extract the path from the object
-                    if 'path' in frame_path:
-                        frame_path = frame_path['path']
-                    else:
-                        continue  # Skip if no path found
-                
-                # Create RawFrame record
-                type_mapping = {
-                    'lightFrames': 'light',
-                    'darkFrames': 'dark',
-                    'flatFrames': 'flat',
-                    'biasFrames': 'bias',
-                    'darkFlats': 'dark_flat'
-                }
-                
-                print(f"Creating RawFrame for {frame_type}: {frame_path}")
-                
-                raw_frame = RawFrame(
-                    frameset_id=frameset_id,
-                    frame_type=type_mapping[frame_type],
-                    file_path=frame_path,
-                    # Additional metadata could be extracted in a more sophisticated way
-                    exposure_time=None,  # Default to None for now
-                    iso=None,            # Default to None for now
-                    temperature=None,    # Default to None for now
-                    capture_time=datetime.utcnow()  # Default to now
-                )
-                db.session.add(raw_frame)
-                
-                # Increment count for this frame type
-                frame_counts[frame_type] += 1
+        if frame_type not in frame_counts:
+            continue
+        for frame_path in frame_list:
+            # Frames can be plain paths or objects with a path
+            if isinstance(frame_path, dict):
+                frame_path = frame_path.get('path')
+            # Skip empty paths
+            if not frame_path:
+                continue
+            
+            frame_rows.append({
+                'frame_id': str(uuid.uuid4()),
+                'frameset_id': frameset_id,
+                'frame_type': FRAME_TYPE_MAPPING[frame_type],
+                'file_path': frame_path,
+                # Filled in from the frame's header below
+                'exposure_time': None,
+                'iso': None,
+                'temperature': None,
+                'capture_time': now,
+                'gain': None,
+                'filter_name': None,
+                'binning': None,
+                'camera_serial': None,
+                'lens': None,
+                'content_digest': None,
+                'file_size': None
+            })
+            frame_counts[frame_type] += 1
+    
+    if frame_rows:
+        # Digests and sizes recorded when the frames were uploaded
+        storage = get_storage()
+        frame_paths = [row['file_path'] for row in frame_rows]
+        content_digests, file_sizes = stored_file_info(storage, frame_paths)
+        if user_id is None:
+            user_id = db.session.execute(select(Image.user_id).where(Image.image_id == image_id)).scalar()
+        usage = UsageChanges()
+        # Capture settings from the headers, read in parallel (see app/metadata_pool.py)
+        frame_metadata = read_frames_metadata(
+            storage, [path for path in frame_paths if '://' not in path], content_digests
+        )
+        for row in frame_rows:
+            row['content_digest'] = content_digests.get(row['file_path'])
+            row['file_size'] = file_sizes.get(row['file_path'])
+            usage.add(user_id, row['frame_type'], row['file_size'])
+            apply_frame_metadata(row, frame_metadata.get(row['file_path'], {}))
+        
+        db.session.execute(insert(RawFrame.__table__), frame_rows)
+        
+        # Every frame is one more reference to its blob, and counts towards its owner's usage
+        adjust_blob_refs(added=frame_paths)
+        usage.apply()
     
     # Create FrameSummary
-    frame_summary = FrameSummary(
-        image_id=image_id,
-        light_frame_count=frame_counts['lightFrames'],
-        dark_frame_count=frame_counts['darkFrames'],
-        flat_frame_count=frame_counts['flatFrames'],
-        bias_frame_count=frame_counts['biasFrames'],
-        dark_flat_count=frame_counts['darkFlats']
-    )
-    db.session.add(frame_summary)
+    db.session.execute(insert(FrameSummary.__table__), [{
+        'summary_id': str(uuid.uuid4()),
+        'image_id': image_id,
+        'light_frame_count': frame_counts['lightFrames'],
+        'dark_frame_count': frame_counts['darkFrames'],
+        'flat_frame_count': frame_counts['flatFrames'],
+        'bias_frame_count': frame_counts['biasFrames'],
+        'dark_flat_count': frame_counts['darkFlats']
+    }])
     
     # Log the frame counts
     print(f"FrameSummary counts: Light={frame_counts['lightFrames']}, Dark={frame_counts['darkFrames']}", f"Flat={frame_counts['flatFrames']}, Bias={frame_counts['biasFrames']}, DarkFlat={frame_counts['darkFlats']}")
+    
+    return frameset_id
 
 
 """ def handle_small_file(file, file_type):
@@ -790,23 +1518,66 @@ def create_or_link_session(image_id, user_id, session_details, location_details)
     )
     db.session.add(frame_summary) """
 
-def handle_small_file(file, file_type):
-    """Process and save a small file upload"""
+def store_streamed_file(part, journal=None):
+    """Record a file stream_multipart() already wrote to disk, returns its relative path"""
+    if part.relative_path is None:
+        if current_app.config.get('UPLOAD_DEDUP', True):
+            part.relative_path, _ = store_blob(
+                get_storage(), part.path, part.content_digest, part.file_size,
+                extension=os.path.splitext(part.filename)[1], journal=journal
+            )
+        else:
+            # Into a shard of the folder it was streamed to (see app/upload_layout.py)
+            folder = os.path.relpath(os.path.dirname(part.path), FINAL_UPLOAD_FOLDER)
+            relative_path = sharded_path(folder, os.path.basename(part.path))
+            if journal is not None:
+                journal.stage(part.path, relative_path)
+            else:
+                get_storage().put_file(relative_path, part.path)
+            part.relative_path = relative_path
+        db.session.merge(StoredFile(
+            file_path=part.relative_path,
+            content_digest=part.content_digest,
+            file_size=part.file_size
+        ))
+    return part.relative_path
+
+def handle_small_file(file, file_type, journal=None):
+    """Process and save a small file upload (staged in journal if given, see app/upload_journal.py)"""
+    if isinstance(file, StreamedFile):
+        return store_streamed_file(file, journal=journal)
     if file and file.filename:
-        # Create directory if it doesn't exist
-        type_folder = os.path.join(FINAL_UPLOAD_FOLDER, file_type)
-        os.makedirs(type_folder, exist_ok=True)
-        
-        # Generate unique filename
+        # Generate unique filename in a shard of the type's folder (see app/upload_layout.py)
         filename = secure_filename(file.filename)
         unique_filename = f"{uuid.uuid4()}_{filename}"
-        file_path = os.path.join(type_folder, unique_filename)
+        relative_path = sharded_path(file_type, unique_filename)
         
-        # Save file
-        file.save(file_path)
+        # Save file to the temp folder, hashing it on the way to disk
+        file_path = os.path.join(TEMP_UPLOAD_FOLDER, unique_filename)
+        if journal is not None:
+            journal.track(file_path)
+        hasher = BlockHasher()
+        file_size = write_stream(file_path, file.stream, on_block=hasher.update)
+        content_digest = hasher.hexdigest()
+        
+        # Then hand it to the storage backend
+        if current_app.config.get('UPLOAD_DEDUP', True):
+            relative_path, _ = store_blob(
+                get_storage(), file_path, content_digest, file_size,
+                extension=os.path.splitext(filename)[1], journal=journal
+            )
+        elif journal is not None:
+            journal.stage(file_path, relative_path)
+        else:
+            get_storage().put_file(relative_path, file_path)
+        db.session.merge(StoredFile(
+            file_path=relative_path,
+            content_digest=content_digest,
+            file_size=file_size
+        ))
         
         # Return relative path
-        return os.path.join(file_type, unique_filename)
+        return relative_path
     
     return None
 
@@ -1446,7 +2217,8 @@ def get_image_path(image_id):
   """
   image = Image.query.get(image_id)
   if image:
-   return 'uploads/'+image.file_path
+   # A key of the storage backend (see app/storage.py)
+   return image.file_path
   return None
  
 
@@ -1461,6 +2233,7 @@ def get_image_by_id(image_id):
  
   Returns:
   Response: The image file if found, or a JSON error message with a 404 status code if not found.
+  Range requests are answered with the requested part only.
   """
   image_path = get_image_path(image_id)
  
@@ -1468,17 +2241,17 @@ def get_image_by_id(image_id):
   if image_path:
   # Determine the correct MIME type based on the file extension.
    try:
-    # Ensure the path is absolute
-    full_image_path = os.path.abspath(image_path)
     #Mimetype detection
     mime_type =  'image/jpeg' #default
-    if full_image_path.lower().endswith(('.png', '.PNG')):
+    if image_path.lower().endswith(('.png', '.PNG')):
         mime_type = 'image/png'
-    elif full_image_path.lower().endswith(('.gif', '.GIF')):
+    elif image_path.lower().endswith(('.gif', '.GIF')):
         mime_type = 'image/gif'
-    elif full_image_path.lower().endswith(('.jpg', '.JPG', '.jpeg', '.JPEG')):
+    elif image_path.lower().endswith(('.jpg', '.JPG', '.jpeg', '.JPEG')):
         mime_type = 'image/jpeg'
-    return send_file(full_image_path, mimetype=mime_type)
+    return get_storage().send(image_path, mimetype=mime_type)
+   except FileNotFoundError:
+    return jsonify({'error': 'Image file not found'}), 404
    except Exception as e:
     return jsonify({'error': f'Error sending image: {str(e)}'}), 500
   else:
@@ -1526,8 +2299,13 @@ def create_image():
             focal_length=data.get('focal_length'),
             focus_score=data.get('focus_score')
         )
+        new_image.file_size = stored_file_sizes(get_storage(), [new_image.file_path]).get(new_image.file_path)
 
         db.session.add(new_image)
+        adjust_blob_refs(added=[new_image.file_path])
+        usage = UsageChanges()
+        usage.add(new_image.user_id, IMAGE_CATEGORY, new_image.file_size)
+        usage.apply()
         db.session.commit()
 
         return jsonify({'message': 'Image created successfully', 'image_id': new_image.image_id}), 201
@@ -1543,10 +2321,17 @@ def update_image(image_id):
         if not data:
             return jsonify({'error': 'No data provided'}), 400
 
+        usage = UsageChanges()
+        usage.remove(image.user_id, IMAGE_CATEGORY, image.file_size)
         image.user_id = data.get('user_id', image.user_id)
         image.title = data.get('title', image.title)
         image.description = data.get('description', image.description)
+        if data.get('file_path', image.file_path) != image.file_path:
+            adjust_blob_refs(added=[data['file_path']], removed=[image.file_path])
+            image.file_size = stored_file_sizes(get_storage(), [data['file_path']]).get(data['file_path'])
         image.file_path = data.get('file_path', image.file_path)
+        usage.add(image.user_id, IMAGE_CATEGORY, image.file_size)
+        usage.apply()
         image.capture_date_time = datetime.fromisoformat(data.get('capture_date_time')) if data.get('capture_date_time') else image.capture_date_time
         image.exposure_time = data.get('exposure_time', image.exposure_time)
         image.iso = data.get('iso', image.iso)
@@ -1565,6 +2350,10 @@ def update_image(image_id):
 def delete_image(image_id):
     try:
         image = Image.query.get_or_404(image_id)
+        adjust_blob_refs(removed=[image.file_path])
+        usage = UsageChanges()
+        usage.remove(image.user_id, IMAGE_CATEGORY, image.file_size)
+        usage.apply()
         db.session.delete(image)
         db.session.commit()
         return jsonify({'message': 'Image deleted successfully'}), 200
@@ -1984,6 +2773,18 @@ def update_frame_set(frameset_id):
 def delete_frame_set(frameset_id):
     try:
         frame_set = FrameSet.query.get_or_404(frameset_id)
+        # The set's frames go with it, and so do their references to the blobs
+        frames = db.session.execute(
+            select(RawFrame.file_path, RawFrame.frame_type, RawFrame.file_size)
+            .where(RawFrame.frameset_id == frameset_id)
+        ).all()
+        adjust_blob_refs(removed=[frame.file_path for frame in frames])
+        usage = UsageChanges()
+        owner = frameset_owner(frameset_id)
+        for frame in frames:
+            usage.remove(owner, frame.frame_type, frame.file_size)
+        usage.apply()
+        RawFrame.query.filter_by(frameset_id=frameset_id).delete(synchronize_session=False)
         db.session.delete(frame_set)
         db.session.commit()
         return jsonify({'message': 'FrameSet deleted successfully'}), 200
@@ -2044,8 +2845,13 @@ def create_raw_frame():
             temperature=data.get('temperature'),
             capture_time=datetime.fromisoformat(data.get('capture_time')) if data.get('capture_time') else None
         )
+        new_raw_frame.file_size = stored_file_sizes(get_storage(), [new_raw_frame.file_path]).get(new_raw_frame.file_path)
 
         db.session.add(new_raw_frame)
+        adjust_blob_refs(added=[new_raw_frame.file_path])
+        usage = UsageChanges()
+        usage.add(frameset_owner(new_raw_frame.frameset_id), new_raw_frame.frame_type, new_raw_frame.file_size)
+        usage.apply()
         db.session.commit()
 
         return jsonify({'message': 'RawFrame created successfully', 'frame_id': new_raw_frame.frame_id}), 201
@@ -2053,6 +2859,18 @@ def create_raw_frame():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@api_bp.route('/raw_frames/<string:frame_id>/file', methods=['GET'])
+def download_raw_frame(frame_id):
+    """The frame's file, Range requests get just the requested part"""
+    frame = RawFrame.query.get_or_404(frame_id)
+    if not frame.file_path:
+        return jsonify({'error': 'Frame has no file'}), 404
+    try:
+        mime_type = mimetypes.guess_type(frame.file_path)[0] or 'application/octet-stream'
+        return get_storage().send(frame.file_path, mimetype=mime_type, download_name=os.path.basename(frame.file_path))
+    except FileNotFoundError:
+        return jsonify({'error': 'Frame file not found'}), 404
+
 @api_bp.route('/raw_frames/<string:frame_id>', methods=['PUT'])
 def update_raw_frame(frame_id):
     try:
@@ -2061,9 +2879,16 @@ def update_raw_frame(frame_id):
         if not data:
             return jsonify({'error': 'No data provided'}), 400
 
+        usage = UsageChanges()
+        usage.remove(frameset_owner(frame.frameset_id), frame.frame_type, frame.file_size)
         frame.frameset_id = data.get('frameset_id', frame.frameset_id)
         frame.frame_type = data.get('frame_type', frame.frame_type)
+        if data.get('file_path', frame.file_path) != frame.file_path:
+            adjust_blob_refs(added=[data['file_path']], removed=[frame.file_path])
+            frame.file_size = stored_file_sizes(get_storage(), [data['file_path']]).get(data['file_path'])
         frame.file_path = data.get('file_path', frame.file_path)
+        usage.add(frameset_owner(frame.frameset_id), frame.frame_type, frame.file_size)
+        usage.apply()
         frame.exposure_time = data.get('exposure_time', frame.exposure_time)
         frame.iso = data.get('iso', frame.iso)
         frame.temperature = data.get('temperature', frame.temperature)
@@ -2080,6 +2905,10 @@ def update_raw_frame(frame_id):
 def delete_raw_frame(frame_id):
     try:
         frame = RawFrame.query.get_or_404(frame_id)
+        adjust_blob_refs(removed=[frame.file_path])
+        usage = UsageChanges()
+        usage.remove(frameset_owner(frame.frameset_id), frame.frame_type, frame.file_size)
+        usage.apply()
         db.session.delete(frame)
         db.session.commit()
         return jsonify({'message': 'RawFrame deleted successfully'}), 200
@@ -39,6 +39,29 @@ def create_app():
     app.register_blueprint(bp)
     from api import api_bp  # Import the api blueprint
     app.register_blueprint(api_bp, url_prefix='/api')
+    from .blobstore import dedupe_uploads_command
+    app.cli.add_command(dedupe_uploads_command)
+    from .upload_janitor import init_upload_janitor, reap_uploads_command
+    app.cli.add_command(reap_uploads_command)
+    init_upload_janitor(app)
+    from .jobs import init_job_workers, run_jobs_command
+    app.cli.add_command(run_jobs_command)
+    init_job_workers(app)
+    from .upload_admission import init_upload_admission
+    init_upload_admission(app)
+    from .storage_usage import rebuild_storage_usage_command
+    app.cli.add_command(rebuild_storage_usage_command)
+    from .upload_layout import shard_uploads_command
+    app.cli.add_command(shard_uploads_command)
+    from .storage import copy_uploads_command
+    app.cli.add_command(copy_uploads_command)
+    from .upload_journal import init_upload_journal, recover_uploads_command
+    app.cli.add_command(recover_uploads_command)
+    init_upload_journal(app)
+    from .upload_gc import gc_uploads_command
+    app.cli.add_command(gc_uploads_command)
+    from .metadata_cache import refresh_frame_metadata_command
+    app.cli.add_command(refresh_frame_metadata_command)
     from .models import User, CelestialObject, Gear, Location, Session, Image, ImageObject, ImageGear, ImageSession, ProcessingLog, FrameSummary, FrameSet, RawFrame
     # Register model views
     admin = Admin(app, name='Astrophotography Admin Panel', template_mode='bootstrap3')
@@ -0,0 +1,255 @@
+"""Content-addressed storage for uploaded files.
+
+Every file is stored once under uploads/blobs/<d[0:2]>/<d[2:4]>/<digest><ext>,
+keyed by its content digest (see app/digests.py). Uploading the same master
+bias or dark library again only adds rows pointing at the existing blob.
+
+Blob.ref_count counts the Image/RawFrame rows whose file_path points at the
+blob. A freshly uploaded blob starts at 0 until finalize-upload links it, so
+unreferenced blobs are only removed once they are older than a grace period.
+An upload that reuses a blob touches it (file mtime and Blob.last_used_at)
+before its own transaction commits, so a running gc-uploads (app/upload_gc.py)
+sees the blob is wanted again.
+
+Blobs are kept in the configured storage backend (see app/storage.py).
+"""
+import os
+from collections import Counter
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, union, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from . import db
+from .digests import file_digest
+from .models import Blob, FrameSet, Image, RawFrame, StoredFile
+
+# Folder (relative to the uploads folder) holding the blobs
+BLOB_FOLDER = 'blobs'
+
+
+def blob_relative_path(digest, extension=''):
+    """Where the blob with this digest lives, relative to the uploads folder"""
+    return os.path.join(BLOB_FOLDER, digest[:2], digest[2:4], f'{digest}{extension.lower()}')
+
+
+def is_blob_path(file_path):
+    return bool(file_path) and file_path.replace('\\', '/').startswith(BLOB_FOLDER + '/')
+
+
+def touch_blob(storage, blob):
+    """Mark an existing blob as used right now, False if its file is gone.
+
+    The file's mtime moves at once and Blob.last_used_at is written on a
+    connection of its own and committed, so gc-uploads sees both before the
+    caller's transaction (which links the blob) commits.
+    """
+    if not storage.touch(blob.file_path):
+        return False
+    now = datetime.utcnow()
+    blob.last_used_at = now
+    if db.engine.dialect.name == 'sqlite':
+        # One writer at a time, the second connection would wait for our own transaction.
+        # The file mtime is what gc-uploads goes by there.
+        return True
+    table = Blob.__table__
+    try:
+        with db.engine.begin() as connection:
+            # A row locked by another transaction (possibly ours) is being written anyway
+            locked = connection.execute(
+                select(table.c.content_digest)
+                .where(table.c.content_digest == blob.content_digest)
+                .with_for_update(skip_locked=True)
+            ).scalar()
+            if locked is not None:
+                connection.execute(
+                    update(table).where(table.c.content_digest == blob.content_digest).values(last_used_at=now)
+                )
+    except OperationalError as e:
+        print(f"Could not mark blob {blob.content_digest} as used: {str(e)}")
+    return True
+
+
+def store_blob(storage, src_path, digest, file_size, extension='', keep_source=False, journal=None):
+    """Put the local file src_path into the blob store, unless the same content is already there.
+
+    The source file is handed to the storage backend (moved, or kept when
+    keep_source is set) and a Blob row is added to db.session. If a blob with
+    this digest already exists the source is just dropped. With a journal the
+    file is only staged, journal.publish() puts it in place (see app/upload_journal.py).
+    Returns (relative_path, is_duplicate).
+    """
+    blob = db.session.get(Blob, digest)
+    if blob is not None and ((journal is not None and journal.has(blob.file_path)) or touch_blob(storage, blob)):
+        if not keep_source:
+            if journal is not None:
+                journal.drop(src_path)
+            else:
+                os.remove(src_path)
+        return blob.file_path, True
+
+    relative_path = blob_relative_path(digest, extension)
+    if journal is not None:
+        journal.stage(src_path, relative_path, keep_source=keep_source)
+    else:
+        storage.put_file(relative_path, src_path, keep_source=keep_source)
+
+    if blob is not None:
+        # The row survived but the file went missing, this upload brings it back
+        blob.file_path = relative_path
+        blob.last_used_at = datetime.utcnow()
+        return relative_path, False
+
+    try:
+        # Another request may be storing the same content right now
+        with db.session.begin_nested():
+            db.session.add(Blob(
+                content_digest=digest,
+                file_path=relative_path,
+                file_size=file_size,
+                ref_count=0
+            ))
+    except IntegrityError:
+        return db.session.get(Blob, digest).file_path, True
+
+    return relative_path, False
+
+
+def owned_digests(user_id, digests):
+    """The digests among digests that an Image or RawFrame of user_id already has"""
+    image_digests = select(Image.content_digest).where(
+        Image.user_id == user_id, Image.content_digest.in_(digests)
+    )
+    frame_digests = (
+        select(RawFrame.content_digest)
+        .join(FrameSet, FrameSet.frameset_id == RawFrame.frameset_id)
+        .join(Image, Image.image_id == FrameSet.image_id)
+        .where(Image.user_id == user_id, RawFrame.content_digest.in_(digests))
+    )
+    return set(db.session.execute(union(image_digests, frame_digests)).scalars())
+
+
+def find_stored_files(storage, digests, user_id, batch_size=500):
+    """Find a stored file for each of the given content digests the user already owns.
+
+    A digest alone proves nothing (anyone can learn one), so only content the
+    user's own Image/RawFrame rows reference is matched; other digests are
+    reported missing, whoever else has the file. Returns {digest: StoredFile}
+    for the digests whose content is on disk, preferring the blob over
+    copies stored before deduplication.
+    """
+    digests = list(set(digests))
+    found = {}
+    for start in range(0, len(digests), batch_size):
+        batch = list(owned_digests(user_id, digests[start:start + batch_size]))
+        if not batch:
+            continue
+        stored_files = StoredFile.query.filter(StoredFile.content_digest.in_(batch)).all()
+        stored_files.sort(key=lambda stored: not is_blob_path(stored.file_path))
+        for stored in stored_files:
+            if stored.content_digest in found:
+                continue
+            if storage.exists(stored.file_path):
+                found[stored.content_digest] = stored
+    return found
+
+
+def adjust_blob_refs(added=(), removed=(), batch_size=500):
+    """Update Blob.ref_count for file paths that gained or lost a referencing row.
+
+    Runs in the current db.session transaction, so the counts are committed
+    (or rolled back) together with the rows that reference the blobs. Paths
+    changing by the same amount share an UPDATE, so registering thousands of
+    frames takes a handful of statements.
+    """
+    counts = Counter(path for path in added if is_blob_path(path))
+    counts.subtract(path for path in removed if is_blob_path(path))
+    by_delta = {}
+    for path, delta in counts.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(path)
+
+    blob_table = Blob.__table__
+    now = datetime.utcnow()
+    for delta, paths in by_delta.items():
+        for start in range(0, len(paths), batch_size):
+            db.session.execute(
+                update(blob_table)
+                .where(blob_table.c.file_path.in_(paths[start:start + batch_size]))
+                .values(ref_count=blob_table.c.ref_count + delta, last_used_at=now)
+            )
+
+
+def import_existing_files(storage, batch_size=500):
+    """Move files referenced by Image/RawFrame rows into the blob store.
+
+    Files are copied (hard linked on local storage) into place first, the rows are rewritten and
+    committed batch by batch, and only then are the old names removed, so a
+    crash half way never leaves a row pointing at a missing file.
+    Returns (files_imported, bytes_saved).
+    """
+    imported = 0
+    saved = 0
+    moved = {}  # old relative path -> blob relative path
+
+    for model in (Image, RawFrame):
+        # Paged by primary key, rows left behind (their file is gone) don't come back
+        primary_key = model.__mapper__.primary_key[0]
+        last_key = None
+        while True:
+            query = (
+                model.query
+                .filter(model.file_path.isnot(None))
+                .filter(~model.file_path.like(f'{BLOB_FOLDER}/%'))
+            )
+            if last_key is not None:
+                query = query.filter(primary_key > last_key)
+            rows = query.order_by(primary_key).limit(batch_size).all()
+            if not rows:
+                break
+            last_key = getattr(rows[-1], primary_key.key)
+            # Rows whose file is gone keep their path
+            rows = [row for row in rows if row.file_path in moved or storage.exists(row.file_path)]
+
+            old_paths = set()
+            for row in rows:
+                old_path = row.file_path
+                if old_path not in moved:
+                    with storage.local_copy(old_path) as full_path:
+                        digest = file_digest(full_path)
+                        size = os.path.getsize(full_path)
+                        new_path, is_duplicate = store_blob(
+                            storage, full_path, digest, size,
+                            extension=os.path.splitext(old_path)[1], keep_source=True
+                        )
+                    db.session.merge(StoredFile(file_path=new_path, content_digest=digest, file_size=size))
+                    moved[old_path] = new_path
+                    imported += 1
+                    if is_duplicate:
+                        saved += size
+                old_paths.add(old_path)
+                row.file_path = moved[old_path]
+                row.content_digest = os.path.splitext(os.path.basename(moved[old_path]))[0]
+                db.session.flush()
+                adjust_blob_refs(added=[row.file_path])
+            db.session.commit()
+
+            # The rows point at the blobs now, the old copies can go
+            for old_path in old_paths:
+                storage.delete(old_path)
+                StoredFile.query.filter_by(file_path=old_path).delete()
+            db.session.commit()
+
+    return imported, saved
+
+
+@click.command('dedupe-uploads')
+@click.option('--batch-size', default=500, help='Rows rewritten per transaction.')
+@with_appcontext
+def dedupe_uploads_command(batch_size):
+    """Move existing uploads into the content-addressed blob store."""
+    from .storage import get_storage
+    imported, saved = import_existing_files(get_storage(), batch_size=batch_size)
+    click.echo(f'Imported {imported} files, {saved} bytes of duplicates removed')
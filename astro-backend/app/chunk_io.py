@@ -0,0 +1,218 @@
+import os
+import shutil
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of the buffer used when streaming request bodies to disk
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Content-Encodings a chunk can be sent with (zstd needs the zstandard package)
+CHUNK_ENCODINGS = ('identity', 'gzip', 'x-gzip', 'deflate', 'zstd')
+
+
+def preallocate(path, size):
+    """Create (or resize) a file so that chunks can be written at their offsets"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if size:
+            try:
+                # Reserve the blocks up front so the disk can't fill up mid-upload
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                # Not available on every platform/filesystem, a sparse file works too
+                os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def write_stream_at(path, stream, offset, on_block=None):
+    """Copy a readable stream into an existing file starting at offset.
+
+    Returns the number of bytes written. on_block, if given, is called with
+    every block as it goes to disk.
+    """
+    written = 0
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while True:
+            block = stream.read(COPY_BUFFER_SIZE)
+            if not block:
+                break
+            if on_block:
+                on_block(block)
+            view = memoryview(block)
+            while view:
+                n = os.pwrite(fd, view, offset + written)
+                view = view[n:]
+                written += n
+    finally:
+        os.close(fd)
+    return written
+
+
+def write_stream(path, stream, on_block=None):
+    """Copy a readable stream into a new file, returns the number of bytes written"""
+    with open(path, 'wb'):
+        pass
+    return write_stream_at(path, stream, 0, on_block=on_block)
+
+
+def append_file(dst_fd, src_path):
+    """Append src_path to the open descriptor dst_fd, using kernel-side copies when possible"""
+    with open(src_path, 'rb') as src:
+        remaining = os.fstat(src.fileno()).st_size
+        src_fd = src.fileno()
+
+        # copy_file_range keeps the data inside the kernel (and can reflink on CoW filesystems)
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while remaining > 0:
+                    n = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+                return
+            except OSError:
+                pass
+
+        # sendfile is the next best thing on older kernels
+        if hasattr(os, 'sendfile'):
+            try:
+                offset = os.fstat(src_fd).st_size - remaining
+                while remaining > 0:
+                    n = os.sendfile(dst_fd, src_fd, offset, remaining)
+                    if n == 0:
+                        break
+                    offset += n
+                    remaining -= n
+                return
+            except OSError:
+                pass
+
+        # Plain buffered copy as a last resort
+        src.seek(os.fstat(src_fd).st_size - remaining)
+        with os.fdopen(os.dup(dst_fd), 'wb', closefd=True) as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def concat_files(dst_path, src_paths):
+    """Concatenate src_paths into dst_path without pulling the data through Python"""
+    fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for src_path in src_paths:
+            append_file(fd, src_path)
+    finally:
+        os.close(fd)
+
+
+def publish(src_path, dst_path):
+    """Move a finished file into place, a plain rename when both are on the same filesystem.
+
+    Either way dst_path never exists half written.
+    """
+    try:
+        os.replace(src_path, dst_path)
+    except OSError:
+        # Temp and upload folders live on different devices, copy to a temp name next to dst_path first
+        temp_path = f'{dst_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            shutil.copyfile(src_path, temp_path)
+            fsync_path(temp_path)
+            os.replace(temp_path, dst_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.remove(src_path)
+
+
+def fsync_path(path):
+    """Flush a file's data (or a folder's entries) to stable storage"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_paths(paths, threads=8):
+    """fsync a batch of files or folders.
+
+    The fsyncs are issued concurrently, so the filesystem can commit them
+    together instead of waiting for the disk once per file.
+    """
+    paths = list(dict.fromkeys(paths))
+    if threads <= 1 or len(paths) <= 1:
+        for path in paths:
+            fsync_path(path)
+        return
+    with ThreadPoolExecutor(min(threads, len(paths))) as pool:
+        # list() so an error from any of them is raised here
+        list(pool.map(fsync_path, paths))
+
+
+def available_chunk_encodings():
+    """The CHUNK_ENCODINGS this server can actually decode"""
+    try:
+        import zstandard  # noqa: F401
+        return list(CHUNK_ENCODINGS)
+    except ImportError:
+        return [encoding for encoding in CHUNK_ENCODINGS if encoding != 'zstd']
+
+
+class UnsupportedEncoding(Exception):
+    """Raised for a Content-Encoding the server can't decode"""
+
+
+class DecodingReader:
+    """Decompress a stream while it is read.
+
+    Never returns more than limit decoded bytes, so a chunk can't spill into
+    its neighbour's region (or fill the disk) whatever it decompresses to.
+    If there was more, overflow is set once the limit has been reached.
+    """
+
+    def __init__(self, stream, encoding, limit):
+        self.overflow = False
+        self._stream = stream
+        self._remaining = limit
+        self._tail = b''
+        if encoding in ('gzip', 'x-gzip'):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._read_decoded = self._read_zlib
+        elif encoding == 'deflate':
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+            self._read_decoded = self._read_zlib
+        elif encoding == 'zstd':
+            try:
+                import zstandard  # optional dependency, only needed for zstd chunks
+            except ImportError:
+                raise UnsupportedEncoding('zstd encoded chunks need the zstandard package on the server')
+            self._reader = zstandard.ZstdDecompressor().stream_reader(stream, read_size=COPY_BUFFER_SIZE)
+            self._read_decoded = self._reader.read
+        else:
+            raise UnsupportedEncoding(f'Unsupported Content-Encoding {encoding!r}')
+
+    def _read_zlib(self, size):
+        while True:
+            if self._tail:
+                data, self._tail = self._tail, b''
+            else:
+                data = self._stream.read(COPY_BUFFER_SIZE)
+                if not data:
+                    return self._decompressor.flush()
+            # max_length keeps a highly compressed block from being inflated all at once
+            out = self._decompressor.decompress(data, size)
+            self._tail = self._decompressor.unconsumed_tail
+            if out:
+                return out
+
+    def read(self, size=COPY_BUFFER_SIZE):
+        if self._remaining <= 0:
+            if self._read_decoded(1):
+                self.overflow = True
+            return b''
+        data = self._read_decoded(min(size, self._remaining))
+        self._remaining -= len(data)
+        return data
@@ -0,0 +1,79 @@
+"""Content digests for uploaded files.
+
+A file's content digest is the SHA-256 of the SHA-256 digests of each of its
+1 MiB blocks (the last block may be shorter). Hashing in fixed blocks means
+the chunks of a parallel upload can be hashed on arrival, in any order and on
+any worker, and combined at the end without reading the file again. A file
+gets the same digest whether it was uploaded in chunks or in one piece.
+
+This is not the SHA-256 of the file itself. Clients that want to check an
+upload compute it the same way,
+
+    sha256(sha256(block 0) + sha256(block 1) + ... + sha256(last block))
+
+with raw 32 byte block digests and the block size /chunk-upload/init
+returns, and send it as blockDigest (DIGEST_ALGORITHM) on completion.
+"""
+import hashlib
+
+# Name of the digest scheme, as reported to clients
+DIGEST_ALGORITHM = 'sha256-blocks'
+
+# Size of the blocks files are hashed in
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+class BlockHasher:
+    """Hash a stream of bytes block by block as it is written"""
+
+    def __init__(self):
+        self._digests = []
+        self._current = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            take = min(len(view), DIGEST_BLOCK_SIZE - self._filled)
+            self._current.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == DIGEST_BLOCK_SIZE:
+                self._digests.append(self._current.digest())
+                self._current = hashlib.sha256()
+                self._filled = 0
+
+    def block_digests(self):
+        """The concatenated digests of every block seen so far (a partial last block included)"""
+        digests = list(self._digests)
+        if self._filled:
+            digests.append(self._current.copy().digest())
+        return b''.join(digests)
+
+    def hexdigest(self):
+        """The content digest of everything seen so far"""
+        return combine_block_digests(self.block_digests())
+
+
+def combine_block_digests(block_digests):
+    """Turn the concatenated block digests of a whole file into its content digest"""
+    return hashlib.sha256(block_digests).hexdigest()
+
+
+def file_digest(path):
+    """Compute the content digest of a file on disk (reads the whole file)"""
+    hasher = BlockHasher()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(DIGEST_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def is_block_aligned(offset, length, is_last):
+    """Whether a chunk covers whole blocks, so its block digests can be combined later"""
+    if offset % DIGEST_BLOCK_SIZE:
+        return False
+    return is_last or length % DIGEST_BLOCK_SIZE == 0
@@ -0,0 +1,715 @@
+"""Capture metadata read from the headers of uploaded frames.
+
+Only the header is read, never the pixel data, so registering a session of
+thousands of sub-exposures stays cheap. Every format is turned into the same
+dict (keys missing when the header doesn't say):
+
+    exposure_time  seconds          iso           int
+    gain           camera gain      temperature   sensor temperature, deg C
+    capture_time   datetime (UTC)   image_type    'light', 'dark', ... as written by the capture software
+    filter         str              binning       int
+    width, height  pixels           instrument, telescope, object   str
+    focal_length   mm               aperture      f-number
+    serial_number  camera body      lens          str
+    sample_format  'UInt16', 'Float32', ... (XISF)
+
+read_metadata(f) sniffs the format from the first bytes of a binary file
+object. Formats:
+
+    FITS           the 2880 byte header blocks up to the END card
+    CR2, NEF, ARW  (and any TIFF) IFD0, the Exif IFD and the Canon/Nikon maker
+                   note, the file is memory-mapped and only the directory
+                   entries and the values they point at are touched
+    CR3            the CMT1-3 boxes (TIFF structures) of the Canon uuid box
+    XISF           the XML header, stream-parsed up to the end of the first
+                   Image element (its FITSKeyword and Property children,
+                   geometry and sample format), the data blocks are skipped
+"""
+import mmap
+import os
+import re
+import struct
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+# Bumped whenever a reader changes what it returns, so cached results (app/metadata_cache.py) are read again
+METADATA_VERSION = 1
+
+# FITS headers come in blocks of 36 cards of 80 characters
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+# Headers longer than this are not a frame we want to parse
+FITS_MAX_HEADER_BLOCKS = 100
+
+# FITS keyword -> metadata key, the first one found wins
+FITS_KEYWORDS = {
+    'EXPTIME': 'exposure_time',
+    'EXPOSURE': 'exposure_time',
+    'ISOSPEED': 'iso',
+    'ISO': 'iso',
+    'GAIN': 'gain',
+    'CCD-TEMP': 'temperature',
+    'CCD_TEMP': 'temperature',
+    'TEMPERAT': 'temperature',
+    'DATE-OBS': 'capture_time',
+    'IMAGETYP': 'image_type',
+    'FRAME': 'image_type',
+    'FILTER': 'filter',
+    'XBINNING': 'binning',
+    'NAXIS1': 'width',
+    'NAXIS2': 'height',
+    'INSTRUME': 'instrument',
+    'TELESCOP': 'telescope',
+    'OBJECT': 'object',
+    'FOCALLEN': 'focal_length',
+}
+# Only needed to complete DATE-OBS
+FITS_EXTRA_KEYWORDS = {'TIME-OBS'}
+
+INT_KEYS = {'iso', 'binning', 'width', 'height'}
+FLOAT_KEYS = {'exposure_time', 'gain', 'temperature', 'focal_length', 'aperture'}
+STR_KEYS = {'image_type', 'filter', 'instrument', 'telescope', 'object', 'serial_number', 'lens', 'sample_format'}
+
+# What capture software writes in IMAGETYP, normalised to RawFrame.frame_type
+IMAGE_TYPES = {
+    'light': 'light', 'light frame': 'light', 'object': 'light', 'science': 'light',
+    'dark': 'dark', 'dark frame': 'dark',
+    'flat': 'flat', 'flat field': 'flat', 'flat frame': 'flat',
+    'bias': 'bias', 'bias frame': 'bias', 'offset': 'bias', 'zero': 'bias',
+    'dark flat': 'dark_flat', 'darkflat': 'dark_flat', 'flat dark': 'dark_flat',
+    # Integrated masters (PixInsight, Siril)
+    'master light': 'light', 'master dark': 'dark', 'master flat': 'flat', 'master bias': 'bias',
+    'master dark flat': 'dark_flat', 'master flat dark': 'dark_flat',
+}
+
+_OLD_FITS_DATE = re.compile(r'^(\d\d)/(\d\d)/(\d\d)$')
+_EXIF_OFFSET = re.compile(r'^[+-]\d\d:\d\d$')
+
+
+def parse_fits_value(raw):
+    """Python value of the value field of a card (bytes after '= ')"""
+    raw = raw.strip()
+    if raw.startswith(b"'"):
+        # Strings end at the first quote that isn't doubled
+        end = 1
+        while True:
+            end = raw.find(b"'", end)
+            if end < 0:
+                end = len(raw)
+                break
+            if raw[end + 1:end + 2] == b"'":
+                end += 2
+                continue
+            break
+        return raw[1:end].replace(b"''", b"'").decode('latin-1').rstrip()
+    value = raw.split(b'/', 1)[0].strip()
+    if value == b'T':
+        return True
+    if value == b'F':
+        return False
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace(b'D', b'E'))
+    except ValueError:
+        return value.decode('latin-1')
+
+
+def read_fits_header(f, keywords=None):
+    """{keyword: value} of the primary header of the FITS file f, stopping at END.
+
+    Only the keywords in keywords are parsed (all of them if None).
+    """
+    header = {}
+    for _ in range(FITS_MAX_HEADER_BLOCKS):
+        block = f.read(FITS_BLOCK_SIZE)
+        if len(block) < FITS_BLOCK_SIZE:
+            break
+        for offset in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+            keyword = block[offset:offset + 8].rstrip().decode('latin-1')
+            if keyword == 'END':
+                return header
+            if block[offset + 8:offset + 10] != b'= ':
+                continue
+            if keywords is not None and keyword not in keywords:
+                continue
+            header.setdefault(keyword, parse_fits_value(block[offset + 10:offset + FITS_CARD_SIZE]))
+    return header
+
+
+def parse_date(value, time_value=None):
+    """UTC datetime of a DATE-OBS style value (None if it isn't one)"""
+    if not isinstance(value, str) or not value:
+        return None
+    value = value.strip()
+    old = _OLD_FITS_DATE.match(value)
+    if old:
+        # dd/mm/yy, from before 1999
+        day, month, year = (int(part) for part in old.groups())
+        value = f'{1900 + year:04d}-{month:02d}-{day:02d}'
+    if 'T' not in value and isinstance(time_value, str) and time_value.strip():
+        value = f'{value}T{time_value.strip()}'
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def normalise_image_type(value):
+    if not isinstance(value, str):
+        return None
+    return IMAGE_TYPES.get(value.strip().lower(), value.strip().lower() or None)
+
+
+def _typed(key, value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        if key in INT_KEYS:
+            return int(round(float(value)))
+        if key in FLOAT_KEYS:
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    if key in STR_KEYS:
+        value = str(value).strip()
+        return value or None
+    return value
+
+
+def fits_metadata(header):
+    """The metadata dict (see the module docstring) of a parsed FITS header"""
+    metadata = {}
+    for keyword, key in FITS_KEYWORDS.items():
+        if key in metadata or keyword not in header:
+            continue
+        if key == 'capture_time':
+            value = parse_date(header[keyword], header.get('TIME-OBS'))
+        elif key == 'image_type':
+            value = normalise_image_type(header[keyword])
+        else:
+            value = _typed(key, header[keyword])
+        if value is not None:
+            metadata[key] = value
+    return metadata
+
+
+def is_fits(prefix):
+    return prefix.startswith(b'SIMPLE  =')
+
+
+def read_fits_metadata(f):
+    return fits_metadata(read_fits_header(f, set(FITS_KEYWORDS) | FITS_EXTRA_KEYWORDS))
+
+
+class FileView:
+    """Sliceable view of a seekable file object, for files that can't be memory-mapped (S3)"""
+
+    def __init__(self, f):
+        self._f = f
+        self._size = f.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(self._size)
+        self._f.seek(start)
+        return self._f.read(max(stop - start, 0))
+
+
+@contextmanager
+def map_file(f):
+    """The contents of the binary file object f as a sliceable buffer, memory-mapped if f is a real file"""
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        mapped = None
+    if mapped is None:
+        yield FileView(f)
+        return
+    try:
+        yield mapped
+    finally:
+        mapped.close()
+
+
+def _unpack(buf, fmt, pos):
+    size = struct.calcsize(fmt)
+    data = buf[pos:pos + size]
+    if pos < 0 or len(data) < size:
+        raise ValueError('TIFF structure points outside the file')
+    return struct.unpack(fmt, data)
+
+
+# TIFF field type -> (struct format of one value, bytes per value)
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('B', 1),
+    8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 13: ('I', 4),
+}
+TIFF_ASCII = 2
+TIFF_UNDEFINED = 7
+TIFF_RATIONALS = {5, 10}
+TIFF_BYTE_ORDERS = {b'II': '<', b'MM': '>'}
+# More entries than this in one directory means we are reading garbage
+TIFF_MAX_ENTRIES = 1000
+
+
+def tiff_header(buf, base=0):
+    """(struct byte order, offset of the first IFD) of the TIFF header at base"""
+    order = TIFF_BYTE_ORDERS.get(buf[base:base + 2])
+    if order is None:
+        raise ValueError('Not a TIFF header')
+    magic, offset = _unpack(buf, order + 'HI', base + 2)
+    if magic != 42:
+        raise ValueError('Not a TIFF header')
+    return order, offset
+
+
+class Ifd:
+    """One TIFF image file directory, values are only decoded when asked for.
+
+    Offsets in the directory are relative to base (the TIFF header the
+    directory belongs to).
+    """
+
+    def __init__(self, buf, order, base, offset):
+        self.buf = buf
+        self.order = order
+        self.base = base
+        self._entries = {}
+        start = base + offset
+        (count,) = _unpack(buf, order + 'H', start)
+        if count > TIFF_MAX_ENTRIES:
+            raise ValueError('Not a TIFF directory')
+        raw = buf[start + 2:start + 2 + count * 12]
+        for i in range(len(raw) // 12):
+            tag, field_type, n, value = struct.unpack_from(order + 'HHII', raw, i * 12)
+            if field_type not in TIFF_TYPES:
+                continue
+            size = TIFF_TYPES[field_type][1] * n
+            # Values of 4 bytes or less are stored in the entry itself
+            position = start + 2 + i * 12 + 8 if size <= 4 else base + value
+            self._entries[tag] = (field_type, n, position)
+
+    def position(self, tag):
+        """Absolute position of the value of tag (None if it isn't there)"""
+        entry = self._entries.get(tag)
+        return entry[2] if entry else None
+
+    def get(self, tag):
+        """Value of tag: str, a number (a rational as float) or a tuple of them, None if missing"""
+        entry = self._entries.get(tag)
+        if entry is None:
+            return None
+        field_type, n, position = entry
+        fmt, size = TIFF_TYPES[field_type]
+        data = self.buf[position:position + size * n]
+        if n == 0 or len(data) < size * n:
+            return None
+        if field_type == TIFF_ASCII:
+            return data.split(b'\0', 1)[0].decode('latin-1').strip() or None
+        if field_type == TIFF_UNDEFINED:
+            return data
+        values = struct.unpack(self.order + fmt * n, data)
+        if field_type in TIFF_RATIONALS:
+            values = tuple(
+                values[i] / values[i + 1] if values[i + 1] else None for i in range(0, len(values), 2)
+            )
+        return values[0] if len(values) == 1 else values
+
+
+# Tags of IFD0
+TIFF_MAKE = 0x010F
+TIFF_MODEL = 0x0110
+TIFF_DATE_TIME = 0x0132
+TIFF_EXIF_IFD = 0x8769
+# Tags of the Exif IFD
+EXIF_EXPOSURE_TIME = 0x829A
+EXIF_F_NUMBER = 0x829D
+EXIF_ISO = 0x8827
+EXIF_RECOMMENDED_EXPOSURE_INDEX = 0x8832
+EXIF_ISO_SPEED = 0x8833
+EXIF_DATE_TIME_ORIGINAL = 0x9003
+EXIF_OFFSET_TIME_ORIGINAL = 0x9011
+EXIF_SUB_SEC_TIME_ORIGINAL = 0x9291
+EXIF_FOCAL_LENGTH = 0x920A
+EXIF_MAKER_NOTE = 0x927C
+EXIF_TEMPERATURE = 0x9400
+EXIF_BODY_SERIAL_NUMBER = 0xA431
+EXIF_LENS_MODEL = 0xA434
+# Canon maker note
+CANON_SHOT_INFO = 0x0004
+CANON_SERIAL_NUMBER = 0x000C
+CANON_LENS_MODEL = 0x0095
+CANON_CAMERA_TEMPERATURE = 12  # index in ShotInfo, degrees + 128 (0 if not recorded)
+# Nikon maker note (type 3, with its own TIFF header)
+NIKON_SERIAL_NUMBER = 0x001D
+NIKON_LENS = 0x0084
+NIKON_MAKER_NOTE_PREFIX = b'Nikon\0'
+NIKON_TIFF_OFFSET = 10
+
+
+def parse_exif_date(value, sub_sec=None, offset=None):
+    """datetime of an Exif 'YYYY:MM:DD HH:MM:SS' value, in UTC if the offset is known"""
+    # Sliced by hand, strptime would be most of the cost of reading a raw
+    if not isinstance(value, str) or len(value) < 19:
+        return None
+    try:
+        parsed = datetime(
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19])
+        )
+    except ValueError:
+        return None  # 0000:00:00 00:00:00 and the like
+    if isinstance(sub_sec, str) and sub_sec.strip().isdigit():
+        parsed = parsed.replace(microsecond=int(sub_sec.strip()[:6].ljust(6, '0')))
+    if isinstance(offset, str) and _EXIF_OFFSET.match(offset.strip()):
+        offset = offset.strip()
+        minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        parsed -= timedelta(minutes=-minutes if offset[0] == '-' else minutes)
+    return parsed
+
+
+def canon_maker_note(ifd):
+    metadata = {}
+    shot_info = ifd.get(CANON_SHOT_INFO)
+    if isinstance(shot_info, tuple) and len(shot_info) > CANON_CAMERA_TEMPERATURE:
+        if shot_info[CANON_CAMERA_TEMPERATURE]:
+            metadata['temperature'] = shot_info[CANON_CAMERA_TEMPERATURE] - 128
+    serial = ifd.get(CANON_SERIAL_NUMBER)
+    if isinstance(serial, int) and serial:
+        metadata['serial_number'] = f'{serial:010d}'
+    metadata['lens'] = ifd.get(CANON_LENS_MODEL)
+    return metadata
+
+
+def nikon_maker_note(ifd):
+    metadata = {'serial_number': ifd.get(NIKON_SERIAL_NUMBER)}
+    lens = ifd.get(NIKON_LENS)
+    if isinstance(lens, tuple) and len(lens) == 4 and None not in lens:
+        # min/max focal length, min/max f-number at them
+        wide, tele, wide_f, tele_f = lens
+        focal = f'{wide:g}mm' if wide == tele else f'{wide:g}-{tele:g}mm'
+        aperture = f'f/{wide_f:g}' if wide_f == tele_f else f'f/{wide_f:g}-{tele_f:g}'
+        metadata['lens'] = f'{focal} {aperture}'
+    return metadata
+
+
+def read_maker_note(buf, make, order, position):
+    """Metadata of the maker note at position, {} for makers we don't read"""
+    make = (make or '').lower()
+    if make.startswith('canon'):
+        # A bare IFD, offsets relative to the TIFF header of the file
+        return canon_maker_note(Ifd(buf, order, 0, position))
+    if make.startswith('nikon') and buf[position:position + 6] == NIKON_MAKER_NOTE_PREFIX:
+        base = position + NIKON_TIFF_OFFSET
+        note_order, offset = tiff_header(buf, base)
+        return nikon_maker_note(Ifd(buf, note_order, base, offset))
+    # Sony keeps its temperatures enciphered, the Exif IFD has the rest
+    return {}
+
+
+def camera_metadata(ifd0, exif, maker_note=None):
+    """The metadata dict of a camera raw from its IFD0, Exif IFD and maker note metadata"""
+    make = ifd0.get(TIFF_MAKE) or ''
+    model = ifd0.get(TIFF_MODEL) or ''
+    if make and model and not model.lower().startswith(make.split()[0].lower()):
+        model = f'{make} {model}'
+    iso = exif.get(EXIF_ISO)
+    if isinstance(iso, tuple):
+        iso = iso[0]
+    if not iso or iso == 0xFFFF:
+        # ISO above 65534 is only in the newer tags
+        iso = exif.get(EXIF_ISO_SPEED) or exif.get(EXIF_RECOMMENDED_EXPOSURE_INDEX) or iso
+    metadata = {
+        'instrument': model or make,
+        'exposure_time': exif.get(EXIF_EXPOSURE_TIME),
+        'aperture': exif.get(EXIF_F_NUMBER),
+        'iso': iso,
+        'focal_length': exif.get(EXIF_FOCAL_LENGTH),
+        'capture_time': parse_exif_date(
+            exif.get(EXIF_DATE_TIME_ORIGINAL) or ifd0.get(TIFF_DATE_TIME),
+            exif.get(EXIF_SUB_SEC_TIME_ORIGINAL), exif.get(EXIF_OFFSET_TIME_ORIGINAL)
+        ),
+        'temperature': exif.get(EXIF_TEMPERATURE),
+        'serial_number': exif.get(EXIF_BODY_SERIAL_NUMBER),
+        'lens': exif.get(EXIF_LENS_MODEL),
+    }
+    for key, value in (maker_note or {}).items():
+        if metadata.get(key) is None:
+            metadata[key] = value
+    metadata = {
+        key: value if key == 'capture_time' else _typed(key, value)
+        for key, value in metadata.items()
+    }
+    return {key: value for key, value in metadata.items() if value is not None}
+
+
+def is_tiff(prefix):
+    return prefix[:4] in (b'II*\0', b'MM\0*')
+
+
+def read_tiff_metadata(f):
+    """Metadata of a TIFF based raw (CR2, NEF, ARW, DNG, ...)"""
+    with map_file(f) as buf:
+        try:
+            order, offset = tiff_header(buf)
+            ifd0 = Ifd(buf, order, 0, offset)
+            exif_offset = ifd0.get(TIFF_EXIF_IFD)
+            exif = Ifd(buf, order, 0, exif_offset) if isinstance(exif_offset, int) else ifd0
+            maker_note = {}
+            position = exif.position(EXIF_MAKER_NOTE)
+            if position is not None:
+                try:
+                    maker_note = read_maker_note(buf, ifd0.get(TIFF_MAKE), order, position)
+                except (ValueError, struct.error):
+                    pass  # a maker note we can't follow doesn't spoil the rest
+            return camera_metadata(ifd0, exif, maker_note)
+        except struct.error as e:
+            raise ValueError(str(e))
+
+
+# The uuid box in moov holding a CR3's metadata
+CR3_CANON_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+
+
+def iter_boxes(buf, start, end):
+    """Yield (type, content start, end) of the ISO base media boxes between start and end"""
+    position = start
+    while position + 8 <= end:
+        size, kind = _unpack(buf, '>I4s', position)
+        header = 8
+        if size == 1:
+            (size,) = _unpack(buf, '>Q', position + 8)
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            raise ValueError('Broken box')
+        yield kind, position + header, min(position + size, end)
+        position += size
+
+
+def _find_box(buf, start, end, kind):
+    for box_kind, content, box_end in iter_boxes(buf, start, end):
+        if box_kind == kind:
+            return content, box_end
+    return None
+
+
+def _cmt_ifd(buf, start):
+    """First IFD of the TIFF structure a CMT box holds"""
+    order, offset = tiff_header(buf, start)
+    return Ifd(buf, order, start, offset)
+
+
+def is_cr3(prefix):
+    return prefix[4:12] == b'ftypcrx '
+
+
+def read_cr3_metadata(f):
+    """Metadata of a Canon CR3 (the TIFF structures in moov/uuid/CMT1-3)"""
+    with map_file(f) as buf:
+        try:
+            moov = _find_box(buf, 0, len(buf), b'moov')
+            if moov is None:
+                return {}
+            canon = None
+            for kind, content, end in iter_boxes(buf, *moov):
+                if kind == b'uuid' and buf[content:content + 16] == CR3_CANON_UUID:
+                    canon = (content + 16, end)
+                    break
+            if canon is None:
+                return {}
+            boxes = {kind: content for kind, content, _ in iter_boxes(buf, *canon)}
+            if b'CMT1' not in boxes or b'CMT2' not in boxes:
+                return {}
+            maker_note = {}
+            if b'CMT3' in boxes:
+                try:
+                    maker_note = canon_maker_note(_cmt_ifd(buf, boxes[b'CMT3']))
+                except (ValueError, struct.error):
+                    pass
+            return camera_metadata(_cmt_ifd(buf, boxes[b'CMT1']), _cmt_ifd(buf, boxes[b'CMT2']), maker_note)
+        except struct.error as e:
+            raise ValueError(str(e))
+
+
+# XISF: signature, header length (little endian uint32), 4 reserved bytes, the XML header
+XISF_SIGNATURE = b'XISF0100'
+XISF_PREFIX_SIZE = 16
+# Headers longer than this are not a frame we want to parse
+XISF_MAX_HEADER_SIZE = 16 * 1024 * 1024
+XISF_READ_SIZE = 64 * 1024
+# XISF property id -> metadata key, used where the FITS keywords don't say
+XISF_PROPERTIES = {
+    'Instrument:ExposureTime': 'exposure_time',
+    'Instrument:Camera:Gain': 'gain',
+    'Instrument:Camera:ISOSpeed': 'iso',
+    'Instrument:Sensor:Temperature': 'temperature',
+    'Observation:Time:Start': 'capture_time',
+    'Instrument:Filter:Name': 'filter',
+    'Instrument:Camera:XBinning': 'binning',
+    'Instrument:Camera:Name': 'instrument',
+    'Instrument:Telescope:Name': 'telescope',
+    'Observation:Object:Name': 'object',
+    'Instrument:Telescope:FocalLength': 'focal_length',  # in meters
+}
+
+
+def _local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def read_xisf_header(f):
+    """(attributes of the first Image element, its FITS keywords, properties) of the XISF file f.
+
+    The XML is fed to the parser a chunk at a time and reading stops at the
+    end of the first Image element, so neither the rest of the header nor
+    the attached data blocks are read.
+    """
+    prefix = f.read(XISF_PREFIX_SIZE)
+    if len(prefix) < XISF_PREFIX_SIZE or not is_xisf(prefix):
+        raise ValueError('Not an XISF file')
+    (remaining,) = struct.unpack('<I', prefix[8:12])
+    if remaining > XISF_MAX_HEADER_SIZE:
+        raise ValueError('XISF header too long')
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    image = None
+    keywords = {}
+    properties = {}
+    try:
+        while remaining > 0:
+            chunk = f.read(min(XISF_READ_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            # Writers may pad the header with zeros
+            parser.feed(chunk.rstrip(b'\0'))
+            for event, element in parser.read_events():
+                name = _local_name(element.tag)
+                if event == 'start':
+                    if name == 'Image' and image is None:
+                        image = dict(element.attrib)
+                    continue
+                if name == 'FITSKeyword' and image is not None:
+                    keyword = (element.get('name') or '').strip().upper()
+                    if keyword and keyword not in keywords:
+                        keywords[keyword] = parse_fits_value((element.get('value') or '').encode('latin-1'))
+                elif name == 'Property':
+                    value = element.get('value', element.text)
+                    if element.get('id') and value is not None:
+                        properties.setdefault(element.get('id'), value.strip())
+                elif name == 'Image':
+                    return image, keywords, properties
+                element.clear()
+    except ET.ParseError as e:
+        raise ValueError(f'Broken XISF header: {e}')
+    return image or {}, keywords, properties
+
+
+def xisf_metadata(image, keywords, properties):
+    """The metadata dict of a parsed XISF header"""
+    metadata = fits_metadata(keywords)
+    for property_id, key in XISF_PROPERTIES.items():
+        if key in metadata or property_id not in properties:
+            continue
+        value = properties[property_id]
+        if key == 'capture_time':
+            value = parse_date(value)
+        else:
+            value = _typed(key, value)
+            if key == 'focal_length' and value is not None:
+                value *= 1000
+        if value is not None:
+            metadata[key] = value
+    # width:height:channels
+    geometry = image.get('geometry', '').split(':')
+    if len(geometry) >= 2 and geometry[0].isdigit() and geometry[1].isdigit():
+        metadata['width'] = int(geometry[0])
+        metadata['height'] = int(geometry[1])
+    if image.get('sampleFormat'):
+        metadata['sample_format'] = image['sampleFormat']
+    return metadata
+
+
+def is_xisf(prefix):
+    return prefix.startswith(XISF_SIGNATURE)
+
+
+def read_xisf_metadata(f):
+    return xisf_metadata(*read_xisf_header(f))
+
+
+# (sniff(first bytes), reader(file object positioned at 0)) per format
+READERS = [
+    (is_fits, read_fits_metadata),
+    (is_tiff, read_tiff_metadata),
+    (is_cr3, read_cr3_metadata),
+    (is_xisf, read_xisf_metadata),
+]
+# Bytes read to recognise a format
+SNIFF_SIZE = 16
+
+
+def read_metadata(f):
+    """Metadata of the frame in the binary file object f, {} for formats we don't read"""
+    prefix = f.read(SNIFF_SIZE)
+    for sniff, reader in READERS:
+        if sniff(prefix):
+            f.seek(0)
+            return reader(f)
+    return {}
+
+
+def read_file_metadata(path):
+    """Metadata of the frame at a local path, {} if it can't be read"""
+    try:
+        with open(path, 'rb') as f:
+            return read_metadata(f)
+    except (OSError, ValueError):
+        return {}
+    except Exception as e:
+        # A header the readers trip over (struct.error, KeyError, ...) costs
+        # this frame its metadata, not the whole batch
+        print(f"Error reading metadata of {path}: {str(e)}")
+        return {}
+
+
+def read_stored_metadata(storage, key):
+    """Metadata of a stored file, {} if it can't be read"""
+    try:
+        with storage.open(key) as f:
+            return read_metadata(f)
+    except (OSError, ValueError):
+        return {}
+    except Exception as e:
+        # A header the readers trip over (struct.error, KeyError, ...) costs
+        # this frame its metadata, not the whole batch
+        print(f"Error reading metadata of {key}: {str(e)}")
+        return {}
+
+
+def metadata_to_json(metadata):
+    """metadata with the datetimes as ISO strings"""
+    return {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in metadata.items()
+    }
+
+
+def metadata_from_json(data):
+    """The metadata dict metadata_to_json() was given"""
+    metadata = dict(data)
+    if isinstance(metadata.get('capture_time'), str):
+        metadata['capture_time'] = datetime.fromisoformat(metadata['capture_time'])
+    return metadata
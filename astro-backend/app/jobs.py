@@ -0,0 +1,343 @@
+"""Durable background jobs, kept in the job table of the app database.
+
+Upload routes do the part that needs the request (reading the body, moving
+files into place) and hand everything else to a job, so the HTTP worker can
+answer at once:
+
+    job = enqueue('finalize_upload', {...}, priority=10, user_id=...)
+    db.session.commit()   # the job is queued together with the rest of the request
+
+Handlers are registered with @job_handler('kind') and called with the
+payload inside an app context. Whatever they return (JSON-serialisable) is
+saved as the job result; if they raise, the job is retried with exponential
+backoff up to max_attempts times and then marked failed.
+
+Jobs are claimed with a conditional UPDATE, so any number of worker threads
+and processes can share the table. No broker is needed. While a handler runs
+its worker renews the lease every JOB_HEARTBEAT_INTERVAL seconds; a job whose
+worker died is picked up again once its lease (JOB_LEASE_SECONDS) runs out.
+A worker that lost its job that way doesn't record an outcome for it.
+
+Workers run as JOB_WORKER_THREADS threads inside each app process (started
+with the first request), or as separate processes with `flask run-jobs`.
+"""
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from . import db
+from .models import Job
+
+# kind -> handler(payload)
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Register the decorated function as the handler for jobs of this kind"""
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(kind, payload=None, priority=0, max_attempts=3, user_id=None, delay=0):
+    """Add a job to db.session, it is queued when the caller commits"""
+    job = Job(
+        kind=kind,
+        payload=json.dumps(payload or {}),
+        status='queued',
+        priority=priority,
+        attempts=0,
+        max_attempts=max_attempts,
+        run_after=datetime.utcnow() + timedelta(seconds=delay),
+        user_id=user_id,
+        created_at=datetime.utcnow()
+    )
+    db.session.add(job)
+    return job
+
+
+def job_to_dict(job):
+    return {
+        'jobId': job.job_id,
+        'kind': job.kind,
+        'status': job.status,
+        'priority': job.priority,
+        'attempts': job.attempts,
+        'maxAttempts': job.max_attempts,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'createdAt': job.created_at.isoformat() if job.created_at else None,
+        'finishedAt': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+def claim_job(worker_id):
+    """Mark the next runnable job as running for worker_id and return it (None if there is none)"""
+    table = Job.__table__
+    now = datetime.utcnow()
+    for _ in range(5):
+        job_id = db.session.execute(
+            select(table.c.job_id)
+            .where(table.c.status == 'queued', table.c.run_after <= now)
+            .order_by(table.c.priority.desc(), table.c.created_at)
+            .limit(1)
+        ).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        try:
+            claimed = db.session.execute(
+                update(table)
+                .where(table.c.job_id == job_id, table.c.status == 'queued')
+                .values(status='running', locked_by=worker_id, locked_at=now, attempts=table.c.attempts + 1)
+            ).rowcount
+            db.session.commit()
+        except OperationalError:
+            # SQLite reports "database is locked" when two workers collide
+            db.session.rollback()
+            claimed = 0
+        if claimed:
+            return db.session.get(Job, job_id)
+        # Another worker got there first, try the next job
+    return None
+
+
+def requeue_stale_jobs(lease_seconds):
+    """Put jobs back in the queue whose worker stopped reporting within lease_seconds"""
+    table = Job.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=lease_seconds)
+    count = db.session.execute(
+        update(table)
+        .where(table.c.status == 'running', table.c.locked_at < cutoff)
+        .values(status='queued', locked_by=None, locked_at=None)
+    ).rowcount
+    db.session.commit()
+    return count
+
+
+def renew_lease(job_id, worker_id):
+    """Move locked_at of a job worker_id is running forward, False if it isn't its job any more"""
+    table = Job.__table__
+    # On a connection of its own, the handler may be in the middle of a transaction
+    with db.engine.begin() as connection:
+        return bool(connection.execute(
+            update(table)
+            .where(table.c.job_id == job_id, table.c.status == 'running', table.c.locked_by == worker_id)
+            .values(locked_at=datetime.utcnow())
+        ).rowcount)
+
+
+class JobHeartbeat:
+    """Renews the lease of a running job from a background thread"""
+
+    def __init__(self, app, job_id, worker_id, interval):
+        self.app = app
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'job-heartbeat-{job_id}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self.app.app_context():
+                    if not renew_lease(self.job_id, self.worker_id):
+                        return
+            except OperationalError as e:
+                # SQLite is locked by a writer, the next beat tries again
+                print(f"Job {self.job_id} heartbeat failed: {str(e)}")
+
+
+def finish_job(job_id, worker_id, **values):
+    """Record the outcome of a job, unless another worker has taken it over meanwhile"""
+    table = Job.__table__
+    finished = db.session.execute(
+        update(table)
+        .where(table.c.job_id == job_id, table.c.locked_by == worker_id)
+        .values(locked_by=None, locked_at=None, **values)
+    ).rowcount
+    db.session.commit()
+    if not finished:
+        print(f"Job {job_id} was requeued while {worker_id} ran it, its outcome is dropped")
+    return bool(finished)
+
+
+def run_job(job):
+    """Run a claimed job and record how it went"""
+    job_id = job.job_id
+    worker_id = job.locked_by
+    handler = HANDLERS.get(job.kind)
+    app = current_app._get_current_object()
+    try:
+        if handler is None:
+            raise LookupError(f'No handler for job kind {job.kind!r}')
+        with JobHeartbeat(app, job_id, worker_id, app.config.get('JOB_HEARTBEAT_INTERVAL', 60)):
+            result = handler(json.loads(job.payload or '{}'))
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        error = f'{type(e).__name__}: {e}\n{traceback.format_exc()}'
+        if handler is not None and job.attempts < job.max_attempts:
+            # Exponential backoff before the next attempt
+            base_delay = app.config.get('JOB_RETRY_DELAY', 30)
+            finish_job(
+                job_id, worker_id, status='queued', error=error,
+                run_after=datetime.utcnow() + timedelta(seconds=base_delay * 2 ** (job.attempts - 1))
+            )
+        else:
+            finish_job(job_id, worker_id, status='failed', error=error, finished_at=datetime.utcnow())
+        print(f"Job {job_id} ({job.kind}) failed on attempt {job.attempts}: {e}")
+        return False
+
+    return finish_job(
+        job_id, worker_id, status='done', error=None, finished_at=datetime.utcnow(),
+        result=json.dumps(result) if result is not None else None
+    )
+
+
+def run_next_job(worker_id):
+    """Claim and run one job, returns False when the queue had nothing to do"""
+    job = claim_job(worker_id)
+    if job is None:
+        return False
+    run_job(job)
+    return True
+
+
+def run_pending_jobs(worker_id='inline'):
+    """Run jobs until none are runnable (used by scripts and the CLI), returns how many ran"""
+    count = 0
+    while run_next_job(worker_id):
+        count += 1
+    return count
+
+
+class JobWorkerPool:
+    """A few threads taking jobs from the queue inside one app process"""
+
+    def __init__(self, app, threads, poll_interval=1.0, lease_seconds=30 * 60):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+            prefix = f'{socket.gethostname()}:{os.getpid()}'
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._run, args=(f'{prefix}:{i}',), name=f'job-worker-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def _run(self, worker_id):
+        last_requeue = 0
+        while not self._stop.is_set():
+            ran = False
+            try:
+                with self.app.app_context():
+                    if time.monotonic() - last_requeue > self.poll_interval * 30:
+                        requeue_stale_jobs(self.lease_seconds)
+                        last_requeue = time.monotonic()
+                    ran = run_next_job(worker_id)
+            except Exception as e:
+                print(f"Job worker {worker_id} error: {str(e)}")
+            if not ran:
+                self._stop.wait(self.poll_interval)
+
+
+def make_worker_pool(app, threads=None):
+    return JobWorkerPool(
+        app,
+        threads if threads is not None else app.config.get('JOB_WORKER_THREADS', 2),
+        poll_interval=app.config.get('JOB_POLL_INTERVAL', 1.0),
+        lease_seconds=app.config.get('JOB_LEASE_SECONDS', 30 * 60)
+    )
+
+
+def init_job_workers(app):
+    """Start JOB_WORKER_THREADS worker threads with the first request this process serves.
+
+    Waiting for a request keeps one-off commands (flask db upgrade, ...) from
+    starting workers.
+    """
+    if not app.config.get('JOB_WORKER_THREADS'):
+        return None
+    pool = make_worker_pool(app)
+    app.extensions['job_workers'] = pool
+
+    @app.before_request
+    def start_job_workers():
+        if not pool._workers:
+            pool.start()
+
+    return pool
+
+
+def _worker_process(threads):
+    """Entry point of a `flask run-jobs` worker process"""
+    from config import Config
+    Config.JOB_WORKER_THREADS = 0  # this process runs its own pool below
+    from . import create_app
+    app = create_app()
+    pool = make_worker_pool(app, threads)
+    pool.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop(timeout=5)
+
+
+@click.command('run-jobs')
+@click.option('--processes', default=1, help='Worker processes to start.')
+@click.option('--threads', default=2, help='Worker threads in each process.')
+@click.option('--drain', is_flag=True, help='Run the jobs that are due now in this process and exit.')
+@with_appcontext
+def run_jobs_command(processes, threads, drain):
+    """Work through the background job queue."""
+    if drain:
+        click.echo(f'Ran {run_pending_jobs()} jobs')
+        return
+
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_worker_process, args=(threads,)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    click.echo(f'Started {processes} worker processes with {threads} threads each, Ctrl+C to stop')
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join(10)
@@ -0,0 +1,179 @@
+"""Persistent cache of parsed frame headers.
+
+Calibration frames are linked into many images and archive-wide refreshes
+read the same files over and over, so what app/frame_metadata.py made of a
+header is kept in the frame_metadata_cache table, under
+
+    digest:<content digest>                        files whose digest is known (app/digests.py)
+    stat:<device>:<inode>:<size>:<mtime in ns>     local files without one
+
+A file that changes gets a new key, so entries never need invalidating.
+Entries parsed by an older METADATA_VERSION count as misses and are
+replaced. Hits move last_used_at forward (at most once per
+LAST_USED_RESOLUTION, so a busy cache isn't a write per read) and
+trim_metadata_cache() drops the least recently used entries beyond
+FRAME_METADATA_CACHE_SIZE.
+
+Only headers that gave something are cached: an empty result may be a read
+error that goes away (S3), and sniffing a JPEG again costs next to nothing.
+
+`flask refresh-frame-metadata` reads the header columns of every RawFrame
+again, through the cache and the process pool (app/metadata_pool.py).
+"""
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .frame_metadata import METADATA_VERSION, metadata_from_json, metadata_to_json
+from .models import FrameMetadataCache, RawFrame
+
+LAST_USED_RESOLUTION = timedelta(hours=1)
+
+
+def _batches(items, batch_size=500):
+    # Databases limit the number of bound parameters per statement
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def cache_key(storage, key, digest=None):
+    """Cache key of the stored file key, None if it can't be cached"""
+    if digest:
+        return f'digest:{digest}'
+    if not storage.local or '://' in key:
+        return None
+    try:
+        stat = os.stat(storage.path(key))
+    except OSError:
+        return None
+    return f'stat:{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def lookup_cached(cache_keys):
+    """{cache key: metadata} of the entries of cache_keys in the cache"""
+    table = FrameMetadataCache.__table__
+    now = datetime.utcnow()
+    found = {}
+    stale = []
+    touched = []
+    for batch in _batches(list(set(cache_keys))):
+        rows = db.session.execute(
+            select(table.c.cache_key, table.c.reader_version, table.c.fields, table.c.last_used_at)
+            .where(table.c.cache_key.in_(batch))
+        ).all()
+        for row in rows:
+            if row.reader_version != METADATA_VERSION:
+                stale.append(row.cache_key)
+                continue
+            found[row.cache_key] = metadata_from_json(json.loads(row.fields))
+            if row.last_used_at is None or row.last_used_at < now - LAST_USED_RESOLUTION:
+                touched.append(row.cache_key)
+    for batch in _batches(stale):
+        db.session.execute(delete(table).where(table.c.cache_key.in_(batch)))
+    for batch in _batches(touched):
+        db.session.execute(update(table).where(table.c.cache_key.in_(batch)).values(last_used_at=now))
+    return found
+
+
+def store_cached(entries):
+    """Cache {cache key: metadata}, returns the number of entries written"""
+    table = FrameMetadataCache.__table__
+    now = datetime.utcnow()
+    rows = [
+        {
+            'cache_key': key, 'reader_version': METADATA_VERSION,
+            'fields': json.dumps(metadata_to_json(metadata)), 'last_used_at': now
+        }
+        for key, metadata in entries.items() if metadata
+    ]
+    if not rows:
+        return 0
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(table), rows)
+    except IntegrityError:
+        # Another worker cached some of them meanwhile, add the rest one by one
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(table), [row])
+            except IntegrityError:
+                pass
+    return len(rows)
+
+
+def trim_metadata_cache(max_entries):
+    """Drop the least recently used entries beyond max_entries, returns how many went"""
+    table = FrameMetadataCache.__table__
+    excess = db.session.execute(select(func.count()).select_from(table)).scalar() - max_entries
+    if excess <= 0:
+        return 0
+    oldest = db.session.execute(
+        select(table.c.cache_key).order_by(table.c.last_used_at).limit(excess)
+    ).scalars().all()
+    for batch in _batches(oldest):
+        db.session.execute(delete(table).where(table.c.cache_key.in_(batch)))
+    return len(oldest)
+
+
+def refresh_frame_metadata(storage, batch_size=1000):
+    """Read the header columns of every RawFrame again, returns (frames, frames changed)"""
+    from api import FRAME_METADATA_COLUMNS, apply_frame_metadata
+    from .metadata_pool import read_frames_metadata
+    table = RawFrame.__table__
+    columns = list(FRAME_METADATA_COLUMNS)
+    statement = (
+        update(table)
+        .where(table.c.frame_id == bindparam('b_frame_id'))
+        .values({column: bindparam(f'b_{column}') for column in columns})
+    )
+    frames = 0
+    changed = 0
+    after = ''
+    while True:
+        rows = db.session.execute(
+            select(table.c.frame_id, table.c.file_path, table.c.content_digest, *(table.c[c] for c in columns))
+            .where(table.c.frame_id > after, table.c.file_path.isnot(None))
+            .order_by(table.c.frame_id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        after = rows[-1].frame_id
+        metadata = read_frames_metadata(
+            storage,
+            [row.file_path for row in rows if '://' not in row.file_path],
+            {row.file_path: row.content_digest for row in rows if row.content_digest}
+        )
+        changes = []
+        for row in rows:
+            current = {column: getattr(row, column) for column in columns}
+            values = dict(current)
+            apply_frame_metadata(values, metadata.get(row.file_path, {}))
+            if values != current:
+                changes.append(dict({f'b_{column}': value for column, value in values.items()}, b_frame_id=row.frame_id))
+        if changes:
+            db.session.execute(statement, changes)
+        # The cache entries of the batch are committed with it
+        db.session.commit()
+        frames += len(rows)
+        changed += len(changes)
+    return frames, changed
+
+
+@click.command('refresh-frame-metadata')
+@click.option('--batch-size', default=1000, help='Frames read and updated per transaction.')
+@with_appcontext
+def refresh_frame_metadata_command(batch_size):
+    """Read the capture settings of every raw frame from its header again."""
+    from .storage import get_storage
+    started = time.monotonic()
+    frames, changed = refresh_frame_metadata(get_storage(), batch_size=batch_size)
+    click.echo(f'Read the headers of {frames} frames in {time.monotonic() - started:.1f}s, {changed} frames updated')
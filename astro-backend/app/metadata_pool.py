@@ -0,0 +1,119 @@
+"""Reading the headers of a finalize batch on a pool of worker processes.
+
+Header parsing (app/frame_metadata.py) is plain Python, so a session of
+thousands of frames used to keep one core busy while the others idled.
+read_frames_metadata() hands the frames of a batch to a ProcessPoolExecutor
+instead, FRAME_METADATA_CHUNK_SIZE paths per task so the pickling round
+trips don't eat the gain, and returns the results in one dict that
+create_frame_records() merges into its bulk insert.
+
+    FRAME_METADATA_WORKERS      processes, None for one per core, 0 to read inline
+    FRAME_METADATA_CHUNK_SIZE   paths sent to a worker at a time
+    FRAME_METADATA_MIN_BATCH    smaller batches are read inline, the pool isn't worth it
+
+The pool is started with the first batch big enough for it and kept for the
+life of the app process. Workers are forked from a forkserver that has only
+imported app.frame_metadata (spawned where there is no forkserver), never
+from the app process itself, whose request and job threads may hold locks.
+Frames on S3 are read with threads instead, the time goes into waiting for
+ranged GETs there, not into parsing. Headers parsed before are taken from
+the metadata cache (app/metadata_cache.py) and never reach the pool.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from .frame_metadata import read_file_metadata, read_stored_metadata
+from .metadata_cache import cache_key, lookup_cached, store_cached, trim_metadata_cache
+
+_pool_lock = threading.Lock()
+
+
+def metadata_workers():
+    workers = current_app.config.get('FRAME_METADATA_WORKERS')
+    if workers is None:
+        return os.cpu_count() or 1
+    return workers
+
+
+def worker_context():
+    """Start method of the pool workers: a forkserver with the header readers preloaded, where available"""
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['app.frame_metadata'])
+    return context
+
+
+def get_metadata_pool(workers):
+    """The process pool of this app process, started on first use"""
+    extensions = current_app.extensions
+    with _pool_lock:
+        pool = extensions.get('metadata_pool')
+        if pool is None:
+            pool = ProcessPoolExecutor(workers, mp_context=worker_context())
+            extensions['metadata_pool'] = pool
+    return pool
+
+
+def discard_metadata_pool(pool):
+    with _pool_lock:
+        if current_app.extensions.get('metadata_pool') is pool:
+            del current_app.extensions['metadata_pool']
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def read_frames_metadata(storage, keys, digests=None):
+    """{key: metadata} of the stored files keys (see app/frame_metadata.py).
+
+    digests ({key: content digest}, where known) are the cache keys of the
+    files, local files without one are cached by size, mtime and inode.
+    """
+    keys = list(dict.fromkeys(keys))
+    config = current_app.config
+    if not config.get('FRAME_METADATA_CACHE', True):
+        return read_headers(storage, keys)
+
+    digests = digests or {}
+    cache_keys = {key: cache_key(storage, key, digests.get(key)) for key in keys}
+    cached = lookup_cached([value for value in cache_keys.values() if value])
+    metadata = {key: cached[cache_keys[key]] for key in keys if cache_keys[key] in cached}
+    missing = [key for key in keys if key not in metadata]
+    if missing:
+        # Copies of the same file are read once
+        readers = {}
+        for key in missing:
+            readers.setdefault(cache_keys[key] or key, key)
+        read = read_headers(storage, list(readers.values()))
+        for key in missing:
+            metadata[key] = read[readers[cache_keys[key] or key]]
+        if store_cached({cache_keys[key]: read[key] for key in read if cache_keys[key]}):
+            trim_metadata_cache(config.get('FRAME_METADATA_CACHE_SIZE', 1000000))
+    return metadata
+
+
+def read_headers(storage, keys):
+    """{key: metadata} of the stored files keys, read inline or on the pool"""
+    config = current_app.config
+    workers = metadata_workers()
+    if workers <= 1 or len(keys) < config.get('FRAME_METADATA_MIN_BATCH', 64):
+        return {key: read_stored_metadata(storage, key) for key in keys}
+
+    if not storage.local:
+        with ThreadPoolExecutor(workers) as executor:
+            return dict(zip(keys, executor.map(lambda key: read_stored_metadata(storage, key), keys)))
+
+    pool = get_metadata_pool(workers)
+    paths = [storage.path(key) for key in keys]
+    try:
+        results = pool.map(read_file_metadata, paths, chunksize=config.get('FRAME_METADATA_CHUNK_SIZE', 16))
+        return dict(zip(keys, results))
+    except BrokenProcessPool as e:
+        # A worker died (killed, out of memory...), read this batch here and start afresh next time
+        print(f"Metadata pool failed, reading {len(keys)} headers inline: {str(e)}")
+        discard_metadata_pool(pool)
+        return {key: read_stored_metadata(storage, key) for key in keys}
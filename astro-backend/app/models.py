@@ -15,6 +15,7 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     name = db.Column(db.String(64), nullable=False)
     last_login = db.Column(db.DateTime, default=datetime.utcnow)
+    storage_quota = db.Column(db.BigInteger)  # bytes, None for STORAGE_QUOTA_BYTES
     
     images = db.relationship('Image', backref='user', lazy=True)
     sessions = db.relationship('Session', backref='user', lazy=True)
@@ -95,6 +96,8 @@ class Image(db.Model):
     aperture = db.Column(db.Float)
     focal_length = db.Column(db.Float)
     focus_score = db.Column(db.Float)
+    content_digest = db.Column(db.String(64), index=True)  # see app/digests.py
+    file_size = db.Column(db.BigInteger)  # bytes, counted in storage_usage
 
     objects = db.relationship('ImageObject', back_populates='image')
     gear_used = db.relationship('ImageGear', back_populates='image')
@@ -162,4 +165,89 @@ class RawFrame(db.Model):
     exposure_time = db.Column(db.Float)
     iso = db.Column(db.Integer)
     temperature = db.Column(db.Float)
-    capture_time = db.Column(db.DateTime)
\ No newline at end of file
+    capture_time = db.Column(db.DateTime)
+    content_digest = db.Column(db.String(64), index=True)  # see app/digests.py
+    file_size = db.Column(db.BigInteger)  # bytes, counted in storage_usage
+    # Read from the frame's header when it is registered (see app/frame_metadata.py)
+    gain = db.Column(db.Float)
+    filter_name = db.Column(db.String(50), index=True)
+    binning = db.Column(db.Integer)
+    camera_serial = db.Column(db.String(64), index=True)
+    lens = db.Column(db.String(100))
+
+# Chunked upload sessions, shared by every worker process
+class UploadSession(db.Model):
+    upload_id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.String(36), db.ForeignKey('user.user_id'), index=True)
+    file_name = db.Column(db.String(255))
+    file_size = db.Column(db.BigInteger)
+    file_type = db.Column(db.String(100))
+    upload_type = db.Column(db.String(50))
+    file_id = db.Column(db.String(100))
+    total_chunks = db.Column(db.Integer)
+    chunk_size = db.Column(db.BigInteger)
+    chunk_mode = db.Column(db.String(10))
+    chunk_folder = db.Column(db.Text)
+    chunk_bitmap = db.Column(db.LargeBinary)  # one bit per chunk, most significant bit first
+    received_chunks = db.Column(db.Integer, default=0)
+    received_bytes = db.Column(db.BigInteger, default=0)
+    is_complete = db.Column(db.Boolean, default=False)
+    final_path = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, index=True)
+    version = db.Column(db.Integer, default=0)  # bumped on every write, used for optimistic locking
+
+# Block digests of the chunks received so far, combined into the file digest on completion
+class UploadChunk(db.Model):
+    upload_id = db.Column(db.String(36), db.ForeignKey('upload_session.upload_id', ondelete='CASCADE'), primary_key=True)
+    chunk_index = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    block_digests = db.Column(db.LargeBinary)
+
+# Every file written under uploads/, with the digest computed while it was written
+class StoredFile(db.Model):
+    file_path = db.Column(db.String(500), primary_key=True)  # relative to the uploads folder
+    content_digest = db.Column(db.String(64), index=True)
+    file_size = db.Column(db.BigInteger)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Blob(db.Model):
+    content_digest = db.Column(db.String(64), primary_key=True)
+    file_path = db.Column(db.String(500), nullable=False, unique=True)  # relative to the uploads folder
+    file_size = db.Column(db.BigInteger)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Image/RawFrame rows pointing at the file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# Bytes stored per user and category, kept up to date incrementally (see app/storage_usage.py)
+class StorageUsage(db.Model):
+    user_id = db.Column(db.String(36), db.ForeignKey('user.user_id'), primary_key=True)
+    category = db.Column(db.String(20), primary_key=True)  # RawFrame.frame_type or 'image'
+    file_count = db.Column(db.BigInteger, nullable=False, default=0)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Header metadata already parsed, by file content (see app/metadata_cache.py)
+class FrameMetadataCache(db.Model):
+    cache_key = db.Column(db.String(120), primary_key=True)  # digest:<content digest> or stat:<dev>:<inode>:<size>:<mtime_ns>
+    reader_version = db.Column(db.Integer, nullable=False)  # frame_metadata.METADATA_VERSION that parsed it
+    fields = db.Column(db.Text, nullable=False)  # JSON
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# Background jobs, see app/jobs.py
+class Job(db.Model):
+    job_id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, failed
+    priority = db.Column(db.Integer, nullable=False, default=0)  # higher runs first
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    user_id = db.Column(db.String(36), db.ForeignKey('user.user_id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
@@ -0,0 +1,126 @@
+"""Streaming multipart/form-data parser that writes file parts straight to disk.
+
+request.files spools every part into a temporary file which then has to be
+copied to its final location, and keeps a file object per part open until the
+request ends. stream_multipart() reads the body in fixed size blocks instead
+and writes each file part directly into the folder it belongs in, hashing it
+on the way (see app/digests.py). Memory stays bounded by the block size plus
+the text fields, however many files the request carries.
+"""
+import os
+import uuid
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from werkzeug.utils import secure_filename
+
+from .chunk_io import COPY_BUFFER_SIZE
+from .digests import BlockHasher
+
+# Size of the blocks the request body is read in
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class StreamedFile:
+    """A file part that was written to disk while the request was read"""
+
+    def __init__(self, name, filename, path):
+        self.name = name
+        self.filename = filename
+        self.path = path
+        self.file_size = 0
+        self.content_digest = None
+        # Set by whoever moves the file to its final place (relative to the uploads folder)
+        self.relative_path = None
+
+
+def stream_multipart(stream, content_type, folder_for, max_size=None, max_form_memory=1024 * 1024, max_parts=None,
+                     on_file=None):
+    """Parse a multipart/form-data body from stream.
+
+    folder_for(field_name) returns the folder a file part should be written
+    to, or None to drop the part. on_file, if given, is called with the path
+    of every file part before it is created. Returns (form, files) as MultiDicts, with
+    StreamedFile values in files. Raises RequestEntityTooLarge once more than
+    max_size bytes were read, or a text field grows past max_form_memory;
+    files written so far are removed in that case (and on any other error).
+    """
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise ValueError('Expected a multipart/form-data body')
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=max_form_memory, max_parts=max_parts)
+    fields = []
+    files = []
+    current = None
+    buffer = []
+    field_size = 0
+    out = None
+    hasher = None
+    received = 0
+    finished = False
+
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if finished:
+                    raise ValueError('Multipart body ended early')
+                block = stream.read(READ_BLOCK_SIZE)
+                received += len(block)
+                if max_size is not None and received > max_size:
+                    raise RequestEntityTooLarge()
+                finished = not block
+                decoder.receive_data(block or None)
+                continue
+            if isinstance(event, Epilogue):
+                break
+
+            if isinstance(event, File):
+                current = event
+                folder = folder_for(event.name) if event.filename else None
+                if folder is None:
+                    out = None
+                    continue
+                os.makedirs(folder, exist_ok=True)
+                part = StreamedFile(event.name, event.filename, os.path.join(
+                    folder, f"{uuid.uuid4()}_{secure_filename(event.filename)}"
+                ))
+                files.append((event.name, part))
+                if on_file:
+                    on_file(part.path)
+                out = open(part.path, 'wb', buffering=COPY_BUFFER_SIZE)
+                hasher = BlockHasher()
+            elif isinstance(event, Field):
+                current = event
+                buffer = []
+                field_size = 0
+            elif isinstance(event, Data):
+                if isinstance(current, Field):
+                    field_size += len(event.data)
+                    if max_form_memory is not None and field_size > max_form_memory:
+                        raise RequestEntityTooLarge()
+                    buffer.append(event.data)
+                    if not event.more_data:
+                        fields.append((current.name, b''.join(buffer).decode('utf-8', 'replace')))
+                elif out is not None:
+                    out.write(event.data)
+                    hasher.update(event.data)
+                    if not event.more_data:
+                        out.close()
+                        out = None
+                        part = files[-1][1]
+                        part.file_size = os.path.getsize(part.path)
+                        part.content_digest = hasher.hexdigest()
+    except BaseException:
+        if out is not None:
+            out.close()
+        for _, part in files:
+            if os.path.exists(part.path):
+                os.remove(part.path)
+        raise
+
+    return MultiDict(fields), MultiDict(files)
@@ -0,0 +1,484 @@
+"""Where uploaded files are kept: the local uploads folder or S3-compatible object storage.
+
+Stored files are addressed by key, the path relative to the uploads folder
+that rows keep in file_path (blobs/aa/bb/<digest>.fits,
+lightFrames/3f/a2/<uuid>_<name>, ...). The same keys work with every
+backend, so moving the archive means copying the objects, not rewriting rows.
+
+Uploads are still received into local files (chunk folders, streamed
+finalize parts) and handed over with put_file() once they are complete:
+
+    storage = get_storage()
+    storage.put_file(key, local_path)          # moved (or uploaded) into place
+    with storage.open_writer(key) as out:      # or streamed, in parts for S3
+        out.write(block)
+    storage.send(key, mimetype)                # download response, honours Range
+    with storage.local_copy(key) as path:      # for code that needs a real file
+        ...
+
+STORAGE_BACKEND picks the backend: 'local' (FINAL_UPLOAD_FOLDER) or 's3'
+(STORAGE_S3_BUCKET on AWS, MinIO, Ceph... needs the boto3 package).
+"""
+import io
+import os
+import tempfile
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import click
+from flask import Response, current_app, request, send_file, stream_with_context
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from .chunk_io import COPY_BUFFER_SIZE, publish
+from .upload_layout import resolve_upload_path
+
+# S3 won't take parts smaller than this (except the last one)
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def _read_blocks(f, length=None):
+    """Yield blocks from a file object, at most length bytes in total"""
+    while length is None or length > 0:
+        block = f.read(COPY_BUFFER_SIZE if length is None else min(COPY_BUFFER_SIZE, length))
+        if not block:
+            break
+        if length is not None:
+            length -= len(block)
+        yield block
+
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable read-only file over an S3 object, every read is a ranged GET.
+
+    Wrapped in a BufferedReader by S3Storage.open(), so reading a header
+    a few bytes at a time costs one request per buffer.
+    """
+
+    def __init__(self, client, bucket, key, size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        body = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={self.position}-{end}')['Body']
+        data = body.read()
+        body.close()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class LocalWriter:
+    """Streaming write to a local file, only visible under its key once committed"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        self._file = open(self._temp_path, 'wb', buffering=COPY_BUFFER_SIZE)
+        self.size = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class LocalStorage:
+    """Files under a folder on this machine (the default)"""
+
+    local = True
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        """Filesystem path of key (under whichever layout it is in, see app/upload_layout.py)"""
+        return resolve_upload_path(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def size(self, key):
+        """Size in bytes, None if there is no such file"""
+        try:
+            return os.path.getsize(self.path(key))
+        except OSError:
+            return None
+
+    def mtime(self, key):
+        """Last modification time as a timestamp, None if there is no such file"""
+        try:
+            return os.path.getmtime(self.path(key))
+        except OSError:
+            return None
+
+    def touch(self, key):
+        """Set the modification time of key to now, False if there is no such file"""
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_file(self, key, src_path, keep_source=False):
+        """Store the local file src_path under key (moved, unless keep_source is set)"""
+        dst_path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        if not keep_source:
+            publish(src_path, dst_path)
+            return
+        try:
+            os.link(src_path, dst_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            with open(src_path, 'rb') as f, LocalWriter(dst_path) as out:
+                for block in _read_blocks(f):
+                    out.write(block)
+
+    def open_writer(self, key):
+        return LocalWriter(os.path.join(self.root, key))
+
+    def open(self, key):
+        """Seekable binary file object for reading key"""
+        return open(self.path(key), 'rb')
+
+    def iter_range(self, key, start=0, end=None):
+        """Yield the bytes start..end (inclusive, None for the end of the file) of key"""
+        with open(self.path(key), 'rb') as f:
+            f.seek(start)
+            yield from _read_blocks(f, None if end is None else end - start + 1)
+
+    def delete(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def move(self, key, new_key):
+        new_path = os.path.join(self.root, new_key)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(self.path(key), new_path)
+
+    def iter_files(self, skip=(), threads=8, folder=None):
+        """Yield (key, size, mtime) of every file, walking the folders in parallel.
+
+        Top level folders in skip are left out, or only folder is walked if given.
+        """
+        def scan(folder):
+            files = []
+            folders = []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if folder != self.root or entry.name not in skip:
+                                folders.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat()
+                            files.append((os.path.relpath(entry.path, self.root).replace(os.sep, '/'), st.st_size, st.st_mtime))
+            except FileNotFoundError:
+                pass
+            return files, folders
+
+        with ThreadPoolExecutor(max(threads, 1)) as pool:
+            pending = {pool.submit(scan, os.path.join(self.root, folder) if folder else self.root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, folders = future.result()
+                    pending.update(pool.submit(scan, folder) for folder in folders)
+                    yield from files
+
+    @contextmanager
+    def local_copy(self, key):
+        yield self.path(key)
+
+    def send(self, key, mimetype=None, download_name=None):
+        # send_file answers Range and conditional requests itself
+        return send_file(self.path(key), mimetype=mimetype, download_name=download_name, conditional=True)
+
+
+class S3Writer:
+    """Streaming write to S3. Data goes up in part_size parts through a multipart
+    upload, small objects in a single PUT. Nothing is visible until commit()."""
+
+    def __init__(self, client, bucket, key, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.size = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self._parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=number, Body=bytes(data)
+        )
+        self._parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+
+    def commit(self):
+        if self._upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            return
+        if self._buffer:
+            self._upload_part(self._buffer)
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts}
+        )
+
+    def abort(self):
+        if self._upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, keys optionally under a prefix"""
+
+    local = False
+
+    def __init__(self, client, bucket, prefix='', part_size=64 * 1024 * 1024):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.part_size = part_size
+
+    def object_key(self, key):
+        return self.prefix + key.replace('\\', '/')
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        head = self._head(key)
+        return head['ContentLength'] if head is not None else None
+
+    def mtime(self, key):
+        head = self._head(key)
+        return head['LastModified'].timestamp() if head is not None else None
+
+    def touch(self, key):
+        # LastModified only changes when the object is written again, so this
+        # just checks it is there (Blob.last_used_at is what counts on S3)
+        return self.exists(key)
+
+    def put_file(self, key, src_path, keep_source=False):
+        with open(src_path, 'rb') as f, self.open_writer(key) as out:
+            for block in _read_blocks(f):
+                out.write(block)
+        if not keep_source:
+            os.remove(src_path)
+
+    def open_writer(self, key):
+        return S3Writer(self.client, self.bucket, self.object_key(key), self.part_size)
+
+    def open(self, key, buffer_size=64 * 1024):
+        """Seekable binary file object for reading key, fetched buffer_size bytes at a time"""
+        size = self.size(key)
+        if size is None:
+            raise FileNotFoundError(key)
+        return io.BufferedReader(S3RangeReader(self.client, self.bucket, self.object_key(key), size), buffer_size)
+
+    def iter_range(self, key, start=0, end=None):
+        byte_range = f'bytes={start}-{"" if end is None else end}'
+        body = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key), Range=byte_range)['Body']
+        try:
+            yield from _read_blocks(body)
+        finally:
+            body.close()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def move(self, key, new_key):
+        # Managed copy, objects over 5 GB are copied in parts
+        self.client.copy({'Bucket': self.bucket, 'Key': self.object_key(key)}, self.bucket, self.object_key(new_key))
+        self.delete(key)
+
+    def iter_files(self, skip=(), threads=8, folder=None):
+        """Yield (key, size, mtime) of every object under the prefix (or under folder in it),
+        top level folders in skip left out"""
+        prefix = self.prefix + folder.strip('/') + '/' if folder else self.prefix
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key'][len(self.prefix):]
+                if key.split('/', 1)[0] in skip:
+                    continue
+                yield key, obj['Size'], obj['LastModified'].timestamp()
+
+    @contextmanager
+    def local_copy(self, key):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.client.download_fileobj(self.bucket, self.object_key(key), f)
+            yield path
+        finally:
+            os.remove(path)
+
+    def send(self, key, mimetype=None, download_name=None):
+        size = self.size(key)
+        if size is None:
+            raise FileNotFoundError(key)
+        headers = {'Accept-Ranges': 'bytes'}
+        if download_name:
+            headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+        byte_range = request.range.range_for_length(size) if request.range else None
+        if byte_range is None:
+            start, stop, status = 0, size, 200
+        else:
+            (start, stop), status = byte_range, 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        if stop == start:
+            return Response(b'', status=status, mimetype=mimetype, headers=headers)
+        body = self.iter_range(key, start, stop - 1)
+        return Response(stream_with_context(body), status=status, mimetype=mimetype, headers=headers)
+
+
+def make_storage(config, local_root):
+    """The backend configured in config, local files under local_root by default"""
+    if config.get('STORAGE_BACKEND', 'local') == 's3':
+        import boto3  # optional dependency, only needed for this backend
+        client = boto3.client(
+            's3',
+            endpoint_url=config.get('STORAGE_S3_ENDPOINT_URL'),
+            region_name=config.get('STORAGE_S3_REGION'),
+            aws_access_key_id=config.get('STORAGE_S3_ACCESS_KEY_ID'),
+            aws_secret_access_key=config.get('STORAGE_S3_SECRET_ACCESS_KEY')
+        )
+        return S3Storage(
+            client, config['STORAGE_S3_BUCKET'],
+            prefix=config.get('STORAGE_S3_PREFIX') or '',
+            part_size=config.get('STORAGE_S3_PART_SIZE', 64 * 1024 * 1024)
+        )
+    return LocalStorage(local_root)
+
+
+def get_storage():
+    """Return the storage backend configured for the current app"""
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        from api import FINAL_UPLOAD_FOLDER
+        storage = make_storage(current_app.config, FINAL_UPLOAD_FOLDER)
+        current_app.extensions['storage'] = storage
+    return storage
+
+
+def stored_keys(batch_size=1000):
+    """Every key a row points at (blobs, stored files, images and frames)"""
+    from . import db
+    from .models import Blob, Image, RawFrame, StoredFile
+    for column in (Blob.file_path, StoredFile.file_path, Image.file_path, RawFrame.file_path):
+        for key in db.session.execute(select(column).distinct().where(column.isnot(None))).yield_per(batch_size).scalars():
+            if '://' not in key and not os.path.isabs(key):
+                yield key
+
+
+def copy_stored_files(source, target, keys):
+    """Copy keys from one backend to another, skipping what the target has already.
+
+    Returns (files_copied, bytes_copied).
+    """
+    copied = 0
+    copied_bytes = 0
+    for key in keys:
+        if target.exists(key) or not source.exists(key):
+            continue
+        with target.open_writer(key) as out:
+            for block in source.iter_range(key):
+                out.write(block)
+        copied += 1
+        copied_bytes += out.size
+    return copied, copied_bytes
+
+
+@click.command('copy-uploads')
+@click.option('--to', 'backend', type=click.Choice(['local', 's3']), required=True, help='Backend to copy to.')
+@click.option('--local-root', default=None, help='Folder to copy to with --to local.')
+@with_appcontext
+def copy_uploads_command(backend, local_root):
+    """Copy every stored file from the configured storage backend to another one.
+
+    Keys stay the same, so switch STORAGE_BACKEND once it is done. Files
+    uploaded meanwhile are picked up by running it again.
+    """
+    from api import FINAL_UPLOAD_FOLDER
+    source = get_storage()
+    target = make_storage(dict(current_app.config, STORAGE_BACKEND=backend), local_root or FINAL_UPLOAD_FOLDER)
+    copied, copied_bytes = copy_stored_files(source, target, stored_keys())
+    click.echo(f'Copied {copied} files ({copied_bytes} bytes)')
@@ -0,0 +1,208 @@
+"""Per-user storage accounting and quotas.
+
+The size of every upload is recorded when it is written (StoredFile.file_size)
+and copied onto the Image/RawFrame row that points at it. storage_usage keeps
+one row per (user, category) with the file count and bytes of those rows, and
+is updated in the same transaction whenever one is created, moved or deleted:
+
+    changes = UsageChanges()
+    changes.add(user_id, 'light', file_size)      # a new light frame
+    changes.remove(user_id, 'image', file_size)   # a deleted main image
+    changes.apply()                                # one UPDATE per touched row
+
+Categories are the RawFrame.frame_type values, plus 'image' for main images.
+Usage counts the bytes a user uploaded, whether or not the blob store shares
+the file with someone else, so a user's usage never depends on other users.
+
+Reading a user's usage is a primary key lookup of a handful of rows, which is
+what the quota checks at /chunk-upload/init, /chunk-upload/complete and
+/finalize-upload do (together with the sizes of the user's chunked uploads
+that aren't registered yet). `flask rebuild-storage-usage` recomputes the
+table (and the missing sizes) from scratch.
+"""
+from collections import defaultdict
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .models import FrameSet, Image, RawFrame, StorageUsage, StoredFile
+from .upload_sessions import get_upload_store
+
+# Category of main images (raw frames use their frame_type)
+IMAGE_CATEGORY = 'image'
+
+
+class UsageChanges:
+    """Usage deltas collected while rows change, written with apply()"""
+
+    def __init__(self):
+        # (user_id, category) -> [file count delta, bytes delta]
+        self.deltas = defaultdict(lambda: [0, 0])
+
+    def add(self, user_id, category, file_size, count=1):
+        if user_id is None:
+            return
+        delta = self.deltas[(user_id, category or 'unknown')]
+        delta[0] += count
+        delta[1] += (file_size or 0) * count
+
+    def remove(self, user_id, category, file_size, count=1):
+        self.add(user_id, category, file_size, -count)
+
+    def apply(self):
+        """Add the deltas to storage_usage within the current db.session transaction"""
+        table = StorageUsage.__table__
+        now = datetime.utcnow()
+        for (user_id, category), (files, size) in self.deltas.items():
+            if not files and not size:
+                continue
+            values = dict(
+                file_count=table.c.file_count + files,
+                total_bytes=table.c.total_bytes + size,
+                updated_at=now
+            )
+            where = (table.c.user_id == user_id, table.c.category == category)
+            if db.session.execute(update(table).where(*where).values(**values)).rowcount:
+                continue
+            try:
+                # First file of this kind for the user, unless another request just added the row
+                with db.session.begin_nested():
+                    db.session.add(StorageUsage(
+                        user_id=user_id, category=category,
+                        file_count=files, total_bytes=size, updated_at=now
+                    ))
+            except IntegrityError:
+                db.session.execute(update(table).where(*where).values(**values))
+        self.deltas.clear()
+
+
+def stored_file_info(storage, file_paths, batch_size=500):
+    """({path: content digest}, {path: size}) recorded for file_paths when they were uploaded.
+
+    Sizes of files uploaded before sizes were recorded come from storage.
+    """
+    file_paths = list({path for path in file_paths if path})
+    digests = {}
+    sizes = {}
+    for start in range(0, len(file_paths), batch_size):
+        rows = db.session.execute(
+            select(StoredFile.file_path, StoredFile.content_digest, StoredFile.file_size)
+            .where(StoredFile.file_path.in_(file_paths[start:start + batch_size]))
+        ).all()
+        digests.update({row.file_path: row.content_digest for row in rows})
+        sizes.update({row.file_path: row.file_size for row in rows if row.file_size is not None})
+    for path in file_paths:
+        if path not in sizes and '://' not in path:
+            size = storage.size(path)
+            if size is not None:
+                sizes[path] = size  # files that went missing count as 0 bytes
+    return digests, sizes
+
+
+def stored_file_sizes(storage, file_paths, batch_size=500):
+    """Sizes recorded for file_paths when they were uploaded, from storage for anything older"""
+    return stored_file_info(storage, file_paths, batch_size)[1]
+
+
+def frameset_owner(frameset_id):
+    """user_id of the image a frame set belongs to"""
+    if not frameset_id:
+        return None
+    return db.session.execute(
+        select(Image.user_id).join(FrameSet, FrameSet.image_id == Image.image_id)
+        .where(FrameSet.frameset_id == frameset_id)
+    ).scalar()
+
+
+def usage_for(user_id):
+    """{category: {'files': n, 'bytes': n}} for one user"""
+    rows = db.session.execute(
+        select(StorageUsage.category, StorageUsage.file_count, StorageUsage.total_bytes)
+        .where(StorageUsage.user_id == user_id)
+    ).all()
+    return {row.category: {'files': row.file_count, 'bytes': row.total_bytes} for row in rows}
+
+
+def quota_for(user):
+    """Bytes the user may store, None for no limit"""
+    if user is not None and user.storage_quota is not None:
+        return user.storage_quota
+    return current_app.config.get('STORAGE_QUOTA_BYTES')
+
+
+def check_quota(user, extra_bytes, upload_ids=()):
+    """(fits, used_bytes, quota) for storing extra_bytes more.
+
+    Chunked uploads the user has in progress, or completed but not finalized
+    yet, count as used, so parallel uploads can't each fit on their own and
+    overshoot together. upload_ids are the uploads extra_bytes already
+    includes, they aren't counted twice.
+    """
+    quota = quota_for(user)
+    if quota is None:
+        return True, None, None
+    used = db.session.execute(
+        select(func.coalesce(func.sum(StorageUsage.total_bytes), 0))
+        .where(StorageUsage.user_id == user.user_id)
+    ).scalar()
+    used += get_upload_store().pending_bytes(user.user_id, exclude=upload_ids)
+    return used + max(extra_bytes or 0, 0) <= quota, used, quota
+
+
+def rebuild_storage_usage(storage, batch_size=500):
+    """Fill in missing Image/RawFrame sizes and recompute storage_usage from the rows.
+
+    Returns the number of sizes that were filled in.
+    """
+    filled = 0
+    for model, key in ((Image, Image.image_id), (RawFrame, RawFrame.frame_id)):
+        while True:
+            rows = db.session.execute(
+                select(key, model.file_path)
+                .where(model.file_size.is_(None), model.file_path.isnot(None))
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            sizes = stored_file_sizes(storage, [row.file_path for row in rows])
+            for row in rows:
+                db.session.execute(
+                    update(model.__table__).where(key == row[0])
+                    .values(file_size=sizes.get(row.file_path, 0))
+                )
+            db.session.commit()
+            filled += len(rows)
+
+    changes = UsageChanges()
+    for user_id, files, size in db.session.execute(
+        select(Image.user_id, func.count(), func.sum(Image.file_size)).group_by(Image.user_id)
+    ):
+        changes.deltas[(user_id, IMAGE_CATEGORY)] = [files, size or 0]
+    for user_id, category, files, size in db.session.execute(
+        select(Image.user_id, RawFrame.frame_type, func.count(), func.sum(RawFrame.file_size))
+        .join(FrameSet, FrameSet.frameset_id == RawFrame.frameset_id)
+        .join(Image, Image.image_id == FrameSet.image_id)
+        .group_by(Image.user_id, RawFrame.frame_type)
+    ):
+        changes.deltas[(user_id, category or 'unknown')] = [files, size or 0]
+
+    StorageUsage.query.delete()
+    changes.apply()
+    db.session.commit()
+    return filled
+
+
+@click.command('rebuild-storage-usage')
+@click.option('--batch-size', default=500, help='Rows updated per transaction.')
+@with_appcontext
+def rebuild_storage_usage_command(batch_size):
+    """Recompute per-user storage usage from the image and frame rows."""
+    from .storage import get_storage
+    filled = rebuild_storage_usage(get_storage(), batch_size=batch_size)
+    users = db.session.execute(select(func.count(func.distinct(StorageUsage.user_id)))).scalar()
+    click.echo(f'Filled in {filled} file sizes, usage recomputed for {users} users')
@@ -0,0 +1,252 @@
+"""Fair-share admission control for the upload routes.
+
+Every upload request has to be admitted before it touches the disk:
+
+    - a user has at most UPLOAD_MAX_CONCURRENT_PER_USER requests in flight, and
+      fewer once other users are uploading too (the UPLOAD_MAX_CONCURRENT slots
+      are shared out evenly between the users that want them)
+    - a token bucket per user limits the bytes/sec one user can push
+      (UPLOAD_USER_BYTES_PER_SEC, bursts up to UPLOAD_USER_BURST_BYTES)
+    - a global token bucket keeps all uploads together within the disk I/O
+      budget (UPLOAD_IO_BYTES_PER_SEC / UPLOAD_IO_BURST_BYTES)
+
+A request that can't start right away waits in a queue for up to
+UPLOAD_ADMISSION_MAX_WAIT seconds. If it still can't start it is answered with
+429 (the user's own limits) or 503 (the server-wide ones) and a Retry-After
+header, so the client backs off instead of piling more work onto the disk.
+
+The limits apply per app process, like the upload janitor and the job workers.
+"""
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, jsonify, request
+
+# Why a request was refused -> HTTP status
+REFUSAL_STATUS = {
+    'user_concurrency': 429,
+    'user_bandwidth': 429,
+    'global_concurrency': 503,
+    'global_io': 503
+}
+
+
+class TokenBucket:
+    """Bytes/sec limiter. A request larger than the bucket is let through once it
+    is full and leaves it in debt, so the requests after it wait for the refill."""
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """Seconds until amount bytes may pass (0 if they may now)"""
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= amount
+
+
+class AdmissionController:
+    """Decides which upload requests may run now, see the module docstring"""
+
+    def __init__(self, max_per_user=0, max_total=0, user_rate=0, user_burst=0,
+                 io_rate=0, io_burst=0, max_wait=5, retry_after=2):
+        self.max_per_user = max_per_user
+        self.max_total = max_total
+        self.user_rate = user_rate
+        self.user_burst = user_burst or user_rate
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.io_bucket = TokenBucket(io_rate, io_burst or io_rate) if io_rate else None
+        self._cond = threading.Condition()
+        self._active = {}   # user_id -> requests in flight
+        self._waiting = {}  # user_id -> requests queued
+        self._buckets = {}  # user_id -> TokenBucket
+        self._admitted = 0
+        self._refused = dict.fromkeys(REFUSAL_STATUS, 0)
+
+    def _user_limit(self, user_id):
+        """How many requests this user may have in flight, given who else is uploading"""
+        limit = self.max_per_user
+        if self.max_total:
+            users = len(set(self._active) | set(self._waiting) | {user_id})
+            share = max(1, self.max_total // users)
+            limit = min(limit, share) if limit else share
+        return limit
+
+    def _user_bucket(self, user_id, now):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        return bucket
+
+    def _blocked(self, user_id, nbytes, now):
+        """None if the request can start now, else (reason, seconds to wait or None if unknown)"""
+        limit = self._user_limit(user_id)
+        if limit and self._active.get(user_id, 0) >= limit:
+            return 'user_concurrency', None
+        if self.max_total and sum(self._active.values()) >= self.max_total:
+            return 'global_concurrency', None
+        if self.user_rate and nbytes:
+            delay = self._user_bucket(user_id, now).delay(nbytes, now)
+            if delay:
+                return 'user_bandwidth', delay
+        if self.io_bucket and nbytes:
+            delay = self.io_bucket.delay(nbytes, now)
+            if delay:
+                return 'global_io', delay
+        return None
+
+    def acquire(self, user_id, nbytes=0):
+        """Wait for the request to be admitted.
+
+        Returns None once it is (call release() when it's done), or
+        (reason, retry_after_seconds) if it couldn't start within max_wait.
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            self._waiting[user_id] = self._waiting.get(user_id, 0) + 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    blocked = self._blocked(user_id, nbytes, now)
+                    if blocked is None:
+                        break
+                    reason, delay = blocked
+                    remaining = deadline - now
+                    if remaining <= 0 or (delay is not None and delay > remaining):
+                        self._refused[reason] += 1
+                        retry_after = delay if delay is not None else self.retry_after
+                        return reason, max(1, math.ceil(retry_after))
+                    # Woken early by release() when a slot frees up
+                    self._cond.wait(min(delay, remaining) if delay is not None else remaining)
+            finally:
+                self._waiting[user_id] -= 1
+                if not self._waiting[user_id]:
+                    del self._waiting[user_id]
+
+            now = time.monotonic()
+            if self.user_rate and nbytes:
+                self._user_bucket(user_id, now).take(nbytes, now)
+            if self.io_bucket and nbytes:
+                self.io_bucket.take(nbytes, now)
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            self._admitted += 1
+            return None
+
+    def release(self, user_id):
+        with self._cond:
+            self._active[user_id] -= 1
+            if not self._active[user_id]:
+                del self._active[user_id]
+                # A full bucket is the same as a new one, no need to keep it around
+                bucket = self._buckets.get(user_id)
+                if bucket is not None and user_id not in self._waiting:
+                    bucket._refill(time.monotonic())
+                    if bucket.tokens >= bucket.capacity:
+                        del self._buckets[user_id]
+            self._cond.notify_all()
+
+    def stats(self, user_id=None):
+        """Current queue depths and counters for monitoring"""
+        with self._cond:
+            now = time.monotonic()
+            stats = {
+                'active': sum(self._active.values()),
+                'queued': sum(self._waiting.values()),
+                'activeUsers': len(self._active),
+                'queuedUsers': len(self._waiting),
+                'maxQueuedPerUser': max(self._waiting.values(), default=0),
+                'admitted': self._admitted,
+                'refused': dict(self._refused),
+                'ioTokens': None,
+                'limits': {
+                    'maxConcurrentPerUser': self.max_per_user,
+                    'maxConcurrent': self.max_total,
+                    'userBytesPerSec': self.user_rate,
+                    'ioBytesPerSec': self.io_bucket.rate if self.io_bucket else 0,
+                    'maxWait': self.max_wait
+                }
+            }
+            if self.io_bucket:
+                self.io_bucket._refill(now)
+                stats['ioTokens'] = int(self.io_bucket.tokens)
+            if user_id is not None:
+                stats['user'] = {
+                    'active': self._active.get(user_id, 0),
+                    'queued': self._waiting.get(user_id, 0),
+                    'limit': self._user_limit(user_id)
+                }
+            return stats
+
+
+def make_admission_controller(config):
+    """The controller for these settings, None if every limit is turned off"""
+    controller = AdmissionController(
+        max_per_user=config.get('UPLOAD_MAX_CONCURRENT_PER_USER', 0),
+        max_total=config.get('UPLOAD_MAX_CONCURRENT', 0),
+        user_rate=config.get('UPLOAD_USER_BYTES_PER_SEC', 0),
+        user_burst=config.get('UPLOAD_USER_BURST_BYTES', 0),
+        io_rate=config.get('UPLOAD_IO_BYTES_PER_SEC', 0),
+        io_burst=config.get('UPLOAD_IO_BURST_BYTES', 0),
+        max_wait=config.get('UPLOAD_ADMISSION_MAX_WAIT', 5),
+        retry_after=config.get('UPLOAD_ADMISSION_RETRY_AFTER', 2)
+    )
+    if not (controller.max_per_user or controller.max_total or controller.user_rate or controller.io_bucket):
+        return None
+    return controller
+
+
+def init_upload_admission(app):
+    controller = make_admission_controller(app.config)
+    app.extensions['upload_admission'] = controller
+    return controller
+
+
+def get_admission_controller():
+    return current_app.extensions.get('upload_admission')
+
+
+def admission_controlled(f):
+    """Only run the (token_required) upload route once the request is admitted.
+
+    The request is charged its Content-Length against the bandwidth buckets.
+    """
+    @wraps(f)
+    def decorated(current_user, *args, **kwargs):
+        controller = get_admission_controller()
+        if controller is None:
+            return f(current_user, *args, **kwargs)
+
+        user_id = current_user.user_id if current_user else None
+        refused = controller.acquire(user_id, request.content_length or 0)
+        if refused:
+            reason, retry_after = refused
+            response = jsonify({
+                'error': 'The server is busy with other uploads, try again later',
+                'reason': reason,
+                'retryAfter': retry_after
+            })
+            response.status_code = REFUSAL_STATUS[reason]
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        try:
+            return f(current_user, *args, **kwargs)
+        finally:
+            controller.release(user_id)
+
+    return decorated
@@ -0,0 +1,260 @@
+"""Mark-and-sweep garbage collection of stored files.
+
+Deleting an image or frame only removes its row, and uploads that were never
+finalized leave their files behind too. collect_garbage() finds the files no
+row needs any more:
+
+    1. mark   - the file_path of every Image and RawFrame row, and of the blobs
+                still referenced (or used within the grace period), is streamed
+                in primary key order, a batch per short transaction, into a
+                KeySet of 8 byte hashes
+    2. sweep  - the storage backend is walked (local folders in parallel) and
+                every file that isn't marked and is older than the grace period
+                is an orphan
+    3. orphans are handled in batches: their StoredFile rows go first, so no
+       new upload can be pointed at them, then they are checked against the
+       rows once more and quarantined (moved to .quarantine/<date>/) or deleted.
+       Right before that, blobs are checked for an upload that reused them
+       since the run started (see touch_blob() in app/blobstore.py); in
+       quarantine mode a local blob reused while it was being moved is put back.
+
+Files are marked under both their flat and sharded names (see
+app/upload_layout.py), so rows from before `flask shard-uploads` keep their
+files. `flask gc-uploads` runs it, quarantined files are removed for good
+after UPLOAD_GC_QUARANTINE_DAYS.
+"""
+import hashlib
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import or_, select
+
+from . import db
+from .blobstore import is_blob_path
+from .models import Blob, Image, RawFrame, StoredFile
+from .upload_journal import JOURNAL_FOLDER
+from .upload_layout import is_flat_path, to_flat, to_sharded
+
+# Top level folder (inside the uploads folder) orphans are moved to
+QUARANTINE_FOLDER = '.quarantine'
+
+
+class KeySet:
+    """Set of stored file keys, kept as 64 bit hashes instead of strings.
+
+    A hash collision can only make an orphan look referenced, so it is kept,
+    never the other way round.
+    """
+
+    def __init__(self):
+        self._hashes = set()
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def add(self, key):
+        self._hashes.add(self._hash(key))
+
+    def __contains__(self, key):
+        return self._hash(key) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+
+def layouts(key):
+    """key under every layout a row may know it by"""
+    key = key.replace('\\', '/')
+    if is_flat_path(key):
+        return [key, to_sharded(key)]
+    flat = to_flat(key)
+    return [key, flat] if flat else [key]
+
+
+def _stream_column(pk, column, where=None, batch_size=5000):
+    """Yield the non-null values of column, a batch per transaction in primary key order"""
+    after = ''
+    while True:
+        query = select(pk, column).where(pk > after, column.isnot(None)).order_by(pk).limit(batch_size)
+        if where is not None:
+            query = query.where(where)
+        rows = db.session.execute(query).all()
+        # End the read transaction, so the collector never holds the database for long
+        db.session.rollback()
+        if not rows:
+            return
+        after = rows[-1][0]
+        for row in rows:
+            yield row[1]
+
+
+def blob_in_use(cutoff):
+    """Blobs referenced by a row, or too recently used to be collected"""
+    return or_(Blob.ref_count > 0, Blob.last_used_at >= cutoff)
+
+
+def mark_referenced(cutoff, batch_size=5000):
+    """KeySet of every key a row needs"""
+    marked = KeySet()
+    columns = (
+        (Image.image_id, Image.file_path, None),
+        (RawFrame.frame_id, RawFrame.file_path, None),
+        (Blob.content_digest, Blob.file_path, blob_in_use(cutoff))
+    )
+    for pk, column, where in columns:
+        for key in _stream_column(pk, column, where, batch_size):
+            if '://' in key:
+                continue
+            for name in layouts(key):
+                marked.add(name)
+    return marked
+
+
+def still_referenced(keys, cutoff, batch_size=400):
+    """The keys of keys some row points at right now"""
+    names = {name: key for key in keys for name in layouts(key)}
+    name_list = list(names)
+    found = set()
+    for start in range(0, len(name_list), batch_size):
+        batch = name_list[start:start + batch_size]
+        for column in (Image.file_path, RawFrame.file_path):
+            found.update(db.session.execute(select(column).where(column.in_(batch))).scalars())
+        found.update(db.session.execute(
+            select(Blob.file_path).where(Blob.file_path.in_(batch), blob_in_use(cutoff))
+        ).scalars())
+    return {names[name] for name in found}
+
+
+def blob_touched_since(storage, key, started, started_ts):
+    """Whether an upload reused the blob stored at key after the run started"""
+    last_used_at = db.session.execute(select(Blob.last_used_at).where(Blob.file_path == key)).scalar()
+    if last_used_at is not None and last_used_at >= started:
+        return True
+    mtime = storage.mtime(key)
+    return mtime is not None and mtime >= started_ts
+
+
+def _sweep_batch(storage, orphans, cutoff, started, started_ts, mode, quarantine_prefix, report):
+    keys = [key for key, _ in orphans]
+    # No new upload can find these through their digest from now on
+    StoredFile.query.filter(StoredFile.file_path.in_(keys)).delete(synchronize_session=False)
+    db.session.commit()
+
+    referenced = still_referenced(keys, cutoff)
+    removed = []
+    for key, size in orphans:
+        is_blob = is_blob_path(key)
+        if key in referenced or (is_blob and blob_touched_since(storage, key, started, started_ts)):
+            report['rescued'] += 1
+            continue
+        if mode == 'quarantine':
+            quarantined = f'{quarantine_prefix}/{key}'
+            storage.move(key, quarantined)
+            if is_blob and storage.local and (storage.mtime(quarantined) or 0) >= started_ts:
+                # Reused between the check and the move, the rename kept the new mtime
+                storage.move(quarantined, key)
+                report['rescued'] += 1
+                continue
+        else:
+            storage.delete(key)
+        removed.append(key)
+        report['orphans'] += 1
+        report['orphanBytes'] += size
+
+    # Blob rows of collected blobs (their ref_count was 0)
+    if removed:
+        Blob.query.filter(
+            Blob.file_path.in_(removed), Blob.ref_count <= 0,
+            or_(Blob.last_used_at.is_(None), Blob.last_used_at < started)
+        ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def collect_garbage(storage, grace_period=timedelta(days=1), mode='quarantine', batch_size=500,
+                    threads=8, dry_run=False):
+    """Find the stored files nothing needs and quarantine or delete them.
+
+    mode is 'quarantine' or 'delete'. Only files older than grace_period
+    (counted from the start of the run) are touched, so uploads that are
+    still being finalized are safe. Returns a report of the run.
+    """
+    started = datetime.utcnow()
+    started_ts = time.time()
+    cutoff = started - grace_period
+    cutoff_ts = time.time() - grace_period.total_seconds()
+    report = {
+        'marked': 0, 'scanned': 0, 'orphans': 0, 'orphanBytes': 0, 'rescued': 0,
+        'mode': 'dry-run' if dry_run else mode
+    }
+
+    marked = mark_referenced(cutoff)
+    report['marked'] = len(marked)
+
+    quarantine_prefix = f"{QUARANTINE_FOLDER}/{started.strftime('%Y%m%d-%H%M%S')}"
+    batch = []
+    for key, size, mtime in storage.iter_files(skip=(JOURNAL_FOLDER, QUARANTINE_FOLDER), threads=threads):
+        report['scanned'] += 1
+        if mtime >= cutoff_ts or key in marked:
+            continue
+        if dry_run:
+            report['orphans'] += 1
+            report['orphanBytes'] += size
+            continue
+        batch.append((key, size))
+        if len(batch) >= batch_size:
+            _sweep_batch(storage, batch, cutoff, started, started_ts, mode, quarantine_prefix, report)
+            batch = []
+    if batch:
+        _sweep_batch(storage, batch, cutoff, started, started_ts, mode, quarantine_prefix, report)
+    return report
+
+
+def purge_quarantine(storage, older_than=timedelta(days=7), threads=8):
+    """Delete quarantined files that have been there longer than older_than, returns (files, bytes)"""
+    cutoff = (datetime.utcnow() - older_than).strftime('%Y%m%d-%H%M%S')
+    purged = 0
+    freed = 0
+    for key, size, _ in storage.iter_files(threads=threads, folder=QUARANTINE_FOLDER):
+        parts = key.split('/', 2)
+        if len(parts) < 3 or parts[1] >= cutoff:
+            continue
+        storage.delete(key)
+        purged += 1
+        freed += size
+    return purged, freed
+
+
+@click.command('gc-uploads')
+@click.option('--delete', 'delete_orphans', is_flag=True, help='Delete orphans instead of quarantining them.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be collected.')
+@click.option('--grace-hours', default=None, type=float, help='Leave files younger than this alone.')
+@click.option('--batch-size', default=500, help='Orphans handled per transaction.')
+@click.option('--threads', default=8, help='Folders scanned in parallel.')
+@with_appcontext
+def gc_uploads_command(delete_orphans, dry_run, grace_hours, batch_size, threads):
+    """Quarantine or delete stored files no image or frame references."""
+    from .storage import get_storage
+    config = current_app.config
+    storage = get_storage()
+    if grace_hours is None:
+        grace_hours = config.get('UPLOAD_GC_GRACE_SECONDS', 24 * 60 * 60) / 3600
+    mode = 'delete' if delete_orphans else config.get('UPLOAD_GC_MODE', 'quarantine')
+    report = collect_garbage(
+        storage, grace_period=timedelta(hours=grace_hours), mode=mode,
+        batch_size=batch_size, threads=threads, dry_run=dry_run
+    )
+    click.echo(
+        f"Scanned {report['scanned']} files against {report['marked']} referenced paths: "
+        f"{report['orphans']} orphans ({report['orphanBytes']} bytes, {report['mode']}), "
+        f"{report['rescued']} picked up again meanwhile"
+    )
+    if not dry_run:
+        purged, freed = purge_quarantine(
+            storage, older_than=timedelta(days=config.get('UPLOAD_GC_QUARANTINE_DAYS', 7)), threads=threads
+        )
+        if purged:
+            click.echo(f'Removed {purged} quarantined files ({freed} bytes)')
@@ -0,0 +1,187 @@
+"""Cleans up after chunked uploads that never completed.
+
+A chunk folder under TEMP_UPLOAD_FOLDER is only removed when its upload
+completes. The janitor takes care of everything else:
+
+    - sessions whose TTL ran out lose their chunk folder and their session row
+    - folders no live session points at (e.g. the session expired in Redis) are removed
+    - when the temp folder grows past UPLOAD_TEMP_BUDGET, the least recently
+      active uploads are evicted until it fits again (uploads active within
+      ORPHAN_GRACE_SECONDS are never evicted, a chunk may be being written)
+
+It runs every UPLOAD_JANITOR_INTERVAL seconds in a background thread of each
+worker, started with the first request it serves (the clean-up is idempotent,
+so several workers running it is fine), and on demand with `flask reap-uploads`.
+"""
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .upload_sessions import get_upload_store
+
+# Folders without a session are left alone this long, init creates the folder
+# just before the session. Uploads active this recently aren't evicted either.
+ORPHAN_GRACE_SECONDS = 10 * 60
+
+
+def path_usage(path):
+    """Bytes of disk a file or folder actually takes (preallocated files count in full, sparse ones don't)"""
+    def usage(st):
+        return st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+
+    if os.path.isfile(path):
+        return usage(os.stat(path))
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += usage(os.stat(os.path.join(dirpath, name)))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def last_modified(path):
+    """Newest mtime of a folder and the files in it (0 when it's gone)"""
+    latest = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in [dirpath] + [os.path.join(dirpath, name) for name in filenames]:
+            try:
+                latest = max(latest, os.stat(name).st_mtime)
+            except FileNotFoundError:
+                pass
+    return latest
+
+
+def idle_seconds(store, info, path):
+    """Seconds since a chunk of the upload was last received or written"""
+    idle = time.time() - last_modified(path)
+    if info['expiresAt']:
+        # Every received chunk moves expiresAt a TTL ahead
+        received_at = info['expiresAt'] - timedelta(seconds=store.ttl)
+        idle = min(idle, (datetime.utcnow() - received_at).total_seconds())
+    return idle
+
+
+def remove_path(path):
+    """Delete a chunk folder (or stray file) and return the bytes it took"""
+    if not path or not os.path.exists(path):
+        return 0
+    freed = path_usage(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+    return freed
+
+
+def reap_uploads(temp_folder, budget=None, now=None):
+    """Run one clean-up pass over temp_folder and return a report of what was reclaimed"""
+    store = get_upload_store()
+    report = {
+        'expiredSessions': 0,
+        'orphanedFolders': 0,
+        'evictedSessions': 0,
+        'reclaimedBytes': 0,
+        'tempBytes': 0
+    }
+
+    # 1. Sessions past their TTL
+    for info in store.expired(now):
+        report['reclaimedBytes'] += remove_path(info['chunkFolder'])
+        store.delete(info['uploadId'])
+        report['expiredSessions'] += 1
+
+    # 2. Folders that don't belong to a live upload
+    live = []
+    for entry in os.scandir(temp_folder):
+        info = store.get(entry.name)
+        if info is not None and not info['isComplete']:
+            live.append((info, entry.path, path_usage(entry.path)))
+            continue
+        if time.time() - entry.stat().st_mtime < ORPHAN_GRACE_SECONDS:
+            continue
+        report['reclaimedBytes'] += remove_path(entry.path)
+        report['orphanedFolders'] += 1
+
+    # 3. Keep the uploads in progress within the budget, the least recently active go first.
+    # Uploads still receiving chunks are left alone, evicting them would pull the folder
+    # out from under a write.
+    temp_bytes = sum(usage for _, _, usage in live)
+    if budget and temp_bytes > budget:
+        live.sort(key=lambda item: item[0]['expiresAt'] or datetime.min)
+        for info, path, usage in live:
+            if temp_bytes <= budget:
+                break
+            if idle_seconds(store, info, path) < ORPHAN_GRACE_SECONDS:
+                continue
+            report['reclaimedBytes'] += remove_path(path)
+            store.delete(info['uploadId'])
+            temp_bytes -= usage
+            report['evictedSessions'] += 1
+
+    report['tempBytes'] = temp_bytes
+    return report
+
+
+def run_janitor(app):
+    """One clean-up pass with the folders and budget configured for app"""
+    from api import TEMP_UPLOAD_FOLDER
+    with app.app_context():
+        report = reap_uploads(TEMP_UPLOAD_FOLDER, budget=app.config.get('UPLOAD_TEMP_BUDGET'))
+    print(
+        f"Upload janitor: reclaimed {report['reclaimedBytes']} bytes "
+        f"({report['expiredSessions']} expired, {report['orphanedFolders']} orphaned, "
+        f"{report['evictedSessions']} evicted), {report['tempBytes']} bytes still in use"
+    )
+    app.extensions['upload_janitor_report'] = dict(report, finishedAt=datetime.utcnow().isoformat())
+    return report
+
+
+def init_upload_janitor(app):
+    """Start the background janitor thread with the first request this process serves,
+    if UPLOAD_JANITOR_INTERVAL is set.
+
+    Waiting for a request keeps one-off commands (flask db upgrade, ...) and
+    processes that only build an app (e.g. multiprocessing children importing
+    run.py) from starting a janitor of their own.
+    """
+    interval = app.config.get('UPLOAD_JANITOR_INTERVAL')
+    if not interval:
+        return None
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                run_janitor(app)
+            except Exception as e:
+                print(f"Upload janitor failed: {str(e)}")
+
+    stop = threading.Event()
+    thread = threading.Thread(target=loop, name='upload-janitor', daemon=True)
+    thread.stop = stop
+    app.extensions['upload_janitor'] = thread
+    lock = threading.Lock()
+
+    @app.before_request
+    def start_upload_janitor():
+        if thread.ident is not None:
+            return
+        with lock:
+            if thread.ident is None:
+                thread.start()
+
+    return thread
+
+
+@click.command('reap-uploads')
+@with_appcontext
+def reap_uploads_command():
+    """Remove expired and abandoned chunked uploads now."""
+    run_janitor(current_app._get_current_object())
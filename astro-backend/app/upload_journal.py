@@ -0,0 +1,328 @@
+"""Write-ahead journal for putting uploaded files in place.
+
+Finishing an upload touches two places: the files go into the storage
+backend and the rows pointing at them into the database. A crash in between
+used to leave half written files under their final name, or files no row
+points at. Requests that store files now go through an UploadJournal:
+
+    journal = open_upload_journal()
+    journal.track(path)               # a file this request is writing
+    journal.stage(path, key)          # a finished file, to be stored as key
+    ...add the rows...
+    journal.publish(storage)          # fsync, journal barrier, rename into place
+    db.session.commit()
+    journal.commit()                  # the entry isn't needed any more
+
+publish() fsyncs every staged file in one batch, appends a barrier to the
+journal and fsyncs it, and only then moves the files into place (each one
+atomically, see chunk_io.publish()) and fsyncs their folders, again in one
+batch. A request that fails calls rollback() instead, which takes back what
+it published and removes the files it was writing.
+
+Each request's entry is a file of JSON lines in uploads/.journal, so a crash
+leaves it behind. recover_upload_journals() runs with the first request a
+process serves (and with `flask recover-uploads`) and finishes the entries of
+processes that are gone: files whose rows were committed are completed,
+anything else is rolled back. A chunked upload's data.part goes back into its
+chunk folder, so the client can simply complete it again.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from . import db
+from .chunk_io import fsync_path, fsync_paths, publish
+from .models import Image, RawFrame, StoredFile
+
+# Folder (inside the uploads folder) holding the journal entries
+JOURNAL_FOLDER = '.journal'
+JOURNAL_SUFFIX = '.journal'
+
+
+class UploadJournal:
+    """Journal entry of one request, see the module docstring"""
+
+    def __init__(self, folder, fsync=True, fsync_threads=8):
+        self.folder = folder
+        self.fsync = fsync
+        self.fsync_threads = fsync_threads
+        self.path = os.path.join(
+            folder, f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex}{JOURNAL_SUFFIX}'
+        )
+        self.closed = False
+        self._fd = None
+        self._folder_synced = False
+        self._tracked = []
+        self._staged = []     # (src_path, key, keep_source) not published yet
+        self._published = []  # (src_path, key, keep_source) in place
+        self._dropped = []    # files removed once the rows are committed
+
+    def _append(self, record):
+        if self._fd is None:
+            os.makedirs(self.folder, exist_ok=True)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # One write per line, so a crashed process never leaves a line half in the page cache
+        os.write(self._fd, (json.dumps(record) + '\n').encode('utf-8'))
+
+    def track(self, path):
+        """Record a file about to be written, it is removed unless the request commits"""
+        self._tracked.append(path)
+        self._append({'write': path})
+
+    def stage(self, src_path, key, keep_source=False):
+        """Record a finished local file that publish() will store under key"""
+        self._staged.append((src_path, key, keep_source))
+        self._append({'stage': src_path, 'key': key, 'keep': keep_source})
+
+    def has(self, key):
+        """True if key is staged or published by this journal"""
+        return any(staged_key == key for _, staged_key, _ in self._staged + self._published)
+
+    def drop(self, path):
+        """Remove path once the request has committed (a duplicate of a stored file)"""
+        self._dropped.append(path)
+
+    def publish(self, storage):
+        """Put the staged files in place, right before the rows pointing at them are committed"""
+        if not self._staged:
+            return
+        if self.fsync and storage.local:
+            # The data of every staged file, in one batch
+            fsync_paths([src for src, _, _ in self._staged], self.fsync_threads)
+
+        # Write-ahead: the entry is on disk before anything is renamed
+        self._append({'publish': len(self._staged)})
+        if self.fsync:
+            os.fsync(self._fd)
+            if not self._folder_synced:
+                fsync_path(self.folder)
+                self._folder_synced = True
+
+        staged, self._staged = self._staged, []
+        for src_path, key, keep_source in staged:
+            storage.put_file(key, src_path, keep_source=keep_source)
+            self._published.append((src_path, key, keep_source))
+
+        if self.fsync and storage.local:
+            # And the renames, one fsync per folder
+            fsync_paths([os.path.dirname(storage.path(key)) for _, key, _ in staged], self.fsync_threads)
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            os.remove(self.path)
+        self.closed = True
+
+    def commit(self):
+        """The rows are committed, forget the entry"""
+        if self.closed:
+            return
+        remove_files(self._dropped)
+        self._close()
+
+    def rollback(self, storage):
+        """Take back what this request published and remove what it wrote.
+
+        db.session has to be rolled back first, so only rows other requests
+        committed keep a file in place.
+        """
+        if self.closed:
+            return
+        undo_published(storage, reversed(self._published), set(self._tracked))
+        remove_files(self._tracked)
+        self._close()
+
+
+def is_referenced(key):
+    """True if a committed row needs the file at key.
+
+    A Blob row alone doesn't, store_blob() brings back the file of a blob that lost it.
+    """
+    for column in (StoredFile.file_path, Image.file_path, RawFrame.file_path):
+        if db.session.execute(select(column).where(column == key).limit(1)).first() is not None:
+            return True
+    return False
+
+
+def undo_published(storage, published, tracked=()):
+    """Roll back published (src_path, key, keep_source) unless their rows made it.
+
+    Returns (completed, rolled_back).
+    """
+    completed = 0
+    rolled_back = 0
+    for src_path, key, keep_source in published:
+        if is_referenced(key):
+            # Committed, make sure the file is there too
+            if not storage.exists(key) and os.path.exists(src_path):
+                storage.put_file(key, src_path, keep_source=keep_source)
+            completed += 1
+            continue
+        if storage.exists(key):
+            src_folder = os.path.dirname(src_path)
+            if storage.local and not keep_source and src_path not in tracked \
+                    and os.path.isdir(src_folder) and not os.path.exists(src_path):
+                # Back where it was staged (e.g. a chunk folder), so the upload can be completed again
+                publish(storage.path(key), src_path)
+            else:
+                storage.delete(key)
+        rolled_back += 1
+    return completed, rolled_back
+
+
+def remove_files(paths):
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def read_journal(path):
+    """(tracked paths, possibly published ops, staged ops never published) of a journal file"""
+    tracked = []
+    pending = []
+    published = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # the last line of an entry cut short by a crash
+            if 'write' in record:
+                tracked.append(record['write'])
+            elif 'stage' in record:
+                pending.append((record['stage'], record['key'], record.get('keep', False)))
+            elif 'publish' in record:
+                published.extend(pending)
+                pending = []
+    return tracked, published, pending
+
+
+def _process_alive(pid):
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_abandoned(name, mtime, max_age, now=None):
+    """True if the process that wrote the journal entry called name is gone"""
+    if (now or time.time()) - mtime > max_age:
+        return True
+    try:
+        host, pid, _ = name[:-len(JOURNAL_SUFFIX)].rsplit('_', 2)
+        pid = int(pid)
+    except ValueError:
+        return True
+    if host != socket.gethostname():
+        # Can't tell whether it's still running, wait for max_age
+        return False
+    return pid != os.getpid() and not _process_alive(pid)
+
+
+def recover_upload_journals(folder, storage, max_age=60 * 60):
+    """Complete or roll back the journal entries abandoned by crashed processes"""
+    report = {'entries': 0, 'completed': 0, 'rolledBack': 0, 'removedFiles': 0, 'skipped': 0}
+    if not os.path.isdir(folder):
+        return report
+    for entry in os.scandir(folder):
+        if not entry.name.endswith(JOURNAL_SUFFIX):
+            continue
+        if not is_abandoned(entry.name, entry.stat().st_mtime, max_age):
+            report['skipped'] += 1
+            continue
+        try:
+            tracked, published, _ = read_journal(entry.path)
+            completed, rolled_back = undo_published(storage, published, set(tracked))
+            report['removedFiles'] += remove_files(tracked)
+            # Staged files never published are left alone, they are either tracked
+            # (and removed above) or belong to an upload session (the janitor's business)
+            os.remove(entry.path)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Upload journal {entry.name} could not be recovered: {str(e)}")
+            continue
+        report['entries'] += 1
+        report['completed'] += completed
+        report['rolledBack'] += rolled_back
+    return report
+
+
+def journal_folder():
+    from api import FINAL_UPLOAD_FOLDER
+    return os.path.join(FINAL_UPLOAD_FOLDER, JOURNAL_FOLDER)
+
+
+def open_upload_journal():
+    """A new journal entry for the current request"""
+    return UploadJournal(
+        journal_folder(),
+        fsync=current_app.config.get('UPLOAD_FSYNC', True),
+        fsync_threads=current_app.config.get('UPLOAD_FSYNC_THREADS', 8)
+    )
+
+
+def run_recovery(app):
+    from .storage import get_storage
+    with app.app_context():
+        report = recover_upload_journals(
+            journal_folder(), get_storage(), max_age=app.config.get('UPLOAD_JOURNAL_MAX_AGE', 60 * 60)
+        )
+    if report['entries']:
+        print(
+            f"Upload journal: recovered {report['entries']} entries ({report['completed']} files completed, "
+            f"{report['rolledBack']} rolled back, {report['removedFiles']} partial files removed)"
+        )
+    return report
+
+
+def init_upload_journal(app):
+    """Recover abandoned journal entries with the first request this process serves.
+
+    Waiting for a request keeps one-off commands (flask db upgrade, ...) from running it.
+    """
+    lock = threading.Lock()
+    done = []
+
+    @app.before_request
+    def recover_upload_journal():
+        if done:
+            return
+        with lock:
+            if done:
+                return
+            done.append(True)
+            try:
+                run_recovery(app)
+            except Exception as e:
+                print(f"Upload journal recovery failed: {str(e)}")
+
+
+@click.command('recover-uploads')
+@with_appcontext
+def recover_uploads_command():
+    """Complete or roll back uploads interrupted by a crash."""
+    report = run_recovery(current_app._get_current_object())
+    click.echo(
+        f"Recovered {report['entries']} journal entries: {report['completed']} files completed, "
+        f"{report['rolledBack']} rolled back, {report['removedFiles']} partial files removed, "
+        f"{report['skipped']} entries still in use"
+    )
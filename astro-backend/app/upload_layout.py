@@ -0,0 +1,169 @@
+"""Sharded directory layout of the uploads folder.
+
+Files that don't go to the blob store (app/blobstore.py, sharded by digest
+already) used to land in one flat folder per type:
+
+    uploads/lightFrames/<uuid>_<name>
+
+With millions of sub-exposures a single directory makes lookups, listings
+and backups crawl. New files get UPLOAD_SHARD_LEVELS levels of fan-out
+instead, taken from a hash of the file name (256 folders per level):
+
+    uploads/lightFrames/3f/a2/<uuid>_<name>
+
+`flask shard-uploads` moves existing files and rewrites the file_path of the
+rows pointing at them in batches. Until it has run (or while it runs),
+resolve_upload_path() finds a file under either layout, so recorded paths
+keep working.
+"""
+import hashlib
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, select, update
+
+from . import db
+from .models import Image, RawFrame, StoredFile
+
+# Hex characters of the name hash per directory level
+SHARD_WIDTH = 2
+# Top level folders that are laid out some other way
+UNSHARDED_FOLDERS = ('blobs',)
+
+
+def shard_levels():
+    return current_app.config.get('UPLOAD_SHARD_LEVELS', 2)
+
+
+def shard_dirs(name, levels):
+    """The shard folders a file called name goes in"""
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(levels)]
+
+
+def sharded_path(folder, name, levels=None):
+    """Path of a new file called name inside folder (absolute or relative)"""
+    if levels is None:
+        levels = shard_levels()
+    return os.path.join(folder, *shard_dirs(name, levels), name)
+
+
+def _parts(relative_path):
+    return relative_path.replace('\\', '/').split('/')
+
+
+def is_flat_path(relative_path):
+    """True for <folder>/<name> paths written before the sharded layout"""
+    if not relative_path or os.path.isabs(relative_path) or '://' in relative_path:
+        return False
+    parts = _parts(relative_path)
+    return len(parts) == 2 and parts[0] not in UNSHARDED_FOLDERS
+
+
+def to_sharded(relative_path, levels=None):
+    """The sharded counterpart of a flat relative path"""
+    folder, name = _parts(relative_path)
+    return '/'.join([folder, *shard_dirs(name, shard_levels() if levels is None else levels), name])
+
+
+def to_flat(relative_path, levels=None):
+    """The flat counterpart of a sharded relative path (None if it isn't one)"""
+    if levels is None:
+        levels = shard_levels()
+    parts = _parts(relative_path)
+    if len(parts) != levels + 2 or parts[0] in UNSHARDED_FOLDERS:
+        return None
+    if parts[1:-1] != shard_dirs(parts[-1], levels):
+        return None
+    return f'{parts[0]}/{parts[-1]}'
+
+
+def resolve_upload_path(upload_folder, relative_path):
+    """Absolute path of a stored file, under whichever layout it is in right now.
+
+    Falls back to the path as recorded if the file isn't found under either.
+    """
+    recorded = os.path.join(upload_folder, relative_path)
+    if os.path.exists(recorded):
+        return recorded
+    other = to_sharded(relative_path) if is_flat_path(relative_path) else to_flat(relative_path)
+    if other:
+        candidate = os.path.join(upload_folder, other)
+        if os.path.exists(candidate):
+            return candidate
+    return recorded
+
+
+def _flat_paths(column, after, batch_size):
+    """Up to batch_size distinct flat paths in column that sort after `after`, and where to continue"""
+    while True:
+        rows = db.session.execute(
+            select(column).distinct()
+            .where(column.isnot(None), column > after)
+            .order_by(column)
+            .limit(batch_size)
+        ).scalars().all()
+        if not rows:
+            return [], None
+        after = rows[-1]
+        flat = [path for path in rows if is_flat_path(path)]
+        if flat:
+            return flat, after
+
+
+def shard_existing_files(upload_folder, batch_size=500, levels=None):
+    """Move flat files into the sharded layout and rewrite the rows that point at them.
+
+    Each batch moves its files first and then rewrites file_path in every
+    table with one executemany per table. A crash in between leaves rows
+    with the old path, which resolve_upload_path() still finds, and running
+    again finishes the job. Returns (files_moved, paths_rewritten).
+    """
+    if levels is None:
+        levels = shard_levels()
+    columns = [Image.__table__.c.file_path, RawFrame.__table__.c.file_path, StoredFile.__table__.c.file_path]
+    moved = 0
+    rewritten = 0
+    for column in columns:
+        after = ''
+        while after is not None:
+            flat_paths, after = _flat_paths(column, after, batch_size)
+            if not flat_paths:
+                break
+
+            changes = []
+            for old_path in flat_paths:
+                new_path = to_sharded(old_path, levels)
+                old_full = os.path.join(upload_folder, old_path)
+                new_full = os.path.join(upload_folder, new_path)
+                if os.path.exists(old_full) and not os.path.exists(new_full):
+                    os.makedirs(os.path.dirname(new_full), exist_ok=True)
+                    os.replace(old_full, new_full)
+                    moved += 1
+                changes.append({'old_path': old_path, 'new_path': new_path})
+
+            for table in (Image.__table__, RawFrame.__table__, StoredFile.__table__):
+                db.session.execute(
+                    update(table)
+                    .where(table.c.file_path == bindparam('old_path'))
+                    .values(file_path=bindparam('new_path')),
+                    changes
+                )
+            db.session.commit()
+            rewritten += len(changes)
+    return moved, rewritten
+
+
+@click.command('shard-uploads')
+@click.option('--batch-size', default=500, help='Paths moved per transaction.')
+@with_appcontext
+def shard_uploads_command(batch_size):
+    """Move uploads from flat type folders into the sharded layout."""
+    from .storage import get_storage
+    if not get_storage().local:
+        raise click.ClickException('Only local storage has folders to shard')
+    from api import FINAL_UPLOAD_FOLDER
+    moved, rewritten = shard_existing_files(FINAL_UPLOAD_FOLDER, batch_size=batch_size)
+    click.echo(f'Moved {moved} files, rewrote {rewritten} recorded paths')
@@ -0,0 +1,531 @@
+"""Shared registry for chunked upload sessions.
+
+The upload routes used to keep their state in a module-level dict, which only
+works with a single worker process and is lost on restart. The stores below
+keep the same information (plus a chunk bitmap, byte counters and an expiry
+time) somewhere every worker can see it:
+
+    SqlUploadSessionStore   - the upload_session table in the app database (default)
+    RedisUploadSessionStore - any Redis compatible server (redis, valkey, fakeredis...)
+
+Pick one with UPLOAD_SESSION_STORE = 'sql' | 'redis' in the config.
+
+Both have the same methods (create, get, mark_chunk, chunk_digests, update,
+delete, expired, completed_uploads, pending_bytes) and pass sessions around
+as plain dicts using the keys the upload routes always used ('fileName',
+'totalChunks', 'receivedChunks', ...).
+"""
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import create_engine, delete, func, select, update
+from sqlalchemy.exc import OperationalError
+
+from . import db
+from .models import UploadSession, UploadChunk
+
+# Default lifetime of an upload session, in seconds
+DEFAULT_SESSION_TTL = 24 * 60 * 60
+
+# Upload info key -> UploadSession column
+FIELD_COLUMNS = {
+    'uploadId': 'upload_id',
+    'userId': 'user_id',
+    'fileName': 'file_name',
+    'fileSize': 'file_size',
+    'fileType': 'file_type',
+    'uploadType': 'upload_type',
+    'fileId': 'file_id',
+    'totalChunks': 'total_chunks',
+    'chunkSize': 'chunk_size',
+    'chunkMode': 'chunk_mode',
+    'chunkFolder': 'chunk_folder',
+    'chunkBitmap': 'chunk_bitmap',
+    'receivedChunks': 'received_chunks',
+    'receivedBytes': 'received_bytes',
+    'isComplete': 'is_complete',
+    'finalPath': 'final_path',
+    'createdAt': 'created_at',
+    'expiresAt': 'expires_at',
+}
+
+
+# ---------------------------- Bitmap helpers ----------------------------
+def empty_bitmap(total_chunks):
+    """A bitmap with room for total_chunks bits, all cleared"""
+    return bytes((int(total_chunks or 0) + 7) // 8)
+
+
+def has_bit(bitmap, index):
+    """Check whether chunk index is marked in the bitmap (most significant bit first, like Redis)"""
+    byte = index // 8
+    if not bitmap or byte >= len(bitmap):
+        return False
+    return bool(bitmap[byte] & (0x80 >> (index % 8)))
+
+
+def set_bit(bitmap, index):
+    """Return a copy of bitmap with chunk index marked"""
+    data = bytearray(bitmap or b'')
+    byte = index // 8
+    if byte >= len(data):
+        data.extend(bytes(byte + 1 - len(data)))
+    data[byte] |= 0x80 >> (index % 8)
+    return bytes(data)
+
+
+def count_bits(bitmap):
+    """Number of chunks marked in the bitmap"""
+    return sum(bin(b).count('1') for b in (bitmap or b''))
+
+
+def first_missing(bitmap, total_chunks):
+    """Index of the first chunk not received yet, or total_chunks when none are missing"""
+    for index in range(int(total_chunks or 0)):
+        if not has_bit(bitmap, index):
+            return index
+    return int(total_chunks or 0)
+
+
+def missing_ranges(bitmap, total_chunks):
+    """List the chunks still missing as inclusive [first, last] ranges"""
+    ranges = []
+    start = None
+    for index in range(int(total_chunks or 0)):
+        if has_bit(bitmap, index):
+            if start is not None:
+                ranges.append([start, index - 1])
+                start = None
+        elif start is None:
+            start = index
+    if start is not None:
+        ranges.append([start, int(total_chunks) - 1])
+    return ranges
+
+
+# ---------------------------- Stores ----------------------------
+class UploadSessionError(Exception):
+    """Raised when an upload session can't be updated"""
+
+
+class SqlUploadSessionStore:
+    """Stores upload sessions in the upload_session table.
+
+    Statements run through a dedicated engine, so using the store never
+    commits or rolls back whatever the request has pending in db.session, and
+    requests holding a db.session connection can't starve it of connections.
+    Chunk updates use optimistic locking on the version column, which keeps
+    the bitmap consistent when several workers write to the same session.
+    """
+
+    max_retries = 50
+
+    def __init__(self, ttl=DEFAULT_SESSION_TTL):
+        self.ttl = ttl
+        self._engine = None
+
+    def expires_at(self):
+        return datetime.utcnow() + timedelta(seconds=self.ttl)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            url = db.engine.url
+            if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+                # An in-memory database only exists on the app's own engine
+                self._engine = db.engine
+            else:
+                self._engine = create_engine(url)
+        return self._engine
+
+    @property
+    def table(self):
+        return UploadSession.__table__
+
+    def _to_info(self, row):
+        if row is None:
+            return None
+        data = row._mapping
+        info = {key: data[column] for key, column in FIELD_COLUMNS.items()}
+        info['version'] = data['version']
+        return info
+
+    def _to_values(self, fields):
+        return {FIELD_COLUMNS[key]: value for key, value in fields.items() if key in FIELD_COLUMNS}
+
+    def _fetch(self, upload_id):
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(self.table).where(self.table.c.upload_id == upload_id)
+            ).first()
+
+    def create(self, info):
+        """Register a new upload session and return it"""
+        values = self._to_values(info)
+        values.setdefault('chunk_bitmap', empty_bitmap(info.get('totalChunks')))
+        values.setdefault('received_chunks', 0)
+        values.setdefault('received_bytes', 0)
+        values.setdefault('is_complete', False)
+        values.setdefault('created_at', datetime.utcnow())
+        values.setdefault('expires_at', self.expires_at())
+        values['version'] = 0
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert().values(**values))
+        return self.get(values['upload_id'])
+
+    def get(self, upload_id):
+        """Return the session for upload_id, or None if it doesn't exist or has expired"""
+        if not upload_id:
+            return None
+        info = self._to_info(self._fetch(upload_id))
+        if info and info['expiresAt'] and info['expiresAt'] < datetime.utcnow():
+            return None
+        return info
+
+    def _write(self, upload_id, change):
+        """Apply change(info) -> (result, values) with optimistic locking"""
+        for attempt in range(self.max_retries):
+            info = self.get(upload_id)
+            if info is None:
+                raise UploadSessionError('Invalid upload ID')
+
+            result, values = change(info)
+            if not values:
+                return result, info
+
+            values['version'] = info['version'] + 1
+            try:
+                with self.engine.begin() as conn:
+                    res = conn.execute(
+                        update(self.table)
+                        .where(self.table.c.upload_id == upload_id)
+                        .where(self.table.c.version == info['version'])
+                        .values(**values)
+                    )
+                if res.rowcount == 1:
+                    info.update({key: values[column] for key, column in FIELD_COLUMNS.items() if column in values})
+                    info['version'] = values['version']
+                    return result, info
+            except OperationalError:
+                # SQLite reports "database is locked" when two writers collide
+                pass
+
+            # Somebody else updated the session first, back off a little and retry
+            time.sleep(min(0.001 * 2 ** attempt, 0.05))
+
+        raise UploadSessionError('Upload session is too busy, try again')
+
+    @property
+    def chunk_table(self):
+        return UploadChunk.__table__
+
+    def mark_chunk(self, upload_id, chunk_index, nbytes, block_digests=None):
+        """Record that chunk_index (nbytes long) is on disk.
+
+        Returns (is_new, info). Marking a chunk twice is harmless: the second
+        call returns is_new=False and the counters are left alone. Every new
+        chunk pushes the expiry time back by the TTL. block_digests, if given,
+        are kept for chunk_digests() (see app/digests.py).
+        """
+        if block_digests is not None:
+            # Saved before the bit is set, so a marked chunk always has its digests
+            with self.engine.begin() as conn:
+                conn.execute(
+                    delete(self.chunk_table)
+                    .where(self.chunk_table.c.upload_id == upload_id)
+                    .where(self.chunk_table.c.chunk_index == chunk_index)
+                )
+                conn.execute(self.chunk_table.insert().values(
+                    upload_id=upload_id, chunk_index=chunk_index, block_digests=block_digests
+                ))
+
+        def change(info):
+            if has_bit(info['chunkBitmap'], chunk_index):
+                return False, None
+            return True, {
+                'chunk_bitmap': set_bit(info['chunkBitmap'], chunk_index),
+                'received_chunks': (info['receivedChunks'] or 0) + 1,
+                'received_bytes': (info['receivedBytes'] or 0) + nbytes,
+                'expires_at': self.expires_at(),
+            }
+
+        return self._write(upload_id, change)
+
+    def chunk_digests(self, upload_id):
+        """Return {chunk_index: block_digests} for the chunks that were hashed on arrival"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(self.chunk_table.c.chunk_index, self.chunk_table.c.block_digests)
+                .where(self.chunk_table.c.upload_id == upload_id)
+            ).all()
+        return {row.chunk_index: row.block_digests for row in rows}
+
+    def update(self, upload_id, **fields):
+        """Overwrite some fields of a session"""
+        _, info = self._write(upload_id, lambda info: (None, self._to_values(fields)))
+        return info
+
+    def delete(self, upload_id):
+        """Forget about a session"""
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.chunk_table).where(self.chunk_table.c.upload_id == upload_id))
+            conn.execute(delete(self.table).where(self.table.c.upload_id == upload_id))
+
+    def expired(self, now=None):
+        """Return the sessions whose TTL has run out"""
+        now = now or datetime.utcnow()
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(self.table).where(self.table.c.expires_at < now)
+            ).all()
+        return [self._to_info(row) for row in rows]
+
+    def completed_uploads(self, user_id, final_paths):
+        """Return {finalPath: uploadId} for the live, completed uploads of user_id among final_paths"""
+        final_paths = list(final_paths)
+        if not final_paths:
+            return {}
+        query = select(self.table.c.final_path, self.table.c.upload_id).where(
+            self.table.c.user_id == user_id,
+            self.table.c.is_complete.is_(True),
+            self.table.c.final_path.in_(final_paths),
+            self.table.c.expires_at >= datetime.utcnow()
+        )
+        with self.engine.connect() as conn:
+            return {row.final_path: row.upload_id for row in conn.execute(query)}
+
+    def pending_bytes(self, user_id, exclude=()):
+        """Total fileSize of the live uploads of user_id, except the upload ids in exclude.
+
+        Completed uploads count too, until finalize-upload registers them
+        (and deletes their session) or they expire.
+        """
+        query = select(func.coalesce(func.sum(self.table.c.file_size), 0)).where(
+            self.table.c.user_id == user_id,
+            self.table.c.expires_at >= datetime.utcnow()
+        )
+        if exclude:
+            query = query.where(self.table.c.upload_id.notin_(list(exclude)))
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+
+class RedisUploadSessionStore:
+    """Stores upload sessions in a Redis compatible server.
+
+    Each session is a hash at upload:<id> with the bitmap in upload:<id>:bitmap.
+    SETBIT tells us whether a chunk was already marked, so retries are
+    detected atomically without any locking. Both keys carry the TTL.
+    upload-user:<user id> is the set of upload ids a user started, for quota checks.
+
+    Redis drops the session keys by itself, so the expiry times are also kept
+    in the upload-expiry sorted set and the chunk folders in the upload-folders
+    hash. Those outlive the session and tell expired() what to clean up.
+    """
+
+    prefix = 'upload:'
+    user_prefix = 'upload-user:'
+    expiry_key = 'upload-expiry'
+    folder_key = 'upload-folders'
+
+    def __init__(self, client, ttl=DEFAULT_SESSION_TTL):
+        self.ttl = ttl
+        self.client = client
+
+    def expires_at(self):
+        return datetime.utcnow() + timedelta(seconds=self.ttl)
+
+    def _key(self, upload_id):
+        return f'{self.prefix}{upload_id}'
+
+    def _score(self, when):
+        """Sorted set score of a (naive UTC) datetime"""
+        return (when - datetime(1970, 1, 1)).total_seconds()
+
+    def _encode(self, fields):
+        encoded = {}
+        for key, value in fields.items():
+            if key == 'chunkBitmap' or key not in FIELD_COLUMNS:
+                continue
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif isinstance(value, bool):
+                value = int(value)
+            encoded[key] = '' if value is None else value
+        return encoded
+
+    def _decode(self, upload_id, data, bitmap):
+        info = {}
+        for key in FIELD_COLUMNS:
+            raw = data.get(key.encode(), b'').decode()
+            if raw == '':
+                value = None
+            elif key in ('fileSize', 'totalChunks', 'chunkSize', 'receivedChunks', 'receivedBytes'):
+                value = int(raw)
+            elif key == 'isComplete':
+                value = raw == '1'
+            elif key in ('createdAt', 'expiresAt'):
+                value = datetime.fromisoformat(raw)
+            else:
+                value = raw
+            info[key] = value
+        info['uploadId'] = upload_id
+        info['chunkBitmap'] = bitmap or b''
+        return info
+
+    def _expire(self, pipe, upload_id):
+        pipe.expire(self._key(upload_id), self.ttl)
+        pipe.expire(self._key(upload_id) + ':bitmap', self.ttl)
+        pipe.expire(self._key(upload_id) + ':digests', self.ttl)
+
+    def create(self, info):
+        fields = dict(info)
+        fields.setdefault('receivedChunks', 0)
+        fields.setdefault('receivedBytes', 0)
+        fields.setdefault('isComplete', False)
+        fields.setdefault('createdAt', datetime.utcnow())
+        fields.setdefault('expiresAt', self.expires_at())
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(info['uploadId']), mapping=self._encode(fields))
+        self._expire(pipe, info['uploadId'])
+        pipe.zadd(self.expiry_key, {info['uploadId']: self._score(fields['expiresAt'])})
+        if info.get('chunkFolder'):
+            pipe.hset(self.folder_key, info['uploadId'], info['chunkFolder'])
+        if info.get('userId'):
+            pipe.sadd(self.user_prefix + info['userId'], info['uploadId'])
+            pipe.expire(self.user_prefix + info['userId'], self.ttl)
+        pipe.execute()
+        return self.get(info['uploadId'])
+
+    def get(self, upload_id):
+        if not upload_id:
+            return None
+        pipe = self.client.pipeline()
+        pipe.hgetall(self._key(upload_id))
+        pipe.get(self._key(upload_id) + ':bitmap')
+        data, bitmap = pipe.execute()
+        if not data:
+            return None
+        return self._decode(upload_id, data, bitmap)
+
+    def mark_chunk(self, upload_id, chunk_index, nbytes, block_digests=None):
+        key = self._key(upload_id)
+        if not self.client.exists(key):
+            raise UploadSessionError('Invalid upload ID')
+
+        if block_digests is not None:
+            # Saved before the bit is set, so a marked chunk always has its digests
+            self.client.hset(key + ':digests', chunk_index, block_digests)
+
+        was_set = self.client.setbit(key + ':bitmap', chunk_index, 1)
+        if not was_set:
+            expires_at = self.expires_at()
+            pipe = self.client.pipeline()
+            pipe.hincrby(key, 'receivedChunks', 1)
+            pipe.hincrby(key, 'receivedBytes', nbytes)
+            pipe.hset(key, 'expiresAt', expires_at.isoformat())
+            self._expire(pipe, upload_id)
+            pipe.zadd(self.expiry_key, {upload_id: self._score(expires_at)})
+            pipe.execute()
+        return not was_set, self.get(upload_id)
+
+    def chunk_digests(self, upload_id):
+        data = self.client.hgetall(self._key(upload_id) + ':digests')
+        return {int(index): digests for index, digests in data.items()}
+
+    def update(self, upload_id, **fields):
+        key = self._key(upload_id)
+        if not self.client.exists(key):
+            raise UploadSessionError('Invalid upload ID')
+        pipe = self.client.pipeline()
+        encoded = self._encode(fields)
+        if encoded:
+            pipe.hset(key, mapping=encoded)
+        if 'expiresAt' in fields:
+            self._expire(pipe, upload_id)
+        if fields.get('expiresAt'):
+            pipe.zadd(self.expiry_key, {upload_id: self._score(fields['expiresAt'])})
+        pipe.execute()
+        return self.get(upload_id)
+
+    def delete(self, upload_id):
+        key = self._key(upload_id)
+        user_id = self.client.hget(key, 'userId')
+        pipe = self.client.pipeline()
+        pipe.delete(key, key + ':bitmap', key + ':digests')
+        pipe.zrem(self.expiry_key, upload_id)
+        pipe.hdel(self.folder_key, upload_id)
+        if user_id:
+            pipe.srem(self.user_prefix + user_id.decode(), upload_id)
+        pipe.execute()
+
+    def expired(self, now=None):
+        # The session keys may be gone already, the expiry index and the
+        # folder hash still know which uploads ran out and where their chunks are
+        now = now or datetime.utcnow()
+        upload_ids = [
+            upload_id.decode()
+            for upload_id in self.client.zrangebyscore(self.expiry_key, '-inf', self._score(now))
+        ]
+        if not upload_ids:
+            return []
+        folders = self.client.hmget(self.folder_key, upload_ids)
+        expired = []
+        for upload_id, folder in zip(upload_ids, folders):
+            info = self.get(upload_id)
+            if info is None:
+                info = {key: None for key in FIELD_COLUMNS}
+                info['uploadId'] = upload_id
+                info['chunkBitmap'] = b''
+            info['chunkFolder'] = folder.decode() if folder else info['chunkFolder']
+            expired.append(info)
+        return expired
+
+    def completed_uploads(self, user_id, final_paths):
+        final_paths = set(final_paths)
+        if not final_paths:
+            return {}
+        upload_ids = [upload_id.decode() for upload_id in self.client.smembers(self.user_prefix + user_id)]
+        pipe = self.client.pipeline()
+        for upload_id in upload_ids:
+            pipe.hmget(self._key(upload_id), 'finalPath', 'isComplete')
+        found = {}
+        for upload_id, (final_path, is_complete) in zip(upload_ids, pipe.execute()):
+            if is_complete == b'1' and final_path and final_path.decode() in final_paths:
+                found[final_path.decode()] = upload_id
+        return found
+
+    def pending_bytes(self, user_id, exclude=()):
+        user_key = self.user_prefix + user_id
+        upload_ids = [upload_id.decode() for upload_id in self.client.smembers(user_key)]
+        pipe = self.client.pipeline()
+        for upload_id in upload_ids:
+            pipe.hget(self._key(upload_id), 'fileSize')
+        total = 0
+        gone = []
+        for upload_id, file_size in zip(upload_ids, pipe.execute()):
+            if file_size is None:
+                # Expired or deleted
+                gone.append(upload_id)
+            elif upload_id not in exclude and file_size:
+                total += int(file_size)
+        if gone:
+            self.client.srem(user_key, *gone)
+        return total
+
+
+def get_upload_store():
+    """Return the upload session store configured for the current app"""
+    store = current_app.extensions.get('upload_sessions')
+    if store is None:
+        kind = current_app.config.get('UPLOAD_SESSION_STORE', 'sql')
+        ttl = current_app.config.get('UPLOAD_SESSION_TTL', DEFAULT_SESSION_TTL)
+        if kind == 'redis':
+            import redis  # optional dependency, only needed for this store
+            client = redis.Redis.from_url(current_app.config.get('UPLOAD_SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+            store = RedisUploadSessionStore(client, ttl=ttl)
+        else:
+            store = SqlUploadSessionStore(ttl=ttl)
+        current_app.extensions['upload_sessions'] = store
+    return store
@@ -0,0 +1,84 @@
+"""Shared set-up for the benchmarks: a throwaway app with its own database and upload folders.
+
+Run the benchmarks from the astro-backend folder, e.g.
+
+    python -m benchmarks.finalize_matching
+"""
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import jwt
+
+from config import Config
+
+
+def make_app(**config):
+    """Create an app on a temporary SQLite database with temporary upload folders.
+
+    Returns (app, client, headers, folder), headers authenticate as a fresh user.
+    Remove folder when done (see temporary_app()).
+    """
+    folder = tempfile.mkdtemp(prefix='astro-bench-')
+    overrides = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(folder, 'bench.db'),
+        'UPLOAD_JANITOR_INTERVAL': 0,
+        'JOB_WORKER_THREADS': 0,  # benchmarks run the jobs themselves, see run_jobs()
+    }
+    overrides.update(config)
+    for key, value in overrides.items():
+        setattr(Config, key, value)
+
+    import api
+    api.TEMP_UPLOAD_FOLDER = os.path.join(folder, 'temp_uploads')
+    api.FINAL_UPLOAD_FOLDER = os.path.join(folder, 'uploads')
+    os.makedirs(api.TEMP_UPLOAD_FOLDER)
+    os.makedirs(api.FINAL_UPLOAD_FOLDER)
+
+    from app import create_app, db
+    from app.models import User
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com', password_hash='-', name='Bench')
+        db.session.add(user)
+        db.session.commit()
+        token = jwt.encode(
+            {'user_id': user.user_id, 'exp': datetime.utcnow() + timedelta(hours=12)},
+            app.config['SECRET_KEY'], algorithm='HS256'
+        )
+    headers = {'Authorization': f'Bearer {token}'}
+    return app, app.test_client(), headers, folder
+
+
+@contextlib.contextmanager
+def temporary_app(**config):
+    app, client, headers, folder = make_app(**config)
+    try:
+        yield app, client, headers
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow the routes' debug prints so they don't dominate the timings"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def timed(fn, *args, **kwargs):
+    """Call fn and return (result, seconds)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_jobs(app):
+    """Run every queued background job in this thread"""
+    from app.jobs import run_pending_jobs
+    with app.app_context():
+        return run_pending_jobs('benchmark')
@@ -0,0 +1,52 @@
+"""How /finalize-upload scales with the number of frames in one request.
+
+Every frame is sent as a small file part and listed again in images.fileData,
+the way the upload form does it. Matching used to rescan every field for every
+frame type and every fileData entry, so the time per frame grew with the frame
+count. It should now stay flat. The time includes the background job that
+registers the frames.
+
+    python -m benchmarks.finalize_matching [frame counts...]
+"""
+import io
+import json
+import sys
+
+from .common import temporary_app, quiet, timed, run_jobs
+
+FRAME_TYPES = ['lightFrames', 'darkFrames', 'flatFrames', 'biasFrames', 'darkFlats']
+
+
+def build_form(frame_count):
+    form = {'imageDetails': json.dumps({'title': f'{frame_count} frames'})}
+    file_data = {frame_type: [] for frame_type in FRAME_TYPES}
+    for i in range(frame_count):
+        frame_type = FRAME_TYPES[i % len(FRAME_TYPES)]
+        index = len(file_data[frame_type])
+        name = f'{frame_type}_{index:05d}.fits'
+        # Different content per frame so deduplication doesn't shortcut anything
+        form[f'images.{frame_type}[{index}]'] = (io.BytesIO(name.encode() * 4), name)
+        file_data[frame_type].append({'name': name, 'size': len(name) * 4})
+    form['images.fileData'] = json.dumps(file_data)
+    return form
+
+
+def run(frame_counts):
+    print(f"{'frames':>8} {'total s':>10} {'ms/frame':>10}")
+    with temporary_app() as (app, client, headers):
+        for frame_count in frame_counts:
+            form = build_form(frame_count)
+            with quiet():
+                response, seconds = timed(
+                    client.post, '/api/finalize-upload',
+                    data=form, headers=headers, content_type='multipart/form-data'
+                )
+                _, job_seconds = timed(run_jobs, app)
+            seconds += job_seconds
+            if response.status_code != 202:
+                raise SystemExit(f'finalize-upload failed: {response.status_code} {response.get_data(as_text=True)}')
+            print(f'{frame_count:>8} {seconds:>10.3f} {seconds * 1000 / frame_count:>10.3f}')
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [250, 500, 1000, 2000, 4000])
@@ -0,0 +1,81 @@
+"""Reading capture metadata from FITS frames: header only vs reading the whole file.
+
+read_file_metadata() stops at the END card of the primary header, so the
+cost per frame doesn't depend on the size of the image. whole_file() below
+reads every byte first, like opening the frame with an image library would,
+and is kept here only as the baseline.
+
+    python -m benchmarks.fits_headers [frame count] [frame size in MB]
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+from .common import timed
+
+HEADER_CARDS = [
+    ('SIMPLE', True), ('BITPIX', 16), ('NAXIS', 2), ('NAXIS1', 4656), ('NAXIS2', 3520),
+    ('EXPTIME', 300.0), ('GAIN', 100), ('CCD-TEMP', -10.2), ('DATE-OBS', '2024-03-01T22:10:05.123'),
+    ('IMAGETYP', 'Light Frame'), ('FILTER', 'Ha'), ('XBINNING', 1), ('YBINNING', 1),
+    ('INSTRUME', 'ZWO ASI294MM Pro'), ('TELESCOP', 'Esprit 100'), ('OBJECT', 'M 42'), ('FOCALLEN', 550.0),
+]
+
+
+def card(keyword, value=None):
+    if value is None:
+        return keyword.ljust(80).encode('ascii')
+    if isinstance(value, bool):
+        value = 'T' if value else 'F'
+    elif isinstance(value, str):
+        value = "'" + value.ljust(8) + "'"
+    return f'{keyword:<8}= {value!s:>20} / written by the benchmark'.ljust(80)[:80].encode('ascii')
+
+
+def fits_header():
+    cards = [card(keyword, value) for keyword, value in HEADER_CARDS]
+    # Capture software writes plenty of cards we don't read
+    cards += [card('HISTORY') for _ in range(60)]
+    cards.append(card('END'))
+    header = b''.join(cards)
+    return header + b' ' * (-len(header) % 2880)
+
+
+def write_frames(folder, frame_count, frame_size):
+    header = fits_header()
+    paths = []
+    for i in range(frame_count):
+        path = os.path.join(folder, f'frame_{i:05d}.fits')
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(os.urandom(1024))
+            # The rest of the data is sparse, so big frames don't fill the disk
+            f.truncate(frame_size)
+        paths.append(path)
+    return paths
+
+
+def whole_file(path):
+    from app.frame_metadata import read_metadata
+    with open(path, 'rb') as f:
+        return read_metadata(io.BytesIO(f.read()))
+
+
+def run(frame_count, frame_mb):
+    from app.frame_metadata import read_file_metadata
+    folder = tempfile.mkdtemp(prefix='astro-bench-')
+    try:
+        paths = write_frames(folder, frame_count, int(frame_mb * 1024 * 1024))
+        print(f"{frame_count} frames of {frame_mb} MB")
+        print(f"{'reader':>12} {'seconds':>10} {'frames/s':>12}")
+        for name, reader in (('whole file', whole_file), ('header only', read_file_metadata)):
+            results, seconds = timed(lambda: [reader(path) for path in paths])
+            assert all(result.get('exposure_time') == 300.0 for result in results)
+            print(f'{name:>12} {seconds:>10.3f} {frame_count / seconds:>12.0f}')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, float(sys.argv[2]) if len(sys.argv) > 2 else 8)
@@ -0,0 +1,139 @@
+"""Registering the frames of a session: an ORM object per frame vs the bulk insert path.
+
+create_frame_records() writes the FrameSet, all RawFrame rows and the
+FrameSummary with Core inserts. orm_per_row() below is how it used to work
+(one RawFrame object and one db.session.add per frame) and is kept here only
+as the baseline. It does the same work around the inserts (digest and size
+lookups, header reads, blob references and storage usage), so the timings
+differ by how the rows are written. The frames are real FITS files in the
+blob store. Both are timed up to and including the commit (best of three),
+with the metadata cache already holding the headers (what the
+process_upload job of a chunked upload leaves behind) and with the headers
+read during registration.
+
+    python -m benchmarks.frame_records [frame counts...]
+"""
+import os
+import sys
+import uuid
+from datetime import datetime
+
+from .common import temporary_app, quiet, timed
+from .fits_headers import fits_header
+
+FRAME_TYPES = ['lightFrames', 'darkFrames', 'flatFrames', 'biasFrames', 'darkFlats']
+
+
+def orm_per_row(image_id, image_files):
+    from app import db
+    from app.blobstore import adjust_blob_refs
+    from app.metadata_pool import read_frames_metadata
+    from app.models import FrameSet, FrameSummary, Image, RawFrame
+    from app.storage import get_storage
+    from app.storage_usage import UsageChanges, stored_file_info
+    import api
+    frameset = FrameSet(image_id=image_id)
+    db.session.add(frameset)
+    db.session.flush()
+    paths = [path for frame_list in image_files.values() for path in frame_list]
+    content_digests, file_sizes = stored_file_info(get_storage(), paths)
+    frame_metadata = read_frames_metadata(get_storage(), paths, content_digests)
+    user_id = db.session.get(Image, image_id).user_id
+    usage = UsageChanges()
+    counts = dict.fromkeys(FRAME_TYPES, 0)
+    for frame_type, frame_list in image_files.items():
+        for frame_path in frame_list:
+            type_mapping = {
+                'lightFrames': 'light', 'darkFrames': 'dark', 'flatFrames': 'flat',
+                'biasFrames': 'bias', 'darkFlats': 'dark_flat'
+            }
+            print(f"Creating RawFrame for {frame_type}: {frame_path}")
+            file_size = file_sizes.get(frame_path)
+            row = {'capture_time': datetime.utcnow()}
+            api.apply_frame_metadata(row, frame_metadata.get(frame_path, {}))
+            db.session.add(RawFrame(
+                frameset_id=frameset.frameset_id,
+                frame_type=type_mapping[frame_type],
+                file_path=frame_path,
+                content_digest=content_digests.get(frame_path),
+                file_size=file_size,
+                **row
+            ))
+            usage.add(user_id, type_mapping[frame_type], file_size)
+            counts[frame_type] += 1
+    adjust_blob_refs(added=paths)
+    usage.apply()
+    db.session.add(FrameSummary(
+        image_id=image_id,
+        light_frame_count=counts['lightFrames'],
+        dark_frame_count=counts['darkFrames'],
+        flat_frame_count=counts['flatFrames'],
+        bias_frame_count=counts['biasFrames'],
+        dark_flat_count=counts['darkFlats']
+    ))
+
+
+def make_session(frame_count, user_id, cache_headers):
+    """An Image row plus image_files for frame_count frames stored as blobs"""
+    from app import db
+    from app.blobstore import blob_relative_path
+    from app.models import Blob, Image, StoredFile
+    import api
+    image = Image(user_id=user_id, title=f'{frame_count} frames')
+    db.session.add(image)
+    header = fits_header()
+    image_files = {frame_type: [] for frame_type in FRAME_TYPES}
+    for i in range(frame_count):
+        frame_type = FRAME_TYPES[i % len(FRAME_TYPES)]
+        digest = uuid.uuid4().hex * 2
+        path = blob_relative_path(digest, '.fits')
+        full_path = os.path.join(api.FINAL_UPLOAD_FOLDER, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(header)
+            f.write(os.urandom(2880))
+        image_files[frame_type].append(path)
+        db.session.add(StoredFile(file_path=path, content_digest=digest, file_size=len(header) + 2880))
+        db.session.add(Blob(content_digest=digest, file_path=path, file_size=len(header) + 2880, ref_count=0))
+    db.session.commit()
+    if cache_headers:
+        from app.metadata_pool import read_frames_metadata
+        from app.storage import get_storage
+        paths = [path for frame_list in image_files.values() for path in frame_list]
+        read_frames_metadata(get_storage(), paths, api.get_content_digests(paths))
+        db.session.commit()
+    return image.image_id, image_files
+
+
+def run(frame_counts):
+    from app import db
+    from app.models import User
+    import api
+
+    def register(create, image_id, image_files):
+        create(image_id, image_files)
+        db.session.commit()
+
+    print(f"{'frames':>8} {'headers':>8} {'orm s':>10} {'bulk s':>10} {'speed-up':>10}")
+    with temporary_app() as (app, client, headers):
+        with app.app_context():
+            user_id = User.query.first().user_id
+            for frame_count in frame_counts:
+                for cache_headers in (True, False):
+                    timings = []
+                    for create in (orm_per_row, api.create_frame_records):
+                        best = None
+                        for _ in range(3):
+                            image_id, image_files = make_session(frame_count, user_id, cache_headers)
+                            with quiet():
+                                _, seconds = timed(register, create, image_id, image_files)
+                            best = seconds if best is None else min(best, seconds)
+                            db.session.expunge_all()
+                        timings.append(best)
+                    orm, bulk = timings
+                    source = 'cached' if cache_headers else 'read'
+                    print(f'{frame_count:>8} {source:>8} {orm:>10.3f} {bulk:>10.3f} {orm / bulk:>9.1f}x')
+
+
+if __name__ == '__main__':
+    run([int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000])
@@ -0,0 +1,67 @@
+"""An archive-wide `flask refresh-frame-metadata` with a cold and a warm metadata cache.
+
+Registers frame_count RawFrame rows over synthetic FITS frames of frame_mb
+MB, then times refresh_frame_metadata() (app/metadata_cache.py) with the
+cache emptied first and again with the cache it left behind. The cold run
+reads every header (inline, FRAME_METADATA_WORKERS=0, to keep the pool out
+of the comparison). The warm run only looks the results up by digest.
+
+    python -m benchmarks.metadata_cache [frame count] [frame size in MB]
+"""
+import hashlib
+import os
+import sys
+import uuid
+
+from .common import temporary_app, timed
+from .fits_headers import write_frames
+
+
+def make_frames(frame_count, frame_mb):
+    """A FrameSet with frame_count RawFrame rows over frames written to the uploads folder"""
+    from app import db
+    from app.models import FrameSet, Image, RawFrame, User
+    import api
+    folder = os.path.join(api.FINAL_UPLOAD_FOLDER, 'lightFrames')
+    os.makedirs(folder)
+    paths = write_frames(folder, frame_count, int(frame_mb * 1024 * 1024))
+    image = Image(user_id=User.query.first().user_id, title='refresh')
+    db.session.add(image)
+    db.session.flush()
+    frameset = FrameSet(image_id=image.image_id)
+    db.session.add(frameset)
+    db.session.flush()
+    db.session.add_all(
+        RawFrame(
+            frame_id=str(uuid.uuid4()), frameset_id=frameset.frameset_id, frame_type='light',
+            file_path=os.path.relpath(path, api.FINAL_UPLOAD_FOLDER),
+            # Stands in for the digest computed at upload
+            content_digest=hashlib.sha256(path.encode('utf-8')).hexdigest()
+        )
+        for path in paths
+    )
+    db.session.commit()
+
+
+def run(frame_count, frame_mb):
+    from app import db
+    from app.metadata_cache import refresh_frame_metadata
+    from app.models import FrameMetadataCache
+    from app.storage import get_storage
+
+    with temporary_app(FRAME_METADATA_WORKERS=0) as (app, client, headers):
+        with app.app_context():
+            make_frames(frame_count, frame_mb)
+            storage = get_storage()
+            print(f"{frame_count} frames of {frame_mb} MB")
+            print(f"{'cache':>8} {'seconds':>10} {'frames/s':>10}")
+            FrameMetadataCache.query.delete()
+            db.session.commit()
+            for label in ('cold', 'warm'):
+                (frames, _), seconds = timed(refresh_frame_metadata, storage)
+                assert frames == frame_count
+                print(f'{label:>8} {seconds:>10.3f} {frame_count / seconds:>10.0f}')
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, float(sys.argv[2]) if len(sys.argv) > 2 else 8)
@@ -0,0 +1,51 @@
+"""Reading the headers of a finalize batch inline vs on the metadata process pool.
+
+Times read_frames_metadata() (app/metadata_pool.py) over a batch of
+synthetic FITS frames for each worker count. The first batch a pool sees
+includes starting its processes, so every count is timed on a warm pool
+(best of three). The metadata cache is off, otherwise every pass after the
+first would only time cache hits. Speed-up needs free cores, on a single
+core machine the pool only adds its overhead.
+
+    python -m benchmarks.metadata_pool [frame count] [worker counts...]
+"""
+import os
+import sys
+
+from .common import temporary_app, timed
+from .fits_headers import write_frames
+
+
+def run(frame_count, worker_counts):
+    from app.metadata_pool import read_frames_metadata, get_metadata_pool, discard_metadata_pool
+    from app.storage import get_storage
+    import api
+
+    with temporary_app(FRAME_METADATA_CACHE=False) as (app, client, headers):
+        with app.app_context():
+            folder = os.path.join(api.FINAL_UPLOAD_FOLDER, 'lightFrames')
+            os.makedirs(folder)
+            paths = write_frames(folder, frame_count, 64 * 1024)
+            keys = [os.path.relpath(path, api.FINAL_UPLOAD_FOLDER) for path in paths]
+            storage = get_storage()
+            print(f"{frame_count} frames, {os.cpu_count()} cores")
+            print(f"{'workers':>8} {'seconds':>10} {'frames/s':>10}")
+            baseline = None
+            for workers in worker_counts:
+                app.config['FRAME_METADATA_WORKERS'] = workers
+                app.config['FRAME_METADATA_MIN_BATCH'] = 1
+                best = None
+                for _ in range(3):
+                    results, seconds = timed(read_frames_metadata, storage, keys)
+                    assert all(metadata.get('exposure_time') == 300.0 for metadata in results.values())
+                    best = seconds if best is None else min(best, seconds)
+                baseline = baseline or best
+                print(f'{workers:>8} {best:>10.3f} {frame_count / best:>10.0f}   {baseline / best:.1f}x')
+                if workers > 1:
+                    discard_metadata_pool(get_metadata_pool(workers))
+
+
+if __name__ == '__main__':
+    frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    counts = [int(arg) for arg in sys.argv[2:]] or sorted({0, 2, 4, os.cpu_count() or 1})
+    run(frame_count, counts)
@@ -0,0 +1,116 @@
+"""Reading capture metadata from camera raws: IFD walking vs reading the whole file.
+
+read_file_metadata() memory-maps a CR2/NEF/ARW and only touches IFD0, the
+Exif IFD and the maker note, so the cost per file is a few microseconds
+whatever the size of the raw. whole_file() reads every byte first, like
+handing the raw to an image library would, and is kept only as the baseline.
+
+    python -m benchmarks.raw_headers [file count] [file size in MB]
+"""
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from .common import timed
+
+ASCII, SHORT, LONG, RATIONAL, UNDEFINED = 2, 3, 4, 5, 7
+
+
+def ascii_entry(tag, text):
+    data = text.encode('ascii') + b'\0'
+    return tag, ASCII, len(data), data
+
+
+def ifd(entries, start):
+    """Little-endian IFD placed at offset start, values that don't fit in an entry follow it"""
+    entries = sorted(entries)
+    data_offset = start + 2 + 12 * len(entries) + 4
+    table = struct.pack('<H', len(entries))
+    data = b''
+    for tag, field_type, count, value in entries:
+        if len(value) <= 4:
+            table += struct.pack('<HHI', tag, field_type, count) + value.ljust(4, b'\0')
+        else:
+            table += struct.pack('<HHII', tag, field_type, count, data_offset + len(data))
+            data += value + b'\0' * (len(value) % 2)
+    return table + struct.pack('<I', 0) + data
+
+
+def maker_note_offset(entries, start):
+    """Where ifd() will put the value of the maker note (the last entry that doesn't fit)"""
+    offset = start + 2 + 12 * len(entries) + 4
+    for tag, _, _, value in sorted(entries):
+        if len(value) > 4:
+            if tag == 0x927C:
+                return offset
+            offset += len(value) + len(value) % 2
+
+
+def canon_raw():
+    """Header of a CR2-like file: IFD0, Exif IFD and a Canon maker note"""
+    exif_start = 512
+    shot_info = [0] * 34
+    shot_info[12] = 128 + 18
+    exif_entries = [
+        (0x829A, RATIONAL, 1, struct.pack('<II', 1, 300)), (0x829D, RATIONAL, 1, struct.pack('<II', 28, 10)),
+        (0x8827, SHORT, 1, struct.pack('<H', 1600)), ascii_entry(0x9003, '2024:03:01 23:10:05'),
+        ascii_entry(0x9011, '+01:00'), (0x920A, RATIONAL, 1, struct.pack('<II', 135, 1)),
+    ]
+
+    def maker_note(start):
+        return ifd([
+            (0x0004, SHORT, len(shot_info), struct.pack(f'<{len(shot_info)}H', *shot_info)),
+            (0x000C, LONG, 1, struct.pack('<I', 123456789)), ascii_entry(0x0095, 'EF135mm f/2L USM'),
+        ], start)
+
+    entries = exif_entries + [(0x927C, UNDEFINED, len(maker_note(0)), maker_note(0))]
+    note = maker_note(maker_note_offset(entries, exif_start))
+    entries[-1] = (0x927C, UNDEFINED, len(note), note)
+    ifd0 = ifd([
+        ascii_entry(0x010F, 'Canon'), ascii_entry(0x0110, 'Canon EOS 6D'),
+        (0x8769, LONG, 1, struct.pack('<I', exif_start)),
+    ], 8)
+    header = b'II*\0' + struct.pack('<I', 8) + ifd0
+    return header.ljust(exif_start, b'\0') + ifd(entries, exif_start)
+
+
+def write_raws(folder, file_count, file_size):
+    header = canon_raw()
+    paths = []
+    for i in range(file_count):
+        path = os.path.join(folder, f'IMG_{i:05d}.CR2')
+        with open(path, 'wb') as f:
+            f.write(header)
+            f.write(os.urandom(1024))
+            # The rest of the image data is sparse, so big raws don't fill the disk
+            f.truncate(file_size)
+        paths.append(path)
+    return paths
+
+
+def whole_file(path):
+    from app.frame_metadata import read_metadata
+    with open(path, 'rb') as f:
+        return read_metadata(io.BytesIO(f.read()))
+
+
+def run(file_count, file_mb):
+    from app.frame_metadata import read_file_metadata
+    folder = tempfile.mkdtemp(prefix='astro-bench-')
+    try:
+        paths = write_raws(folder, file_count, int(file_mb * 1024 * 1024))
+        print(f"{file_count} raws of {file_mb} MB")
+        print(f"{'reader':>12} {'seconds':>10} {'us/file':>10}")
+        for name, reader in (('whole file', whole_file), ('IFDs only', read_file_metadata)):
+            results, seconds = timed(lambda: [reader(path) for path in paths])
+            assert all(result.get('serial_number') == '0123456789' for result in results)
+            print(f'{name:>12} {seconds:>10.3f} {seconds / file_count * 1e6:>10.1f}')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, float(sys.argv[2]) if len(sys.argv) > 2 else 25)
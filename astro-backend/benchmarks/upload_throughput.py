@@ -0,0 +1,318 @@
+"""End-to-end throughput of the upload path.
+
+Starts the app in a child process (scratch SQLite database and upload folders,
+real HTTP server) and drives it like the upload form does:
+
+    /chunk-upload/init -> /chunk-upload/chunk (every chunk) -> /chunk-upload/complete
+
+for every file, with --concurrency files in flight at once, then registers the
+files with /finalize-upload in batches of --frames-per-finalize. Frames are
+synthetic FITS files (a unique header followed by generated data), produced on
+the fly so nothing has to fit in memory or on disk on the client side.
+
+Reports MB/s, p50/p99 latency per endpoint, the server's peak RSS, the bytes
+it wrote to disk and what ended up in the upload folders.
+
+    python -m benchmarks.upload_throughput --files 1000 --file-size 50MB --concurrency 8
+    python -m benchmarks.upload_throughput --chunk-mode concat --session-store sql
+    python -m benchmarks.upload_throughput --encoding zstd
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+FITS_BLOCK = 2880
+UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    number = text.rstrip('KMGB')
+    return int(float(number) * UNITS[text[len(number):]])
+
+
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1024
+
+
+# ---------------------------- Synthetic frames ----------------------------
+class SyntheticFits:
+    """A FITS file of the given size that is generated as it is read"""
+
+    # 16-bit pixels of a dark sky background: a constant high byte and noise in
+    # the low one, which compresses about as well as real light frames
+    pattern = bytes(b for low in os.urandom(512 * 1024) for b in (0x03, low))
+
+    def __init__(self, index, size):
+        cards = [
+            'SIMPLE  =                    T',
+            'BITPIX  =                   16',
+            'NAXIS   =                    1',
+            f'NAXIS1  = {max(size - FITS_BLOCK, 0) // 2:>20}',
+            f"OBJECT  = 'BENCH{index:06d}'",
+            f"FRAMEID = '{uuid.uuid4()}'",
+            'END',
+        ]
+        header = ''.join(card.ljust(80) for card in cards).encode('ascii')
+        self.header = header.ljust(FITS_BLOCK, b' ')[:size]
+        self.size = size
+        self.name = f'light_{index:06d}.fits'
+
+    def read_range(self, offset, length):
+        out = bytearray()
+        if offset < len(self.header):
+            out += self.header[offset:offset + length]
+        position = max(offset, len(self.header)) - len(self.header)
+        while len(out) < length:
+            start = position % len(self.pattern)
+            take = min(len(self.pattern) - start, length - len(out))
+            out += self.pattern[start:start + take]
+            position += take
+        return bytes(out)
+
+
+# ---------------------------- Server process ----------------------------
+def proc_io_write_bytes():
+    """Bytes this process caused to be written to storage (Linux only)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def folder_bytes(folder):
+    total = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            try:
+                total += os.stat(os.path.join(dirpath, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def serve(conn, config):
+    """Child process: run the app on an ephemeral port until told to stop"""
+    import logging
+    import sys
+    from werkzeug.serving import make_server
+    from .common import make_app
+    import api
+
+    # Request logs and the routes' debug prints would only slow the server down
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    sys.stdout = open(os.devnull, 'w')
+
+    app, _, headers, folder = make_app(**config)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    io_before = proc_io_write_bytes()
+    conn.send({'port': server.server_port, 'headers': headers, 'folder': folder})
+
+    conn.recv()  # wait for the stop message
+    # Let the background jobs finish, they are part of the upload work
+    from app.models import Job
+    started = time.perf_counter()
+    with app.app_context():
+        while Job.query.filter(Job.status.in_(['queued', 'running'])).count():
+            time.sleep(0.1)
+    jobs_seconds = time.perf_counter() - started
+    server.shutdown()
+
+    io_after = proc_io_write_bytes()
+    conn.send({
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'disk_written': io_after - io_before if io_before is not None else None,
+        'uploads_bytes': folder_bytes(api.FINAL_UPLOAD_FOLDER),
+        'temp_bytes': folder_bytes(api.TEMP_UPLOAD_FOLDER),
+        'jobs_seconds': jobs_seconds,
+    })
+    conn.close()
+
+
+# ---------------------------- Client ----------------------------
+class Client:
+    """Tiny HTTP client keeping one connection per thread and recording latencies"""
+
+    def __init__(self, port, headers):
+        self.port = port
+        self.headers = headers
+        self.local = threading.local()
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self.sent_bytes = 0
+
+    def request(self, endpoint, method, path, body=None, headers=None):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        all_headers = dict(self.headers, **(headers or {}))
+        started = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=all_headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.local.conn = None
+            raise
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            self.sent_bytes += len(body or b'')
+        if response.status >= 400:
+            raise RuntimeError(f'{endpoint} failed with {response.status}: {data[:200]!r}')
+        return json.loads(data) if data else {}
+
+    def post_json(self, endpoint, path, payload):
+        return self.request(endpoint, 'POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+
+
+def compressor(encoding):
+    if encoding == 'gzip':
+        import gzip
+        return lambda data: gzip.compress(data, compresslevel=1)
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=1).compress
+    return None
+
+
+def upload_file(client, frame, chunk_size, encoding=None):
+    total_chunks = (frame.size + chunk_size - 1) // chunk_size
+    init = client.post_json('init', '/api/chunk-upload/init', {
+        'fileName': frame.name,
+        'fileSize': frame.size,
+        'fileType': 'image/fits',
+        'uploadType': 'lightFrames',
+        'fileId': f'lightFrames_{frame.name}',
+        'totalChunks': total_chunks,
+        'chunkSize': chunk_size,
+    })
+    upload_id = init['uploadId']
+    compress = compressor(encoding)
+    for index in range(total_chunks):
+        offset = index * chunk_size
+        data = frame.read_range(offset, min(chunk_size, frame.size - offset))
+        headers = {'Content-Type': 'application/octet-stream'}
+        if compress:
+            headers.update({'Content-Encoding': encoding, 'X-Chunk-Length': str(len(data))})
+            data = compress(data)
+        client.request(
+            'chunk', 'POST', f'/api/chunk-upload/chunk?uploadId={upload_id}&chunkIndex={index}',
+            data, headers
+        )
+    done = client.post_json('complete', '/api/chunk-upload/complete', {'uploadId': upload_id})
+    return done['filePath']
+
+
+def finalize(client, batch_index, file_paths):
+    boundary = uuid.uuid4().hex
+    fields = [('imageDetails', json.dumps({'title': f'Benchmark batch {batch_index}'}))]
+    fields += [(f'chunkedFiles[lightFrames_{i}]', path) for i, path in enumerate(file_paths)]
+    body = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields
+    ) + f'--{boundary}--\r\n'.encode()
+    client.request('finalize', 'POST', '/api/finalize-upload', body, {
+        'Content-Type': f'multipart/form-data; boundary={boundary}'
+    })
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run(args):
+    config = {
+        'UPLOAD_CHUNK_MODE': args.chunk_mode,
+        'UPLOAD_SESSION_STORE': args.session_store,
+        'UPLOAD_DEDUP': not args.no_dedup,
+        'JOB_WORKER_THREADS': args.job_threads,
+    }
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    server = context.Process(target=serve, args=(child, config))
+    server.start()
+    info = parent.recv()
+    client = Client(info['port'], info['headers'])
+
+    frames = [SyntheticFits(i, args.file_size) for i in range(args.files)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        paths = list(pool.map(lambda frame: upload_file(client, frame, args.chunk_size, args.encoding), frames))
+    upload_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batches = [paths[i:i + args.frames_per_finalize] for i in range(0, len(paths), args.frames_per_finalize)]
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(lambda item: finalize(client, *item), enumerate(batches)))
+    finalize_seconds = time.perf_counter() - started
+
+    parent.send('stop')
+    stats = parent.recv()
+    server.join()
+
+    total_bytes = args.files * args.file_size
+    print(f'{args.files} files x {format_bytes(args.file_size)}, chunks of {format_bytes(args.chunk_size)}, '
+          f'concurrency {args.concurrency}, chunk mode {args.chunk_mode}, session store {args.session_store}, '
+          f'encoding {args.encoding or "identity"}')
+    print(f'upload:   {upload_seconds:8.2f} s  {total_bytes / upload_seconds / 1024 ** 2:8.1f} MB/s')
+    print(f'on the wire: {format_bytes(client.sent_bytes)} ({client.sent_bytes / total_bytes:.2f}x the payload)')
+    print(f'finalize: {finalize_seconds:8.2f} s  ({len(batches)} requests)')
+    print(f'jobs:     {stats["jobs_seconds"]:8.2f} s  to drain the background queue')
+    print()
+    print(f"{'endpoint':<10} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for endpoint in ('init', 'chunk', 'complete', 'finalize'):
+        values = client.latencies.get(endpoint, [])
+        print(f'{endpoint:<10} {len(values):>7} {percentile(values, 0.5) * 1000:>9.1f} '
+              f'{percentile(values, 0.99) * 1000:>9.1f} {max(values or [0]) * 1000:>9.1f}')
+    print()
+    print(f'server peak RSS:     {format_bytes(stats["peak_rss"])}')
+    if stats['disk_written'] is not None:
+        print(f'server disk writes:  {format_bytes(stats["disk_written"])} '
+              f'({stats["disk_written"] / total_bytes:.2f}x the payload)')
+    print(f'uploads folder:      {format_bytes(stats["uploads_bytes"])}')
+    print(f'temp folder left:    {format_bytes(stats["temp_bytes"])}')
+
+    if not args.keep:
+        import shutil
+        shutil.rmtree(info['folder'], ignore_errors=True)
+    else:
+        print(f'scratch folder kept: {info["folder"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=50, help='number of frames to upload')
+    parser.add_argument('--file-size', type=parse_size, default='8MB', help='size of each frame, e.g. 50MB')
+    parser.add_argument('--chunk-size', type=parse_size, default='4MB', help='chunk size used by the client')
+    parser.add_argument('--concurrency', type=int, default=4, help='files uploaded at the same time')
+    parser.add_argument('--frames-per-finalize', type=int, default=100, help='frames registered per finalize request')
+    parser.add_argument('--chunk-mode', choices=['offset', 'concat'], default='offset')
+    parser.add_argument('--session-store', choices=['sql', 'redis'], default='sql')
+    parser.add_argument('--encoding', choices=['gzip', 'zstd'], help='compress every chunk on the client')
+    parser.add_argument('--no-dedup', action='store_true', help='turn off the content-addressed blob store')
+    parser.add_argument('--job-threads', type=int, default=2, help='background job threads in the server')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch database and folders')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -4,3 +4,93 @@ class Config:
     SECRET_KEY = 'secretkey'  # change this in production
     SQLALCHEMY_DATABASE_URI = 'sqlite:///astro_catalog.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # How chunked uploads are put back together:
+    #   'offset' - every chunk is written straight into a preallocated file at its byte offset
+    #   'concat' - chunks are kept as separate files and concatenated with kernel-side copies
+    UPLOAD_CHUNK_MODE = 'offset'
+
+    # Where chunked upload sessions are kept so every worker process can see them:
+    #   'sql'   - the upload_session table in the main database
+    #   'redis' - a Redis compatible server at UPLOAD_SESSION_REDIS_URL (needs the redis package)
+    UPLOAD_SESSION_STORE = 'sql'
+    UPLOAD_SESSION_REDIS_URL = 'redis://localhost:6379/0'
+    UPLOAD_SESSION_TTL = 24 * 60 * 60  # seconds
+
+    # Store uploaded files once per content digest (see app/blobstore.py), identical
+    # uploads then share the same file on disk
+    UPLOAD_DEDUP = True
+
+    # Background clean-up of expired and abandoned chunked uploads (see app/upload_janitor.py)
+    UPLOAD_JANITOR_INTERVAL = 15 * 60  # seconds, 0 turns the janitor thread off
+    UPLOAD_TEMP_BUDGET = 50 * 1024 ** 3  # bytes of chunks kept in TEMP_UPLOAD_FOLDER, None for no limit
+
+    # /finalize-upload parses its multipart body itself and writes every file part
+    # straight to its upload folder (see app/multipart_stream.py)
+    FINALIZE_STREAMING = True
+    FINALIZE_MAX_REQUEST_SIZE = 8 * 1024 ** 3  # bytes per request, None for no limit
+    FINALIZE_MAX_FORM_MEMORY = 4 * 1024 * 1024  # bytes per text field
+    FINALIZE_MAX_PARTS = 5000
+
+    # Background jobs (see app/jobs.py), kept in the app database
+    JOB_WORKER_THREADS = 2  # per app process, 0 to leave the jobs to `flask run-jobs`
+    JOB_POLL_INTERVAL = 1.0  # seconds an idle worker waits before looking again
+    JOB_LEASE_SECONDS = 30 * 60  # a running job is handed to another worker after this long without a heartbeat
+    JOB_HEARTBEAT_INTERVAL = 60  # seconds between the lease renewals of a running job
+    JOB_RETRY_DELAY = 30  # seconds before the first retry, doubled every attempt
+
+    # Fair-share admission control of the upload routes (see app/upload_admission.py),
+    # per app process. Requests that can't start within UPLOAD_ADMISSION_MAX_WAIT
+    # seconds get a 429/503 with Retry-After. 0 turns a limit off.
+    UPLOAD_MAX_CONCURRENT_PER_USER = 16  # enough for a client streaming 8-16 chunks in parallel
+    UPLOAD_MAX_CONCURRENT = 64  # shared out evenly between the users uploading
+    UPLOAD_USER_BYTES_PER_SEC = 0
+    UPLOAD_USER_BURST_BYTES = 256 * 1024 ** 2
+    UPLOAD_IO_BYTES_PER_SEC = 0  # disk write budget of all uploads together
+    UPLOAD_IO_BURST_BYTES = 512 * 1024 ** 2
+    UPLOAD_ADMISSION_MAX_WAIT = 5  # seconds
+    UPLOAD_ADMISSION_RETRY_AFTER = 2  # seconds suggested when waiting for a free slot
+
+    # Bytes each user may store (see app/storage_usage.py), checked when an upload
+    # starts. User.storage_quota overrides it per user, None for no limit.
+    STORAGE_QUOTA_BYTES = None
+
+    # Levels of hashed sub folders new uploads are spread over inside each type
+    # folder, 256 per level (see app/upload_layout.py)
+    UPLOAD_SHARD_LEVELS = 2
+
+    # Uploaded files are fsynced before they are renamed into place and before the rows
+    # pointing at them are committed, with a write-ahead journal to recover from crashes
+    # in between (see app/upload_journal.py). The fsyncs of one request are issued together.
+    UPLOAD_FSYNC = True
+    UPLOAD_FSYNC_THREADS = 8
+    UPLOAD_JOURNAL_MAX_AGE = 60 * 60  # seconds before another host's journal entry counts as abandoned
+
+    # `flask gc-uploads` (see app/upload_gc.py) collects stored files no row references
+    # once they are older than UPLOAD_GC_GRACE_SECONDS, moving them to uploads/.quarantine
+    # ('quarantine', removed for good after UPLOAD_GC_QUARANTINE_DAYS) or deleting them ('delete')
+    UPLOAD_GC_MODE = 'quarantine'
+    UPLOAD_GC_GRACE_SECONDS = 24 * 60 * 60
+    UPLOAD_GC_QUARANTINE_DAYS = 7
+
+    # Headers of the frames of a finalize batch are read on a pool of worker processes
+    # (see app/metadata_pool.py), batches under FRAME_METADATA_MIN_BATCH frames inline
+    FRAME_METADATA_WORKERS = None  # processes per app process, None for one per core, 0 for none
+    FRAME_METADATA_CHUNK_SIZE = 16  # frames sent to a worker at a time
+    FRAME_METADATA_MIN_BATCH = 64
+    # Parsed headers are kept in the frame_metadata_cache table by content digest (or by
+    # size, mtime and inode for local files without one), least recently used go first
+    FRAME_METADATA_CACHE = True
+    FRAME_METADATA_CACHE_SIZE = 1000000  # entries
+
+    # Where stored files are kept (see app/storage.py):
+    #   'local' - FINAL_UPLOAD_FOLDER on this machine
+    #   's3'    - an S3 compatible bucket (AWS, MinIO...), needs the boto3 package
+    STORAGE_BACKEND = 'local'
+    STORAGE_S3_BUCKET = None
+    STORAGE_S3_PREFIX = ''
+    STORAGE_S3_ENDPOINT_URL = None  # e.g. http://localhost:9000 for MinIO, None for AWS
+    STORAGE_S3_REGION = None
+    STORAGE_S3_ACCESS_KEY_ID = None  # None to use the usual AWS credential chain
+    STORAGE_S3_SECRET_ACCESS_KEY = None
+    STORAGE_S3_PART_SIZE = 64 * 1024 * 1024  # bytes per multipart upload part
@@ -1,8 +1,11 @@
 from app import create_app
 from flask_cors import CORS
 
-app = create_app()
-CORS(app)
+# Worker processes of the metadata pool (app/metadata_pool.py) run this file
+# again as __mp_main__, they only need the header readers, not an app
+if __name__ != '__mp_main__':
+    app = create_app()
+    CORS(app)
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend modules are imported the way run.py sees them (app, api, config)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))